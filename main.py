@@ -1,14 +1,29 @@
 """Fichier principal pour les predictions.
 
 Ce module sert a creer des modeles de predictions de signalements et des
-cartes pour comparer les predictions au signalements rellement recus.
-
-Remplissez la partie "PARAMETRES" puis executez le fichier pour creer des
-modeles et des cartes.
+cartes pour comparer les predictions au signalements rellement recus, en
+ligne de commande :
+    python main.py bin      discretise les signalements (remplit le cache)
+    python main.py train    entraine et sauvegarde un modele
+    python main.py predict  sauvegarde les signalements predits (`.npy`)
+    python main.py render   cree l'image comparant predictions et realite
+    python main.py score    affiche les scores des predictions
+
+Les parametres sont donnes en options (`python main.py train --help`) ou
+dans un fichier `.json` dont les cles sont les noms des options (avec `_` a
+la place de `-`), par exemple :
+    {"grille": [240, 240], "methode": "foret", "tuiles": [4, 4],
+     "entrainement": ["2017-04", "2020-10"]}
+    python main.py --config parametres.json train --graine 1
+Les options de la ligne de commande remplacent celles du fichier.
+
+Les modules de calcul (`pandas`, `sklearn`, images) ne sont importes que par
+la commande qui les utilise, et le fichier des constantes n'est lu qu'a ce
+moment : l'aide et les erreurs d'arguments s'affichent immediatement.
 
 Remarques :
-- Il est necessaire d'avoir rempli correctement le fichier `constants.json``
-avant toute utilisation
+- Il est necessaire d'avoir rempli correctement le fichier `constants.json`
+(ou d'en donner un autre avec `--constantes`) avant toute utilisation
 - Les donnees de signalements sont disponibles jusqu'au mois d'octobre 2021
 inclus, n'essayez donc pas d'entrainer un modele au-dela.
 - Le "nombre de pixels par division" correspond au nombre de pixels pour les
@@ -16,86 +31,398 @@ cotes des divisions (qui sont des carres).
 """
 
 
-from scripts.predictions import make_model, predict
+import os
+import sys
+import json
+import argparse
+
+# modules de calcul importes sans paquet (comme entre eux)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'scripts'))
+
+
+
+def month_arg(text):
+    """Renvoie le couple `(annee, mois)` (annee depuis 2000) d'un mois
+    `'AAAA-MM'`.
+        `text`: mois au format `'AAAA-MM'`"""
+
+    parts = text.split('-')
+    if (len(parts) != 2 or not all(part.isdigit() for part in parts)
+            or not 2000 <= int(parts[0]) < 2100
+            or not 1 <= int(parts[1]) <= 12):
+        raise ValueError(f'Mois invalide : {text} (format AAAA-MM)')
+
+    return int(parts[0]) - 2000, int(parts[1])
+
+
+def step_arg(value):
+    """Renvoie le pas de temps d'une option : nom (`'mois'`, `'semaine'`,
+    `'jour'`) ou nombre de jours.
+        `value`: valeur de l'option (texte ou entier)"""
+
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+
+    return value
+
+
+def tiles_arg(values):
+    """Renvoie le decoupage en tuiles d'une option : None, `'regions'` ou
+    couple `(nb_tuiles_long, nb_tuiles_lat)`.
+        `values`: None, `'regions'` ou liste de valeurs de l'option"""
 
+    if values is None or values == 'regions' or values == ['regions']:
+        return None if values is None else 'regions'
+    if len(values) != 2:
+        raise ValueError('Tuiles invalides : "regions" ou deux nombres '
+                         '(tuiles en longitude et en latitude) attendus')
 
-##################
-##  PARAMETRES  ##
-##################
+    return tuple(int(value) for value in values)
 
-## Que faire ?
 
-creer_un_modele = False
-creer_des_cartes = False
-utiliser_lyme = False
+def window_name(dates):
+    """Renvoie le nom d'une periode (`'04-17->10-20'`, comme dans les noms
+    des modeles et des images).
+        `dates`: couple `((annee, mois), (annee, mois))`"""
 
+    (year_min, month_min), (year_max, month_max) = dates
 
-## Carte
+    return f'{month_min:0>2}-{year_min}->{month_max:0>2}-{year_max}'
 
-nombre_divisions_latitude = 120
-nombre_divisions_longitude = 120
-pixels_par_divion = 4
 
+def settings(args):
+    """Renvoie le dictionnaire des parametres des fonctions de calcul deduits
+    des options (grille, periodes, noms des fichiers...).
+        `args`: options lues par `build_parser`"""
 
-## Dates d'entrainement
+    nb_div_long, nb_div_lat = args.grille
+    dates_train = tuple(month_arg(text) for text in args.entrainement)
+    dates_test = tuple(month_arg(text) for text in args.test)
+    model_name = (getattr(args, 'modele', None)
+                  or f'model({window_name(dates_train)})')
 
-mois_debut_entrainement = 4
-annee_debut_entrainement = 17
-mois_fin_entrainement = 10
-annee_fin_entrainement = 20
+    return {'map_info': (nb_div_long, nb_div_lat, args.pixels),
+            'dates_train': dates_train,
+            'dates_test': dates_test,
+            'base_map_info': (None if args.divisions_base is None
+                              else tuple(args.divisions_base)),
+            'step': step_arg(args.pas_de_temps),
+            'model_name': model_name,
+            'image_name': (f'pred({window_name(dates_train)})'
+                           f'_test({window_name(dates_test)})')}
 
 
-## Dates de test
+def load_predictions(args):
+    """Importe `predictions` et charge les constantes (fichier `--constantes`
+    s'il est donne).
+        `args`: options lues par `build_parser`"""
 
-mois_debut_test = 11
-annee_debut_test = 20
-mois_fin_test = 10
-annee_fin_test = 21
+    import predictions
+    predictions.load_constants(args.constantes)
 
+    return predictions
 
-## Regroupement par periodes
 
-nombre_mois_par_periode = 1
+def run_bin(args):
+    """Commande `bin` : discretise les signalements des periodes
+    d'entrainement et de test (cache binaire des signalements rempli pour les
+    commandes suivantes)."""
 
+    params = settings(args)
+    predictions = load_predictions(args)
 
-## Nom des fichiers
+    for name, dates in (('d\'entra\u00EEnement', params['dates_train']),
+                        ('de test', params['dates_test'])):
+        cube, _ = predictions.make_cube(
+            params['map_info'], dates, args.lyme, params['base_map_info'],
+            args.variables_decalees, params['step'])
+        print(f'P\u00E9riode {name} ({window_name(dates)}) : '
+              f'{int(cube.counts.sum())} signalements, {cube.nnz} cases '
+              f'non vides sur {len(cube.dates)} pas de temps')
+
+
+def run_train(args):
+    """Commande `train` : entraine et sauvegarde un modele (voir
+    `predictions.make_model`)."""
+
+    params = settings(args)
+    predictions = load_predictions(args)
+
+    train_time, model_size = predictions.make_model(
+        params['map_info'], params['dates_train'], params['model_name'],
+        args.lyme, params['base_map_info'], args.proportion_cases_vides,
+        args.graine, lags=args.variables_decalees, engine=args.methode,
+        nb_jobs=args.coeurs, tiles=tiles_arg(args.tuiles),
+        nb_workers=args.processus, step=params['step'],
+        profiling=args.profilage)
 
-nom_modele = (f'model({mois_debut_entrainement:0>2}-{annee_debut_entrainement}'
-              +f'->{mois_fin_entrainement:0>2}-{annee_fin_entrainement})')
+    print(f'Mod\u00E8le : {params["model_name"]}\n'
+          f'Temps d\'entra\u00EEnement : {train_time:.2f} s\n'
+          f'Taille du mod\u00E8le : {model_size/1e6:.2f} Mo')
 
-nom_image = (f'pred({mois_debut_entrainement:0>2}-{annee_debut_entrainement}'
-             +f'->{mois_fin_entrainement:0>2}-{annee_fin_entrainement})'
-             +f'_test({mois_debut_test:0>2}-{annee_debut_test}'
-             +f'->{mois_fin_test:0>2}-{annee_fin_test})')
 
+def run_predict(args):
+    """Commande `predict` : sauvegarde le tableau `(nb_pas_de_temps,
+    nb_divisions)` des signalements predits sur la periode de test."""
 
+    params = settings(args)
+    predictions = load_predictions(args)
+    import numpy as np
+    from dtypes import set_row
+
+    cube, _ = predictions.make_cube(
+        params['map_info'], params['dates_test'], args.lyme,
+        params['base_map_info'], args.variables_decalees, params['step'])
+
+    tiles = tiles_arg(args.tuiles)
+    if tiles is None:
+        model = predictions.load_model(params['model_name'])
+        months = predictions.iter_predictions(cube, model)
+    else:
+        from tiles import iter_tile_predictions
+        months = iter_tile_predictions(
+            cube, os.path.join(predictions.model_path, params['model_name']
+                               + '_tuiles.joblib'),
+            nb_workers=args.processus)
+
+    values = np.zeros((len(cube.dates), cube.map_size),
+                      dtype=cube.counts.dtype)
+    for i, (_, _, month) in enumerate(months):
+        values = set_row(values, i, month)
+
+    output = args.sortie or os.path.join(
+        predictions.model_path, params['model_name'] + '_prediction.npy')
+    np.save(output, values)
+    print(f'Pr\u00E9dictions : {output}')
+
+
+def predict_scores(args, image_name):
+    """Renvoie les scores des predictions sur la periode de test (voir
+    `predictions.predict`), en creant l'image `image_name` si elle n'est pas
+    None."""
+
+    params = settings(args)
+    predictions = load_predictions(args)
+
+    return predictions.predict(
+        params['map_info'], params['dates_test'], args.periode, image_name,
+        params['model_name'], args.lyme, params['base_map_info'],
+        nb_threads=args.threads, period_images=args.images_par_periode,
+        animation=args.animation, lags=args.variables_decalees,
+        tiles=tiles_arg(args.tuiles), nb_workers=args.processus,
+        step=params['step'], profiling=args.profilage)
+
+
+def print_scores(scores, as_json=False):
+    """Affiche les scores globaux de chaque niveau et le R2 de chaque
+    periode.
+        `scores`: dictionnaire des scores (voir `metrics.Metrics.result`)
+        `as_json`: bool sur l'affichage du dictionnaire en `json`"""
+
+    if as_json:
+        print(json.dumps(scores))
+        return
+
+    score_li = ''
+    for period_scores in scores['periodes']:
+        date = period_scores['date']
+        day = f'{date[2]:0>2}/' if len(date) == 3 else ''
+        score_li += (f'\n\u2000 {day}{date[1]:0>2}/20{date[0]} : '
+                     f'{period_scores["scores"][0]["r2"]}')
+
+    for factor, level_scores in zip(scores['niveaux'], scores['global']):
+        print(f'Scores globaux (blocs de {factor}x{factor} divisions) :\n'
+              f'\u2000 R\u00B2 : {level_scores["r2"]}\n'
+              f'\u2000 Erreur absolue moyenne : '
+              f'{level_scores["erreur_absolue"]}\n'
+              f'\u2000 D\u00E9viance de Poisson moyenne : '
+              f'{level_scores["deviance_poisson"]}\n'
+              f'\u2000 Points chauds retrouv\u00E9s : '
+              f'{level_scores["points_chauds"]}')
+    print(f'Score R\u00B2 par p\u00E9riode :{score_li}')
+
+
+def run_render(args):
+    """Commande `render` : cree l'image comparant les predictions aux
+    signalements reels et affiche les scores."""
+
+    image_name = args.image or settings(args)['image_name']
+    print_scores(predict_scores(args, image_name), args.json)
+
+
+def run_score(args):
+    """Commande `score` : affiche les scores des predictions (sans image)."""
+
+    print_scores(predict_scores(args, None), args.json)
+
+
+def build_parser():
+    """Renvoie le couple `(parser, commands)` de l'analyseur des options et
+    du dictionnaire des analyseurs de chaque commande."""
+
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='python main.py <commande> --help : options d\'une commande')
+    parser.add_argument('--config',
+                        help='fichier `.json` des parametres (cles : noms '
+                             'des options)')
+    parser.add_argument('--constantes',
+                        help='fichier `.json` des constantes (par defaut '
+                             '`constants.json`)')
+    subparsers = parser.add_subparsers(dest='commande', required=True,
+                                       metavar='commande')
+
+    # options communes : donnees
+    data = argparse.ArgumentParser(add_help=False)
+    data.add_argument('--grille', type=int, nargs=2, default=[120, 120],
+                      metavar=('LONG', 'LAT'),
+                      help='nombres de divisions en longitude et en latitude')
+    data.add_argument('--divisions-base', type=int, nargs=2,
+                      metavar=('LONG', 'LAT'),
+                      help='grille fine (multiple de la grille) discretisee '
+                           'une seule fois et dont on deduit les grilles plus '
+                           'grossieres')
+    data.add_argument('--entrainement', nargs=2,
+                      default=['2017-04', '2020-10'],
+                      metavar=('DEBUT', 'FIN'),
+                      help='periode d\'entrainement (mois AAAA-MM)')
+    data.add_argument('--test', nargs=2, default=['2020-11', '2021-10'],
+                      metavar=('DEBUT', 'FIN'),
+                      help='periode de test (mois AAAA-MM)')
+    data.add_argument('--lyme', action='store_true',
+                      help='utilise les donnees de Lyme')
+    data.add_argument('--variables-decalees', action='store_true',
+                      help='ajoute les signalements du mois et de l\'annee '
+                           'precedents et des divisions voisines (identique '
+                           'pour l\'entrainement et les predictions)')
+    data.add_argument('--pas-de-temps', default='mois',
+                      help='"mois", "semaine" (du lundi au dimanche), "jour" '
+                           'ou nombre de jours (pas de temps entiers '
+                           'uniquement)')
+    data.add_argument('--pixels', type=int, default=4,
+                      help='nombre de pixels par cote de division')
+
+    # options communes : modele
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument('--modele',
+                       help='nom du modele (par defaut deduit de la periode '
+                            'd\'entrainement)')
+    model.add_argument('--tuiles', nargs='+', metavar='TUILES',
+                       help='"regions" ou nombres de tuiles en longitude et '
+                            'en latitude pour un modele par tuile '
+                            '(identique pour l\'entrainement et les '
+                            'predictions)')
+    model.add_argument('--processus', type=int,
+                       help='nombre de processus pour les tuiles (par defaut '
+                            'tous les coeurs)')
+    model.add_argument('--profilage', action='store_true',
+                       help='ecrit les mesures de chaque etape dans un '
+                            'fichier `_profil.jsonl`')
+
+    # options communes : scores et images
+    scores = argparse.ArgumentParser(add_help=False)
+    scores.add_argument('--periode', type=int, default=1,
+                        help='nombre de pas de temps rassembles dans chaque '
+                             'periode')
+    scores.add_argument('--threads', type=int,
+                        help='nombre de threads creant les images (les '
+                             'images par periode pendant les predictions)')
+    scores.add_argument('--json', action='store_true',
+                        help='affiche les scores en `json`')
+
+    command = subparsers.add_parser(
+        'bin', parents=[data],
+        help='discretise les signalements (remplit le cache)')
+    command.set_defaults(run=run_bin)
+
+    command = subparsers.add_parser(
+        'train', parents=[data, model], help='entraine un modele')
+    command.add_argument('--methode', default='arbre',
+                         choices=['arbre', 'gradient', 'foret'],
+                         help='arbre de decision, gradient boosting (perte '
+                              'de Poisson) ou foret aleatoire')
+    command.add_argument('--coeurs', type=int,
+                         help='nombre de coeurs de la foret aleatoire (par '
+                              'defaut tous)')
+    command.add_argument('--proportion-cases-vides', type=float,
+                         help='proportion des cases sans signalement gardees '
+                              'pour l\'entrainement (par defaut toutes)')
+    command.add_argument('--graine', type=int, default=0,
+                         help='graine aleatoire')
+    command.set_defaults(run=run_train)
+
+    command = subparsers.add_parser(
+        'predict', parents=[data, model],
+        help='sauvegarde les signalements predits')
+    command.add_argument('--sortie',
+                         help='fichier `.npy` des predictions (par defaut a '
+                              'cote du modele)')
+    command.set_defaults(run=run_predict)
+
+    command = subparsers.add_parser(
+        'render', parents=[data, model, scores],
+        help='cree la carte comparant predictions et realite')
+    command.add_argument('--image',
+                         help='nom de l\'image (par defaut deduit des '
+                              'periodes)')
+    command.add_argument('--images-par-periode', action='store_true',
+                         help='une image par periode (avec --threads)')
+    command.add_argument('--animation', choices=['gif', 'apng'],
+                         help='image animee sur toutes les periodes (avec '
+                              '--threads)')
+    command.set_defaults(run=run_render)
+
+    command = subparsers.add_parser(
+        'score', parents=[data, model, scores],
+        help='affiche les scores des predictions')
+    command.set_defaults(run=run_score, images_par_periode=False,
+                         animation=None)
+
+    return parser, subparsers.choices
+
+
+def parse_args(argv=None):
+    """Renvoie les options de la ligne de commande, completees par celles du
+    fichier `--config` (les options de la ligne de commande sont
+    prioritaires).
+        `argv`: None (`sys.argv`) ou liste des arguments"""
+
+    parser, commands = build_parser()
+    args = parser.parse_args(argv)
+    if args.config is None:
+        return args
+
+    with open(args.config, 'r') as config:
+        config = json.load(config)
+
+    # un meme fichier peut servir a toutes les commandes : seules les options
+    # d'aucune commande sont refusees
+    options = {name: set(vars(command.parse_args([]))) - {'run'}
+               for name, command in commands.items()}
+    unknown = set(config).difference(*options.values())
+    if unknown:
+        parser.error(f'options inconnues dans {args.config} : '
+                     f'{", ".join(sorted(unknown))}')
+
+    # valeurs du fichier utilisees comme valeurs par defaut
+    commands[args.commande].set_defaults(
+        **{key: value for key, value in config.items()
+           if key in options[args.commande]})
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Execute la commande de la ligne de commande.
+        `argv`: None (`sys.argv`) ou liste des arguments"""
+
+    args = parse_args(argv)
+    try:
+        args.run(args)
+    except ValueError as error:
+        sys.exit(f'Erreur : {error}')
 
-###############################################
-##  EXECUTION - NE RIEN MODIFIER CI-DESSOUS  ##
-###############################################
 
 if __name__ == '__main__':
-    map_info = (nombre_divisions_latitude,
-                nombre_divisions_longitude,
-                pixels_par_divion)
-
-    dates_train = ((annee_debut_entrainement, mois_debut_entrainement),
-                   (annee_fin_entrainement, mois_fin_entrainement))
-
-    dates_test = ((annee_debut_test, mois_debut_test),
-                   (annee_fin_test, mois_fin_test))
-
-    if creer_un_modele:
-        make_model(map_info, dates_train, nom_modele, utiliser_lyme)
-
-    if creer_des_cartes:
-        r2_score, r2_score_li = predict(
-            map_info, dates_test, nombre_mois_par_periode, nom_image,
-            nom_modele, utiliser_lyme)
-        
-        score_li = ''
-        for date, score in r2_score_li:
-            score_li += f'\n\u2000 {date[1]:0>2}/20{date[0]} : {score}'
-        
-        print(f'Score R\u00B2 global des pr\u00E9dictions : {r2_score}\n'
-              f'Score R\u00B2 par p\u00E9riode :{score_li}')
+    main()
@@ -0,0 +1,130 @@
+"""Evaluation glissante des modeles.
+
+Ce module sert a evaluer la fiabilite des predictions en entrainant des
+modeles sur des periodes successives (entrainement jusqu'au mois `m`, test
+sur les mois `m+1` a `m+k`) et a rassembler les scores (R2, erreur absolue,
+deviance de Poisson, points chauds, voir `metrics`) par origine et par
+horizon dans une table.
+
+Les signalements ne sont discretises qu'une seule fois sur tout l'historique,
+et les donnees d'entrainement de chaque mois ne sont construites qu'une fois
+puis reutilisees par toutes les origines qui les contiennent : d'une origine
+a la suivante, seul le nouveau mois est ajoute avant de reentrainer l'arbre.
+"""
+
+
+import numpy as np
+import pandas as pd
+import predictions
+from predictions import sparse_train_set, fit_model, iter_predictions
+from flat_tree import tree_to_nodes, predict_tree
+from make_sglmt_df import sglmt_cube
+from metrics import Metrics
+
+
+
+def month_train_set(cube, i, zero_fraction, seed):
+    """Renvoie les donnees d'entrainement `(X, y, poids)` du mois `i`.
+        `cube`: `CountCube` sur tout l'historique
+        `i`: indice du mois dans `cube.dates`
+        `zero_fraction`: None (toutes les divisions) ou proportion des
+        divisions sans signalement conservees
+        `seed`: graine du tirage des divisions sans signalement"""
+
+    month = cube.slice_months(i, i+1)
+    if zero_fraction is None:
+        indices = np.arange(month.map_size)
+        return (month.features(indices), month.values_at(indices),
+                np.ones(month.map_size))
+
+    return sparse_train_set(month, zero_fraction, seed + i)
+
+
+def backtest(map_info, dates_info, first_origin, horizon, lyme,
+             zero_fraction=None, seed=0, train_months=None):
+    """Evalue des modeles entraines sur des periodes glissantes et renvoie la
+    table des scores (une ligne par origine et par horizon).
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `dates_info`: couple sur tout l'historique etudie
+        `first_origin`: couple `(annee, mois)` du dernier mois d'entrainement
+        de la premiere origine
+        `horizon`: nombre de mois testes apres chaque origine
+        `lyme`: bool sur l'utilisation ou non des donnees de Lyme
+        `zero_fraction`: None ou proportion des divisions sans signalement
+        conservees pour l'entrainement
+        `seed`: graine des tirages et des arbres
+        `train_months`: None (tout l'historique avant l'origine) ou nombre de
+        mois d'entrainement (fenetre glissante)"""
+
+    # verification des parametres avant la discretisation (au moins une
+    # origine suivie de `horizon` mois dans l'historique)
+    (year1, month1), (year2, month2) = dates_info
+    nb_months = year2*12 + month2 - (year1*12 + month1) + 1
+    year, month = first_origin
+    first = year*12 + month - (year1*12 + month1)
+    if int(horizon) != horizon or horizon < 1:
+        raise ValueError(f'Horizon invalide : {horizon}')
+    if train_months is not None and (int(train_months) != train_months
+                                     or train_months < 1):
+        raise ValueError(f"Nombre de mois d'entrainement invalide : "
+                         f'{train_months}')
+    if not 0 <= first < nb_months - horizon:
+        raise ValueError(f'Premiere origine {month:0>2}/20{year} hors de '
+                         f"l'historique ({month1:0>2}/20{year1} a "
+                         f'{month2:0>2}/20{year2}) ou trop tardive pour un '
+                         f'horizon de {horizon} mois')
+
+    predictions.ensure_constants()
+    lyme_info = predictions.lyme_data if lyme else None
+
+    # discretisation unique de tout l'historique
+    cube, dates = sglmt_cube(predictions.bounds,
+                             predictions.sglmt_data_file, map_info,
+                             dates_info, lyme_info, predictions.cache_path)
+
+    blocks = {}
+    rows = []
+    for origin in range(first, len(dates) - horizon):
+        # donnees d'entrainement : seuls les nouveaux mois sont construits
+        start = 0 if train_months is None else max(0, origin+1-train_months)
+        for i in range(start, origin+1):
+            if i not in blocks:
+                blocks[i] = month_train_set(cube, i, zero_fraction, seed)
+        for i in [i for i in blocks if i < start]:
+            del blocks[i]
+
+        X = np.concatenate([blocks[i][0] for i in range(start, origin+1)])
+        y = np.concatenate([blocks[i][1] for i in range(start, origin+1)])
+        weights = np.concatenate([blocks[i][2]
+                                  for i in range(start, origin+1)])
+
+        nodes = tree_to_nodes(fit_model(
+            X, y, None if zero_fraction is None else weights, seed))
+        model = lambda X: predict_tree(nodes, X)
+
+        # test sur les mois suivants
+        test = cube.slice_months(origin+1, origin+1+horizon)
+        metrics = Metrics(map_info)
+        for h, (date, theory, predicted) in enumerate(
+                iter_predictions(test, model), start=1):
+            row = {'annee_origine': dates[origin][0],
+                   'mois_origine': dates[origin][1],
+                   'horizon': h, 'annee': date[0], 'mois': date[1]}
+            # scores de la grille, puis des grilles plus grossieres suffixes
+            for factor, scores in zip(metrics.levels,
+                                      metrics.add(date, theory, predicted)):
+                suffix = '' if factor == 1 else f'_{factor}x{factor}'
+                row.update({name + suffix: value
+                            for name, value in scores.items()})
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    scores = backtest(map_info=(120, 120), dates_info=((17, 4), (21, 10)),
+                      first_origin=(19, 10), horizon=3, lyme=False,
+                      zero_fraction=0.05)
+    print(scores.pivot(index=['annee_origine', 'mois_origine'],
+                       columns='horizon', values='r2'))
@@ -0,0 +1,433 @@
+"""Mesures de performances.
+
+Ce module sert a mesurer les temps de calcul des principales etapes
+(`sglmt_df`, `make_model`, `predict`, `comparative_total`) sur des donnees
+synthetiques bien plus volumineuses que les donnees reelles, pour plusieurs
+nombres de signalements, tailles de grille et nombres de mois. Les temps sont
+rassembles dans une table `.csv` et une image des courbes d'evolution, et
+compares a des temps de reference : l'execution echoue (code de sortie non
+nul) si une etape est devenue trop lente. Le demarrage de la ligne de
+commande (`main.py`) est aussi mesure : l'aide de chaque commande doit
+s'afficher sans importer les modules de calcul et en moins de
+`STARTUP_BUDGET` secondes.
+
+Les donnees synthetiques reprennent les signalements reels (tires au hasard
+avec remise puis deplaces de quelques km) : la saisonnalite, la repartition
+geographique en foyers et les regions sont ainsi conservees.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+import predictions
+from make_sglmt_df import sglmt_df, sglmt_cube
+from create_maps import comparative_total, get_font
+from sglmt_cache import (read_columns, read_regions, join_regions,
+                         load_columns)
+
+
+
+# etapes mesurees
+STAGES = ['sglmt_df_froid', 'sglmt_df', 'make_model', 'predict',
+          'comparative_total']
+
+# ligne de commande (voir `main.py`) : commandes dont le demarrage est
+# mesure, temps de demarrage maximal (en s) et modules de calcul qu'elle ne
+# doit pas importer avant d'executer une commande
+MAIN_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'main.py')
+COMMANDS = ['bin', 'train', 'predict', 'render', 'score']
+STARTUP_BUDGET = 0.5
+HEAVY_MODULES = ['numpy', 'pandas', 'sklearn', 'joblib', 'PIL']
+
+# variables de `predictions` remplacees par `use_data`
+DATA_CONSTANTS = ['sglmt_data_file', 'regions_file', 'lyme_data', 'model_path',
+                  'export_path', 'cache_path', 'results_path']
+
+# couleurs des courbes
+COLORS = [(31, 119, 180), (255, 127, 14), (44, 160, 44), (214, 39, 40),
+          (148, 103, 189), (140, 86, 75), (227, 119, 194), (127, 127, 127)]
+
+
+def synthetic_data(export_dir, scale, source_files, seed=0, jitter=0.05,
+                   chunk_size=1 << 20):
+    """Cree des fichiers de signalements et de regions synthetiques (memes
+    formats que les fichiers reels) avec `scale` fois plus de signalements, et
+    renvoie le couple `(sglmt_file, regions_file)` des couples `(chemin,
+    delimiteur)`. Les fichiers deja crees sont reutilises.
+        `export_dir`: repertoire des fichiers a creer
+        `scale`: nombre de signalements synthetiques par signalement reel
+        `source_files`: couple `(sglmt_file, regions_file)` des fichiers
+        reels dont sont tires les signalements
+        `seed`: graine des tirages
+        `jitter`: ecart type du deplacement des signalements (en degres)
+        `chunk_size`: nombre de lignes ecrites a la fois"""
+
+    sglmt_path = os.path.join(export_dir, f'signalements_x{scale}.csv')
+    regions_path = os.path.join(export_dir, f'regions_x{scale}.csv')
+    if os.path.exists(sglmt_path) and os.path.exists(regions_path):
+        return (sglmt_path, ';'), (regions_path, ';')
+
+    sglmt_file, regions_file = source_files
+    columns = read_columns(sglmt_file)
+    codes, names = join_regions(columns['ref'], read_regions(regions_file))
+    names = np.array(names + [''])
+    nb_source = len(columns['ref'])
+
+    rng = np.random.default_rng(seed)
+    tmp_paths = [f'{path}.{os.getpid()}.tmp'
+                 for path in (sglmt_path, regions_path)]
+    nb_rows = nb_source*scale
+    for start in range(0, nb_rows, chunk_size):
+        size = min(chunk_size, nb_rows - start)
+
+        # signalements reels tires avec remise puis deplaces
+        source = rng.integers(0, nb_source, size)
+        year, month = np.divmod(columns['rel_month'][source] - 1, 12)
+        sglmt_data = pd.DataFrame({
+            'ref': np.arange(start, start+size) + 1,
+            'day': columns['day'][source],
+            'month': month + 1,
+            'year': year + 2000,
+            'lat': columns['lat'][source] + rng.normal(0, jitter, size),
+            'long': columns['long'][source] + rng.normal(0, jitter, size)})
+        sglmt_data.to_csv(tmp_paths[0], sep=';', index=False,
+                          float_format='%.6f', mode='w' if start == 0 else 'a',
+                          header=start == 0)
+
+        # region du signalement reel d'origine
+        known = codes[source] >= 0
+        regions = pd.DataFrame({'ref': sglmt_data['ref'][known],
+                                'region': names[codes[source][known]],
+                                'departement': ''})
+        regions.to_csv(tmp_paths[1], sep=';', index=False,
+                       mode='w' if start == 0 else 'a', header=start == 0)
+
+    os.replace(tmp_paths[0], sglmt_path)
+    os.replace(tmp_paths[1], regions_path)
+
+    return (sglmt_path, ';'), (regions_path, ';')
+
+
+def use_data(sglmt_file, regions_file, work_dir):
+    """Fait utiliser a `predictions` des fichiers de donnees et des
+    repertoires de travail donnes (sans cache des resultats).
+        `sglmt_file`: couple sur le fichier de signalements
+        `regions_file`: couple sur le fichier de regions
+        `work_dir`: repertoire des modeles, des images et du cache"""
+
+    predictions.sglmt_data_file = sglmt_file
+    predictions.regions_file = regions_file
+    predictions.lyme_data = (regions_file, predictions.lyme_data[1])
+    predictions.model_path = work_dir
+    predictions.export_path = work_dir + os.sep
+    predictions.cache_path = os.path.join(work_dir, 'cache')
+    predictions.results_path = None
+
+
+def span_dates(nb_months, first=(17, 4)):
+    """Renvoie les periodes d'entrainement (deux premiers tiers) et de test
+    (dernier tiers) sur `nb_months` mois.
+        `nb_months`: nombre de mois etudies
+        `first`: couple `(annee, mois)` du premier mois"""
+
+    def date(i):
+        year, month = divmod(first[0]*12 + first[1]-1 + i, 12)
+        return year, month+1
+
+    nb_train = max(1, (2*nb_months)//3)
+
+    return ((date(0), date(nb_train-1)),
+            (date(nb_train), date(nb_months-1)))
+
+
+def benchmark_case(scale, grid, nb_months, work_dir, source_files,
+                   zero_fraction=0.05):
+    """Mesure les temps de chaque etape pour une combinaison et renvoie la
+    liste des lignes de resultats.
+        `scale`: nombre de signalements synthetiques par signalement reel
+        `grid`: nombre de divisions en latitude et en longitude
+        `nb_months`: nombre de mois etudies
+        `work_dir`: repertoire des donnees synthetiques et des fichiers crees
+        `source_files`: couple des fichiers reels (voir `synthetic_data`)
+        `zero_fraction`: proportion des divisions vides gardees pour
+        l'entrainement (voir `predictions.sparse_train_set`)"""
+
+    name = f'x{scale}_{grid}x{grid}_{nb_months}mois'
+    case_dir = os.path.join(work_dir, name)
+    os.makedirs(case_dir, exist_ok=True)
+
+    sglmt_file, regions_file = synthetic_data(work_dir, scale, source_files)
+    use_data(sglmt_file, regions_file, case_dir)
+    shutil.rmtree(predictions.cache_path, ignore_errors=True)
+    map_info = (grid, grid, max(1, 480//grid))
+    dates_train, dates_test = span_dates(nb_months)
+
+    durations = {}
+    start = time.perf_counter()
+    sglmt_df(predictions.bounds, sglmt_file, map_info[:-1], dates_train,
+             None, predictions.cache_path)
+    durations['sglmt_df_froid'] = time.perf_counter() - start
+    nb_rows = len(load_columns(sglmt_file, predictions.cache_path)['ref'])
+
+    start = time.perf_counter()
+    sglmt_df(predictions.bounds, sglmt_file, map_info[:-1], dates_train,
+             None, predictions.cache_path)
+    durations['sglmt_df'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions.make_model(map_info, dates_train, name, False,
+                           zero_fraction=zero_fraction)
+    durations['make_model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions.predict(map_info, dates_test, 1, None, name, False)
+    durations['predict'] = time.perf_counter() - start
+
+    cube, dates = sglmt_cube(predictions.bounds, sglmt_file, map_info[:-1],
+                             dates_test, None, predictions.cache_path)
+    sglmts = cube.to_dense().ravel()
+    start = time.perf_counter()
+    comparative_total(sglmts, sglmts, map_info, dates, 1,
+                      (predictions.export_path, name))
+    durations['comparative_total'] = time.perf_counter() - start
+
+    return [{'cas': name, 'signalements': nb_rows, 'grille': grid,
+             'mois': nb_months, 'etape': stage, 'duree': durations[stage]}
+            for stage in STAGES]
+
+
+def benchmark(scales, grids, month_spans, work_dir, results_file,
+              zero_fraction=0.05):
+    """Mesure toutes les combinaisons et renvoie la table des resultats
+    (aussi ecrite dans `results_file`).
+        `scales`: liste des nombres de signalements par signalement reel
+        `grids`: liste des nombres de divisions par cote
+        `month_spans`: liste des nombres de mois etudies
+        `work_dir`: repertoire des donnees synthetiques et des fichiers crees
+        `results_file`: chemin de la table `.csv` des resultats
+        `zero_fraction`: proportion des divisions vides gardees pour
+        l'entrainement"""
+
+    # import de `sklearn` fait hors des mesures
+    import sklearn.tree
+
+    # donnees reelles dont sont tirees les donnees synthetiques (variables de
+    # `predictions` retablies a la fin)
+    predictions.ensure_constants()
+    saved = {name: getattr(predictions, name) for name in DATA_CONSTANTS}
+    source_files = (predictions.sglmt_data_file, predictions.regions_file)
+
+    rows = []
+    try:
+        for scale, grid, nb_months in itertools.product(scales, grids,
+                                                        month_spans):
+            rows += benchmark_case(scale, grid, nb_months, work_dir,
+                                   source_files, zero_fraction)
+            print(rows[-len(STAGES)]['cas'],
+                  {row['etape']: round(row['duree'], 3)
+                   for row in rows[-len(STAGES):]})
+    finally:
+        for name, value in saved.items():
+            setattr(predictions, name, value)
+
+    results = pd.DataFrame(rows)
+    results.to_csv(results_file, index=False)
+
+    return results
+
+
+def plot_curves(results, path, x='signalements', size=(900, 600)):
+    """Cree l'image des courbes d'evolution des temps (echelles
+    logarithmiques) en fonction d'un parametre, une courbe par etape et par
+    valeur des autres parametres.
+        `results`: table des resultats (voir `benchmark`)
+        `path`: chemin du fichier `.png` a creer
+        `x`: parametre en abscisse (`'signalements'`, `'grille'`, `'mois'`)
+        `size`: couple `(largeur, hauteur)` de l'image"""
+
+    width, height = size
+    margin, legend_width = 60, 260
+    others = [column for column in ('signalements', 'grille', 'mois')
+              if column != x]
+    curves = results.groupby(['etape'] + others)
+
+    log_x = np.log10(results[x].to_numpy(dtype=float))
+    log_y = np.log10(np.maximum(results['duree'].to_numpy(), 1e-4))
+    x_min, x_max = log_x.min(), max(log_x.max(), log_x.min() + 1e-9)
+    y_min, y_max = log_y.min(), max(log_y.max(), log_y.min() + 1e-9)
+
+    def point(x_value, y_value):
+        plot_width = width - 2*margin - legend_width
+        return (margin + (np.log10(x_value) - x_min)/(x_max - x_min)
+                * plot_width,
+                height - margin - (np.log10(max(y_value, 1e-4)) - y_min)
+                / (y_max - y_min) * (height - 2*margin))
+
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = get_font(12)
+    draw.line([(margin, margin), (margin, height-margin),
+               (width-margin-legend_width, height-margin)], fill=0)
+    draw.text((margin, height-margin+20), f'{x} (log)', fill=0, font=font)
+    draw.text((5, 5), 'duree en s (log) : '
+              f'{10**y_min:.3g} a {10**y_max:.3g}', fill=0, font=font)
+
+    for i, (key, curve) in enumerate(curves):
+        color = COLORS[i % len(COLORS)]
+        curve = curve.sort_values(x)
+        points = [point(x_value, y_value) for x_value, y_value
+                  in zip(curve[x], curve['duree'])]
+        if len(points) > 1:
+            draw.line(points, fill=color, width=2)
+        for x_point, y_point in points:
+            draw.ellipse([x_point-3, y_point-3, x_point+3, y_point+3],
+                         fill=color)
+        label = ' '.join(str(value) for value in key)
+        draw.text((width-legend_width, margin + 16*i), label, fill=color,
+                  font=font)
+
+    image.save(path)
+
+
+def write_baseline(results, baseline_file):
+    """Ecrit les temps de reference `{cas: {etape: duree}}` en `.json`.
+        `results`: table des resultats (voir `benchmark`)
+        `baseline_file`: chemin du fichier `.json`"""
+
+    baseline = {}
+    for row in results.itertuples():
+        baseline.setdefault(row.cas, {})[row.etape] = row.duree
+    with open(baseline_file, 'w') as file:
+        json.dump(baseline, file, indent=4)
+
+
+def check_baseline(results, baseline_file, tolerance=1.5, min_duration=0.05):
+    """Compare les temps aux temps de reference et renvoie la liste des
+    messages sur les etapes trop lentes (vide si tout va bien).
+        `results`: table des resultats (voir `benchmark`)
+        `baseline_file`: chemin du fichier `.json` des temps de reference
+        (voir `write_baseline`)
+        `tolerance`: rapport maximal accepte avec le temps de reference
+        `min_duration`: duree (en s) en dessous de laquelle une etape n'est
+        pas comparee (mesures trop bruitees)"""
+
+    with open(baseline_file, 'r') as file:
+        baseline = json.load(file)
+
+    regressions = []
+    for row in results.itertuples():
+        reference = baseline.get(row.cas, {}).get(row.etape)
+        if reference is None or max(row.duree, reference) < min_duration:
+            continue
+        if row.duree > tolerance*reference:
+            regressions.append(f'{row.cas} {row.etape} : {row.duree:.3f} s '
+                               f'(reference {reference:.3f} s)')
+
+    return regressions
+
+
+def check_startup(budget=STARTUP_BUDGET, repeats=5):
+    """Mesure le demarrage de la ligne de commande (aide de chaque commande,
+    meilleur temps sur `repeats` lancements) et renvoie la liste des messages
+    sur les commandes trop lentes ou qui importent des modules de calcul
+    (vide si tout va bien).
+        `budget`: temps de demarrage maximal (en s)
+        `repeats`: nombre de lancements de chaque commande"""
+
+    # modules importes par l'aide d'une commande
+    script = ('import sys, runpy\n'
+              'sys.argv = sys.argv[1:]\n'
+              'try:\n'
+              '    runpy.run_path(sys.argv[0], run_name="__main__")\n'
+              'except SystemExit:\n'
+              '    pass\n'
+              f'print(*[name for name in {HEAVY_MODULES!r} '
+              'if name in sys.modules], file=sys.stderr)\n')
+
+    messages = []
+    for command in [None] + COMMANDS:
+        argv = [MAIN_FILE] + ([] if command is None else [command]) + ['-h']
+        name = 'main.py' if command is None else f'main.py {command}'
+
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv, check=True,
+                           stdout=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - start)
+        if min(durations) > budget:
+            messages.append(f'{name} : demarrage en {min(durations):.3f} s '
+                            f'(maximum {budget:.3f} s)')
+
+        imported = subprocess.run([sys.executable, '-c', script] + argv,
+                                  check=True, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE, text=True)
+        if imported.stderr.split():
+            messages.append(f'{name} : modules importes au demarrage '
+                            f'({", ".join(imported.stderr.split())})')
+
+    return messages
+
+
+if __name__ == '__main__':
+    predictions.ensure_constants()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--echelles', type=int, nargs='+', default=[1, 10],
+                        help='signalements synthetiques par signalement reel')
+    parser.add_argument('--grilles', type=int, nargs='+',
+                        default=[30, 120, 480],
+                        help='nombres de divisions par cote')
+    parser.add_argument('--mois', type=int, nargs='+', default=[12, 43],
+                        help='nombres de mois etudies')
+    parser.add_argument('--repertoire', default=os.path.join(
+                            predictions.model_path, 'benchmark'),
+                        help='repertoire des donnees et des resultats')
+    parser.add_argument('--reference',
+                        help='fichier `.json` des temps de reference')
+    parser.add_argument('--ecrire-reference', action='store_true',
+                        help='remplace les temps de reference')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='rapport maximal avec les temps de reference')
+    parser.add_argument('--budget-demarrage', type=float,
+                        default=STARTUP_BUDGET,
+                        help='temps de demarrage maximal de `main.py` (s)')
+    parser.add_argument('--demarrage-seul', action='store_true',
+                        help='mesure uniquement le demarrage de `main.py`')
+    args = parser.parse_args()
+
+    # demarrage de la ligne de commande
+    regressions = check_startup(args.budget_demarrage)
+    if args.demarrage_seul:
+        for message in regressions:
+            print('Regression :', message)
+        sys.exit(1 if regressions else 0)
+
+    os.makedirs(args.repertoire, exist_ok=True)
+    results = benchmark(args.echelles, args.grilles, args.mois,
+                        args.repertoire,
+                        os.path.join(args.repertoire, 'benchmark.csv'))
+    for x in ('signalements', 'grille', 'mois'):
+        if results[x].nunique() > 1:
+            plot_curves(results, os.path.join(args.repertoire,
+                                              f'benchmark_{x}.png'), x)
+
+    if args.reference is not None:
+        if args.ecrire_reference or not os.path.exists(args.reference):
+            write_baseline(results, args.reference)
+        else:
+            regressions += check_baseline(results, args.reference,
+                                          args.tolerance)
+    for message in regressions:
+        print('Regression :', message)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,349 @@
+"""Cube creux de signalements.
+
+Ce module sert a stocker le nombre de signalements par pas de temps (mois,
+semaine, jour...) et par division sous forme creuse (seules les combinaisons
+de pas de temps et de zone non vides sont conservees), et a en extraire des
+tableaux denses ou des `pandas.DataFrame`. Les nombres de signalements sont
+stockes dans le type entier le plus etroit adapte a leur maximum (voir
+`dtypes`), et les variables explicatives sont renvoyees en une seule matrice
+contigue.
+"""
+
+
+import numpy as np
+import pandas as pd
+from dtypes import (count_dtype, sum_dtype, values_max, narrow,
+                    feature_dtype)
+
+
+
+# nombre de lignes de la matrice des variables explicatives remplies a la
+# fois (borne la memoire des tableaux intermediaires)
+FEATURES_CHUNK = 1 << 18
+
+
+class CountCube:
+    """Nombre de signalements par `(mois, lat, long)` au format creux.
+        `indices`: tableau trie des indices non vides (`mois*nb_lat*nb_long
+        + lat*nb_long + long`)
+        `counts`: nombre de signalements pour chaque indice (type entier
+        le plus etroit, voir `dtypes.narrow`)
+        `lyme`: None ou diagnostics de maladies de Lyme pour chaque division
+        (tableau de taille `nb_div_lat*nb_div_long`, voir
+        `make_sglmt_df.lyme_raster`)
+        `dates`: tableau des couples `(annee, mois)` de la periode, ou des
+        triplets `(annee, mois, jour)` de debut de chaque pas de temps plus
+        fin qu'un mois (voir `make_sglmt_df.get_steps_array`)
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `extra`: None ou dictionnaire `{nom: tableau (nb_mois, nb_divisions)}`
+        de variables explicatives supplementaires (voir `feature_store`)
+        `origin`: couple `(lat, long)` de la premiere division du cube dans
+        la carte entiere (pour un cube decoupe, voir `crop`)"""
+
+    def __init__(self, indices, counts, lyme, dates, map_info, extra=None,
+                 origin=(0, 0)):
+        self.indices = indices
+        self.counts = counts
+        self.lyme = lyme
+        self.extra = {} if extra is None else extra
+        self.origin = origin
+        self.dates = dates
+        self.nb_div_long, self.nb_div_lat = map_info
+        self.map_size = self.nb_div_lat*self.nb_div_long
+        self.shape = (len(dates), self.nb_div_lat, self.nb_div_long)
+        # variables explicatives des dates
+        self.date_columns = ['year', 'month', 'day'][:np.shape(dates)[1]]
+
+    @classmethod
+    def from_indices(cls, indices, dates, map_info, lyme=None):
+        """Cree un cube en comptant les signalements par indice.
+            `indices`: indice de chaque signalement (non trie, avec
+            repetitions)
+            `dates`: tableau des couples `(annee, mois)` de la periode
+            `map_info`: couple `(nb_div_long, nb_div_lat)`
+            `lyme`: None ou valeur de Lyme de chaque division"""
+
+        nb_div_long, nb_div_lat = map_info
+        indices = np.asarray(indices, dtype=np.int64)
+
+        # indices hors du cube ignores (seule la plage totale est verifiee :
+        # les signalements hors des bordures sont ecartes par
+        # `sglmt_cache.bin_columns`)
+        mask = (indices >= 0) & (indices < len(dates)*nb_div_lat*nb_div_long)
+        indices = indices[mask]
+
+        uniques, counts = np.unique(indices, return_counts=True)
+
+        return cls(uniques, narrow(counts), lyme, dates, map_info)
+
+    @classmethod
+    def from_counts(cls, indices, counts, dates, map_info, lyme=None):
+        """Cree un cube a partir d'indices uniques deja comptes.
+            `indices`: indices uniques (non necessairement tries)
+            `counts`: nombre de signalements pour chaque indice
+            `dates`: tableau des couples `(annee, mois)` de la periode
+            `map_info`: couple `(nb_div_long, nb_div_lat)`
+            `lyme`: None ou valeur de Lyme de chaque division"""
+
+        nb_div_long, nb_div_lat = map_info
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = np.asarray(counts)
+
+        mask = (indices >= 0) & (indices < len(dates)*nb_div_lat*nb_div_long)
+        order = np.argsort(indices[mask], kind='stable')
+
+        return cls(indices[mask][order], narrow(counts[mask][order]), lyme,
+                   dates, map_info)
+
+    @property
+    def nnz(self):
+        """Nombre de combinaisons de mois et de zone non vides."""
+
+        return len(self.indices)
+
+    def month_bounds(self, i):
+        """Renvoie les bornes `(debut, fin)` des entrees du mois `i` dans les
+        tableaux creux.
+            `i`: indice du mois dans `dates`"""
+
+        return tuple(np.searchsorted(self.indices,
+                                     [i*self.map_size, (i+1)*self.map_size]))
+
+    def month(self, i):
+        """Renvoie le couple `(cells, counts)` (vues, sans copie) des zones non
+        vides du mois `i`, ou `cells = lat*nb_div_long + long`.
+            `i`: indice du mois dans `dates`"""
+
+        start, end = self.month_bounds(i)
+
+        return (self.indices[start:end] - i*self.map_size,
+                self.counts[start:end])
+
+    def month_dense(self, i, dtype=None):
+        """Renvoie le tableau dense `(nb_div_lat, nb_div_long)` du mois `i`.
+            `i`: indice du mois dans `dates`
+            `dtype`: None (type des nombres de signalements) ou type des
+            elements"""
+
+        cells, counts = self.month(i)
+        dense = np.zeros(self.map_size, dtype=dtype or self.counts.dtype)
+        dense[cells] = counts
+
+        return dense.reshape(self.nb_div_lat, self.nb_div_long)
+
+    def to_dense(self, dtype=None, values=None):
+        """Renvoie le tableau dense `(nb_mois, nb_div_lat, nb_div_long)`.
+            `dtype`: None (type des valeurs) ou type des elements
+            `values`: None (nombre de signalements) ou tableau de valeurs a
+            placer a chaque indice"""
+
+        values = self.counts if values is None else np.asarray(values)
+        dense = np.zeros(self.shape[0]*self.map_size,
+                         dtype=dtype or values.dtype)
+        dense[self.indices] = values
+
+        return dense.reshape(self.shape)
+
+    def slice_months(self, start, end):
+        """Renvoie le cube restreint aux mois `start` (inclus) a `end`
+        (exclu), sans copier les tableaux creux.
+            `start` & `end`: indices de mois dans `dates`"""
+
+        first, _ = self.month_bounds(start)
+        last, _ = self.month_bounds(end)
+        offset = start*self.map_size
+
+        return CountCube(self.indices[first:last] - offset,
+                         self.counts[first:last], self.lyme,
+                         self.dates[start:end],
+                         (self.nb_div_long, self.nb_div_lat),
+                         {name: values[start:end]
+                          for name, values in self.extra.items()},
+                         self.origin)
+
+    def crop(self, lat_range, long_range):
+        """Renvoie le cube restreint a un rectangle de divisions (les
+        variables `lat` et `long` restent celles de la carte entiere).
+            `lat_range`: couple `(debut, fin)` des divisions en latitude
+            `long_range`: couple `(debut, fin)` des divisions en longitude"""
+
+        (lat_min, lat_max), (long_min, long_max) = lat_range, long_range
+        width, height = long_max - long_min, lat_max - lat_min
+
+        months, cells = np.divmod(self.indices, self.map_size)
+        lat, long = np.divmod(cells, self.nb_div_long)
+        keep = ((lat >= lat_min) & (lat < lat_max)
+                & (long >= long_min) & (long < long_max))
+        indices = (months[keep]*height*width + (lat[keep] - lat_min)*width
+                   + long[keep] - long_min)
+
+        def crop_cells(values, nb_months=None):
+            shape = (self.nb_div_lat, self.nb_div_long)
+            if nb_months is not None:
+                shape = (nb_months,) + shape
+            values = np.asarray(values).reshape(shape)
+            return np.ascontiguousarray(values[..., lat_min:lat_max,
+                                               long_min:long_max])
+
+        lyme = None if self.lyme is None else crop_cells(self.lyme).ravel()
+        extra = {name: crop_cells(values, len(self.dates))
+                 .reshape(len(self.dates), -1)
+                 for name, values in self.extra.items()}
+
+        return CountCube(indices, self.counts[keep], lyme, self.dates,
+                         (width, height), extra,
+                         (self.origin[0] + lat_min, self.origin[1] + long_min))
+
+    def sample_empty(self, size, rng):
+        """Renvoie les indices (tries) de `size` combinaisons de mois et de
+        zone vides tirees sans remise, sans construire le tableau dense.
+            `size`: nombre d'indices a tirer
+            `rng`: generateur `numpy.random.Generator`"""
+
+        nb_empty = self.shape[0]*self.map_size - self.nnz
+        ranks = np.sort(rng.choice(nb_empty, size=size, replace=False))
+
+        # le rang r parmi les cases vides correspond a l'indice r + (nombre de
+        # cases non vides avant lui)
+        shifts = self.indices - np.arange(self.nnz)
+
+        return ranks + np.searchsorted(shifts, ranks, side='right')
+
+    @property
+    def feature_names(self):
+        """Noms des colonnes de la matrice des variables explicatives (voir
+        `features`)."""
+
+        return self.date_columns + ['lat', 'long', 'lyme'] + list(self.extra)
+
+    def features_dtype(self):
+        """Renvoie le type de la matrice des variables explicatives :
+        `float32` (type utilise par les arbres de `sklearn`) si les dates,
+        les divisions et les valeurs de Lyme y sont exactes, `float64`
+        sinon (voir `dtypes.feature_dtype`)."""
+
+        bound = max(values_max(self.dates),
+                    self.origin[0] + self.nb_div_lat,
+                    self.origin[1] + self.nb_div_long,
+                    0 if self.lyme is None else values_max(self.lyme))
+
+        extra_dtypes = [values.dtype for values in self.extra.values()]
+
+        return np.result_type(feature_dtype(bound), *extra_dtypes)
+
+    def features(self, indices):
+        """Renvoie la matrice `(nb_indices, nb_variables)` contigue (ordre C)
+        des variables explicatives (colonnes `feature_names` : `year`,
+        `month`, `day` pour un pas de temps plus fin qu'un mois, `lat`,
+        `long`, `lyme` puis les variables de `extra`) pour des indices
+        donnes, remplie par blocs de `FEATURES_CHUNK` lignes (sans copie de
+        toute la matrice).
+            `indices`: tableau d'indices de combinaisons de mois et de zone"""
+
+        nb_dates = len(self.date_columns)
+        X = np.empty((len(indices), len(self.feature_names)),
+                     dtype=self.features_dtype())
+
+        for start in range(0, len(indices), FEATURES_CHUNK):
+            block = X[start:start+FEATURES_CHUNK]
+            months, cells = np.divmod(indices[start:start+FEATURES_CHUNK],
+                                      self.map_size)
+            lat, long = np.divmod(cells, self.nb_div_long)
+
+            block[:, :nb_dates] = self.dates[months]
+            block[:, nb_dates] = lat + self.origin[0]
+            block[:, nb_dates+1] = long + self.origin[1]
+            block[:, nb_dates+2] = 0 if self.lyme is None else self.lyme[cells]
+            for j, values in enumerate(self.extra.values(), start=nb_dates+3):
+                block[:, j] = values[months, cells]
+
+        return X
+
+    def values_at(self, indices, values=None):
+        """Renvoie le nombre de signalements (ou une autre valeur creuse) pour
+        des indices donnes, `0` pour les combinaisons vides.
+            `indices`: tableau d'indices de combinaisons de mois et de zone
+            `values`: None (nombre de signalements) ou tableau de valeurs
+            associe a `self.indices`"""
+
+        values = self.counts if values is None else values
+        result = np.zeros(len(indices), dtype=values.dtype)
+        if self.nnz == 0:
+            return result
+
+        pos = np.minimum(np.searchsorted(self.indices, indices), self.nnz-1)
+        found = self.indices[pos] == indices
+        result[found] = values[pos[found]]
+
+        return result
+
+    def coarsen(self, map_info, lyme=None):
+        """Renvoie un nouveau cube sur une grille plus grossiere, en sommant
+        les signalements par blocs de divisions (les variables de `extra` ne
+        sont pas conservees).
+            `map_info`: couple `(nb_div_long, nb_div_lat)` de la nouvelle
+            grille, diviseurs de ceux du cube
+            `lyme`: None ou diagnostics de maladies de Lyme de chaque division
+            de la nouvelle grille (voir `make_sglmt_df.lyme_raster`, les
+            valeurs de la grille fine ne s'en deduisent pas)"""
+
+        nb_div_long, nb_div_lat = map_info
+        if self.nb_div_long % nb_div_long or self.nb_div_lat % nb_div_lat:
+            raise ValueError(f'La grille {nb_div_long}x{nb_div_lat} ne divise'
+                             f' pas la grille {self.nb_div_long}x'
+                             f'{self.nb_div_lat}')
+        factor_long = self.nb_div_long // nb_div_long
+        factor_lat = self.nb_div_lat // nb_div_lat
+
+        # indices dans la nouvelle grille
+        months, cells = np.divmod(self.indices, self.map_size)
+        lat, long = np.divmod(cells, self.nb_div_long)
+        indices = (months*nb_div_lat*nb_div_long
+                   + (lat//factor_lat)*nb_div_long + long//factor_long)
+
+        # somme par bloc
+        order = np.argsort(indices, kind='stable')
+        indices = indices[order]
+        starts = np.flatnonzero(np.diff(indices, prepend=-1))
+        # sommes dans un type assez large pour tout un bloc, puis ramenees
+        # au type le plus etroit
+        counts = self.counts[order].astype(
+            sum_dtype(values_max(self.counts), factor_long*factor_lat))
+        counts = narrow(np.add.reduceat(counts, starts)) \
+            if len(indices) else self.counts[:0]
+
+        return CountCube(indices[starts], counts, lyme, self.dates, map_info)
+
+    def to_dataframe(self):
+        """Renvoie la `pandas.DataFrame` avec chaque combinaison de date et de
+        zone (colonnes `year`, `month`, `lat`, `long`, `nb_sglmt`, `lyme`
+        puis les variables de `extra`), chaque colonne entiere dans le type le
+        plus etroit adapte a son maximum."""
+
+        nb_dates = len(self.dates)
+        size = nb_dates*self.map_size
+
+        df = pd.DataFrame()
+        dates = self.dates.astype(count_dtype(values_max(self.dates)))
+        df[self.date_columns] = np.repeat(dates, self.map_size, axis=0)
+        lat_origin, long_origin = self.origin
+        lat_dtype = count_dtype(lat_origin + self.nb_div_lat)
+        long_dtype = count_dtype(long_origin + self.nb_div_long)
+        df['lat'] = np.tile(np.repeat(np.arange(lat_origin,
+                                                lat_origin + self.nb_div_lat,
+                                                dtype=lat_dtype),
+                                      self.nb_div_long), nb_dates)
+        df['long'] = np.tile(np.arange(long_origin,
+                                       long_origin + self.nb_div_long,
+                                       dtype=long_dtype),
+                             nb_dates*self.nb_div_lat)
+        df['nb_sglmt'] = self.to_dense().reshape(size)
+        if self.lyme is None:
+            df['lyme'] = np.zeros(size, dtype=np.uint8)
+        else:
+            df['lyme'] = np.tile(narrow(self.lyme), nb_dates)
+        for name, values in self.extra.items():
+            df[name] = np.asarray(values).reshape(size)
+
+        return df
@@ -7,7 +7,10 @@ deux ensembles de signalements sur une ou plusieurs periodes.
 
 import numpy as np
 from math import sqrt, ceil
+from functools import lru_cache
 from PIL import Image, ImagePalette, ImageDraw, ImageFont
+from profiling import stage, bind
+from dtypes import sum_dtype, values_max, widen, add_counts, narrow
 
 
 
@@ -35,6 +38,19 @@ def get_color_palette():
 # palette de couleurs restreinte aux couleurs utiles
 palette = get_color_palette()
 
+# organisation spatiale des images (en divisions) : petite et grande
+# bordures, hauteur des legendes et des titres
+SML_BRD, LRG_BRD = 2, 6
+LGND_HEIGHT, TITLE_HEIGHT = 16, 28
+
+
+@lru_cache(maxsize=None)
+def get_font(size):
+    """Renvoie la police des legendes (chargee une seule fois par taille).
+        `size`: taille de la police"""
+
+    return ImageFont.truetype('cmunrm.ttf', size)
+
 
 def get_square_like_grid(n):
     """Renvoie un couple `(height, width)` pour une disposition homogene de
@@ -66,89 +82,162 @@ def split_sglmt_sets(sglmts_li, nb_div_long, nb_div_lat, dates, period):
 
     # cas du reste non nul
     if remainder > 0:
-        remainder_ar = np.zeros((period-remainder)*nb_div_long*nb_div_lat,
-                                dtype=np.ushort)
+        remainder_size = (period-remainder)*nb_div_long*nb_div_lat
         for i in range(len(sglmts_li)):
-            sglmts_li[i] = np.concatenate((sglmts_li[i], remainder_ar))
+            sglmts_li[i] = np.concatenate(
+                (sglmts_li[i], np.zeros(remainder_size,
+                                        dtype=sglmts_li[i].dtype)))
 
-    # decoupage des tableaux
+    # decoupage des tableaux (sommes dans un type assez large pour toute
+    # une periode)
     for i in range(len(sglmts_li)):
         sglmts_split = np.hsplit(sglmts_li[i], len(dates))
-        sglmts_li[i] = [np.sum(np.hsplit(sglmts, period), axis=0,
-                               dtype=np.ushort)
+        dtype = sum_dtype(values_max(sglmts_li[i]), period)
+        sglmts_li[i] = [np.sum(np.hsplit(sglmts, period), axis=0, dtype=dtype)
                         for sglmts in sglmts_split]
 
     return sglmts_li, dates
 
 
-def make_single_map(nb_sglmts, nb_div_long, nb_div_lat, max_val):
-    """Cree une image (carte de la France) et y place un ensemble de
-    signalements.
-        `nb_sglmts`: tableau de taille `nb_div_long*nb_div_lat` avec nb de
-        signalements par division
-        `nb_div_long`: nombre de couches horizontales de la carte
-        `nb_div_lat`: nombre de couches verticales de la carte
-        `max_val`: nombre maximal de signalements en un point"""
-
-    # calcul des couleurs associees
-    pixels = (nb_sglmts*100/max_val).astype(dtype=np.ubyte)
-    pixels = pixels.reshape(nb_div_lat, nb_div_long)
+def date_label(date):
+    """Renvoie le texte d'une date : `mm / 20aa` pour un mois, `jj/mm/aa`
+    pour le debut d'un pas de temps plus fin.
+        `date`: couple `(annee, mois)` ou triplet `(annee, mois, jour)`"""
 
-    # creation de l'image
-    map = Image.fromarray(obj=pixels[::-1], mode='P')
-    map.putpalette(palette)
+    if len(date) == 3:
+        return f'{date[2]:0>2}/{date[1]:0>2}/{date[0]:0>2}'
 
-    return map
+    return f'{date[1]:0>2} / 20{date[0]}'
 
 
 def get_legends_li(dates, period):
-    """Renvoie la liste des legendes (mois sur lesquels on predit) pour
-    l'image finale.
+    """Renvoie la liste des legendes (mois ou jours sur lesquels on predit)
+    pour l'image finale.
         `dates`: liste de couples `(debut, fin)` sur chaque periode etudiee
-        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
-        les signalements"""
+        `period`: periode de temps (nombre de pas de temps) sur laquelle on
+        rassemble les signalements"""
 
     if period == 1:
-        return [f'    {date[1]:0>2} / 20{date[0]}' for (date,_) in dates]
+        return [f'    {date_label(date)}' for (date,_) in dates]
     else:
-        return [f'{start[1]:0>2} / 20{start[0]}   -'
-                +f'   {end[1]:0>2} / 20{end[0]}'
+        return [f'{date_label(start)}   -   {date_label(end)}'
                 for (start, end) in dates]
 
 
-def get_all_maps(sglmts1, sglmts2, map_info, dates, period):
-    """Renvoie des listes des cartes a placer, le decoupage de l'image en
-    cartes et la liste des dates associee.
-        `sglmts1` & `sglmts2`: tableaux avec le nombre de signalements par
-        date et par division
-        `map_info`: triplet `(nb_div_long, nb_div_lat)` sur la construction
-        des cartes 
-        `dates`: liste de couples `(annee, mois)`
-        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
-        les signalements"""
+def get_tiles(sglmts, nb_div_long, nb_div_lat, max_val, nb_tiles):
+    """Renvoie le tableau `(nb_tiles, hauteur, largeur)` des indices de
+    couleurs des cases de la mosaique : carte, rectangle de legende et
+    bordures (les cases sans periode sont vides).
+        `sglmts`: liste des tableaux avec le nombre de signalements par
+        division pour chaque periode
+        `nb_div_long`: nombre de couches horizontales de la carte
+        `nb_div_lat`: nombre de couches verticales de la carte
+        `max_val`: nombre maximal de signalements en un point
+        `nb_tiles`: nombre de cases de la grille"""
+
+    nb_prds = len(sglmts)
+    tile_height = nb_div_lat + LGND_HEIGHT + SML_BRD
+    tile_width = nb_div_long + SML_BRD
+
+    tiles = np.full((nb_tiles, tile_height, tile_width), 101, dtype=np.ubyte)
+    # cartes (nord en haut) et rectangles des legendes
+    pixels = (widen(sglmts, 100*int(max_val))*100/max_val).astype(
+        dtype=np.ubyte)
+    pixels = pixels.reshape(nb_prds, nb_div_lat, nb_div_long)
+    tiles[:nb_prds, :nb_div_lat, :nb_div_long] = pixels[:, ::-1]
+    tiles[:nb_prds, nb_div_lat:nb_div_lat+LGND_HEIGHT, :nb_div_long] = 50
+
+    return tiles
+
+
+def get_panel(tiles, grid_height, grid_width):
+    """Assemble les cases en un panneau (les cases sont placees colonne par
+    colonne) et renvoie le tableau des indices de couleurs.
+        `tiles`: tableau `(grid_height*grid_width, hauteur, largeur)` des
+        cases
+        `grid_height` & `grid_width`: dimensions de la grille"""
+
+    _, tile_height, tile_width = tiles.shape
+    panel = (tiles.reshape(grid_width, grid_height, tile_height, tile_width)
+             .transpose(1, 2, 0, 3)
+             .reshape(grid_height*tile_height, grid_width*tile_width))
+
+    # pas de bordure apres la derniere ligne ni la derniere colonne
+    return panel[:-SML_BRD, :-SML_BRD]
+
+
+def get_mosaic(sglmts1, sglmts2, map_info, max_val=None):
+    """Renvoie le tableau des indices de couleurs de l'image (reduite)
+    comparant les deux ensembles de cartes, et le decoupage en grille.
+        `sglmts1` & `sglmts2`: listes des tableaux avec le nombre de
+        signalements par division pour chaque periode
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `max_val`: None (maximum des deux ensembles) ou nombre de
+        signalements associe a la couleur la plus foncee"""
 
     nb_div_long, nb_div_lat = map_info
 
-    # decoupage des dates et des tableaux
-    sglmts, dates = split_sglmt_sets(
-        [sglmts1, sglmts2], nb_div_long, nb_div_lat, dates, period)
-    sglmts1, sglmts2 = sglmts[0], sglmts[1]
-
     # repartition des cartes en grille
-    grid_height, grid_width = get_square_like_grid(len(dates))
+    grid_height, grid_width = get_square_like_grid(len(sglmts1))
     # valeur maximale au total
-    max_val = np.amax(sglmts)
-    # creation et ajout des sous-cartes aux listes
-    map_li1, map_li2 = [], []
-    for grid_x in range(grid_width):
-        for grid_y in range(min(grid_height, len(dates)-grid_x*grid_height)):
-            i = grid_x*grid_height + grid_y
-            map_li1 += [make_single_map(sglmts1[i],
-                                        nb_div_long, nb_div_lat, max_val)]
-            map_li2 += [make_single_map(sglmts2[i],
-                                        nb_div_long, nb_div_lat, max_val)]
+    if max_val is None:
+        max_val = max(np.amax(sglmts1), np.amax(sglmts2), 1)
+
+    panels = [get_panel(get_tiles(sglmts, nb_div_long, nb_div_lat, max_val,
+                                  grid_height*grid_width),
+                        grid_height, grid_width)
+              for sglmts in (sglmts1, sglmts2)]
+    panel_height, panel_width = panels[0].shape
 
-    return [map_li1, map_li2], (grid_height, grid_width), dates
+    mosaic = np.full((panel_height + TITLE_HEIGHT, 2*panel_width + LRG_BRD),
+                     101, dtype=np.ubyte)
+    mosaic[:panel_height, :panel_width] = panels[0]
+    mosaic[:panel_height, panel_width+LRG_BRD:] = panels[1]
+
+    return mosaic, (grid_height, grid_width)
+
+
+def upscale(pixels, div_size):
+    """Agrandit un tableau d'indices de couleurs (chaque pixel devient un
+    carre de `div_size` pixels de cote).
+        `pixels`: tableau a deux dimensions
+        `div_size`: facteur d'agrandissement"""
+
+    height, width = pixels.shape
+    pixels = np.broadcast_to(pixels[:, None, :, None],
+                             (height, div_size, width, div_size))
+
+    return pixels.reshape(height*div_size, width*div_size)
+
+
+def iter_periods(months, period):
+    """Rassemble au fur et a mesure des signalements mensuels par periode et
+    renvoie (generateur) pour chaque periode le couple `((debut, fin),
+    sglmts_li)` ou `sglmts_li` contient les sommes sur la periode.
+        `months`: iterable de couples `(date, sglmts_li)` avec pour chaque
+        mois la liste des tableaux de signalements par division
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements"""
+
+    start, sums, count = None, None, 0
+    for date, sglmts_li in months:
+        if count == 0:
+            start = date
+            # copies (modifiees en place) dans le type le plus etroit
+            sums = [narrow(np.array(sglmts)) for sglmts in sglmts_li]
+        else:
+            # type elargi avant tout depassement
+            sums = [add_counts(sums_i, sglmts)
+                    for sums_i, sglmts in zip(sums, sglmts_li)]
+        count += 1
+        if count == period:
+            yield (start, date), sums
+            count = 0
+
+    # periode incomplete en fin de liste
+    if count > 0:
+        yield (start, date), sums
 
 
 def comparative_total(sglmts1, sglmts2, map_info, dates, period, export_info):
@@ -164,49 +253,110 @@ def comparative_total(sglmts1, sglmts2, map_info, dates, period, export_info):
         `export_info`: couple `(export_path, file_name)` sur le fichier a
         creer"""
 
-    nb_div_long, nb_div_lat, div_size = map_info
+    nb_div_long, nb_div_lat, _ = map_info
+
+    # decoupage des dates et des tableaux
+    sglmts, dates = split_sglmt_sets(
+        [sglmts1, sglmts2], nb_div_long, nb_div_lat, dates, period)
+
+    comparative_periods(sglmts[0], sglmts[1], map_info, dates, period,
+                        export_info)
+
+
+def comparative_stream(months, map_info, period, export_info):
+    """Comparaison de deux ensembles de cartes construits au fur et a mesure
+    que les signalements de chaque mois sont produits (seules les sommes par
+    periode sont conservees).
+        `months`: iterable de triplets `(date, sglmts1, sglmts2)` avec pour
+        chaque mois les tableaux de signalements par division
+        `map_info`: triplet `(nb_div_long, nb_div_lat, div_size)` sur la
+        construction des cartes
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `export_info`: couple `(export_path, file_name)` sur le fichier a
+        creer"""
+
+    sglmts1, sglmts2, dates = [], [], []
+    months = ((date, (sglmts1, sglmts2)) for date, sglmts1, sglmts2 in months)
+    for dates_prd, (sglmts1_prd, sglmts2_prd) in iter_periods(months, period):
+        dates.append(dates_prd)
+        sglmts1.append(sglmts1_prd)
+        sglmts2.append(sglmts2_prd)
+
+    comparative_periods(sglmts1, sglmts2, map_info, dates, period,
+                        export_info)
+
+
+def comparative_periods(sglmts1, sglmts2, map_info, dates, period,
+                        export_info):
+    """Comparaison de deux ensembles de cartes a partir des signalements deja
+    rassembles par periode.
+        `sglmts1` & `sglmts2`: listes des tableaux avec le nombre de
+        signalements par division pour chaque periode
+        `map_info`: triplet `(nb_div_long, nb_div_lat, div_size)` sur la
+        construction des cartes
+        `dates`: liste de couples `(debut, fin)` sur chaque periode
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `export_info`: couple `(export_path, file_name)` sur le fichier a
+        creer"""
+
     export_path, file_name = export_info
 
-    # cartes, grille et dates
-    [map_li1, map_li2], (grid_height, grid_width), dates = get_all_maps(
-        sglmts1, sglmts2, map_info[:-1], dates, period)
-    nb_prds = len(dates)
+    map = render_comparative(sglmts1, sglmts2, map_info, dates, period)
+    # sauvegarde de la carte
+    with stage('encodage', pixels=map.size[0]*map.size[1]):
+        map.save(export_path + file_name + '.png')
 
-    # organisation spatiale : bordures, cartes, legendes, titres, decalage
-    sml_brd, lrg_brd = 2, 6
-    map_width, map_height = nb_div_long+sml_brd, nb_div_lat+sml_brd
-    lgnd_height, title_height = 16, 28
-    width = 2*(grid_width*map_width-sml_brd) + lrg_brd
-    height = grid_height*(map_height+lgnd_height) - sml_brd + title_height
-    x_shift = grid_width*map_width - sml_brd + lrg_brd
 
-    # carte (reduite)
-    reduced_map = Image.new(mode='P', size=(width, height), color=101)
-    reduced_map.putpalette(palette)
+def render_comparative(sglmts1, sglmts2, map_info, dates, period,
+                       max_val=None):
+    """Renvoie l'image comparant deux ensembles de cartes a partir des
+    signalements deja rassembles par periode.
+        `sglmts1` & `sglmts2`: listes des tableaux avec le nombre de
+        signalements par division pour chaque periode
+        `map_info`: triplet `(nb_div_long, nb_div_lat, div_size)` sur la
+        construction des cartes
+        `dates`: liste de couples `(debut, fin)` sur chaque periode
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `max_val`: None (maximum des deux ensembles) ou nombre de
+        signalements associe a la couleur la plus foncee"""
 
-    for grid_x in range(grid_width):
-        for grid_y in range(min(grid_height, nb_prds-grid_x*grid_height)):
-            i = grid_x*grid_height + grid_y
-            x_map, y_map = grid_x*map_width, grid_y*(map_height+lgnd_height)
-            # ajout des sous-cartes
-            reduced_map.paste(map_li1[i], (x_map,y_map))
-            reduced_map.paste(map_li2[i], (x_map+x_shift,y_map))
-            # rectangles pour la legende
-            lgnds_red = ImageDraw.Draw(reduced_map)
-            y_lgnd1 = y_map+nb_div_lat
-            x_lgnd2, y_lgnd2 = x_map+nb_div_long-1, y_lgnd1+lgnd_height-1
-            coord1 = (x_map, y_lgnd1, x_lgnd2, y_lgnd2)
-            coord2 = (x_map+x_shift, y_lgnd1, x_lgnd2+x_shift, y_lgnd2)
-            lgnds_red.rectangle(coord1, fill=50)
-            lgnds_red.rectangle(coord2, fill=50)
+    with stage('rendu', periodes=len(dates)) as counts:
+        map = render_mosaic(sglmts1, sglmts2, map_info, dates, period,
+                            max_val)
+        counts['pixels'] = map.size[0]*map.size[1]
+
+    return map
+
+
+def render_mosaic(sglmts1, sglmts2, map_info, dates, period, max_val):
+    """Cree l'image comparative (voir `render_comparative`).
+        `sglmts1` & `sglmts2`: listes des tableaux de signalements par periode
+        `map_info`: triplet sur la construction des cartes
+        `dates`: liste de couples `(debut, fin)` sur chaque periode
+        `period`: periode de temps sur laquelle on rassemble les signalements
+        `max_val`: None ou nombre de signalements associe a la couleur la plus
+        foncee"""
+
+    nb_div_long, nb_div_lat, div_size = map_info
+
+    # image (reduite) et grille
+    mosaic, (grid_height, grid_width) = get_mosaic(sglmts1, sglmts2,
+                                                   map_info[:-1], max_val)
+    nb_prds = len(dates)
+
+    # organisation spatiale : bordures, cartes, legendes, decalage
+    map_width, map_height = nb_div_long+SML_BRD, nb_div_lat+SML_BRD
+    x_shift = grid_width*map_width - SML_BRD + LRG_BRD
 
     # carte finale
-    full_width = width*div_size
-    full_height = height*div_size
+    map = Image.fromarray(upscale(mosaic, div_size), mode='P')
+    map.putpalette(palette)
+    full_width, _ = map.size
     full_x_shift = x_shift*div_size
-    map = reduced_map.resize((full_width, full_height),
-                             resample=Image.NEAREST)
-    font = ImageFont.truetype('cmunrm.ttf', 10*div_size)
+    font = get_font(10*div_size)
 
     # legendes des cartes
     lgnds = ImageDraw.Draw(map)
@@ -215,7 +365,7 @@ def comparative_total(sglmts1, sglmts2, map_info, dates, period, export_info):
         for grid_y in range(min(grid_height, nb_prds-grid_x*grid_height)):
             i = grid_x*grid_height + grid_y
             x_lgnd1 = (grid_x*map_width+map_width//6)*div_size
-            y_lgnd1 = (grid_y*(map_height+lgnd_height)+nb_div_lat+2)*div_size
+            y_lgnd1 = (grid_y*(map_height+LGND_HEIGHT)+nb_div_lat+2)*div_size
             coord1 = (x_lgnd1, y_lgnd1)
             coord2 = (x_lgnd1+full_x_shift, y_lgnd1)
             lgnds.text(coord1, legends_li[i], fill=0, font=font)
@@ -223,13 +373,107 @@ def comparative_total(sglmts1, sglmts2, map_info, dates, period, export_info):
 
     # titres 
     x_ttl1 = full_width//6+10*div_size
-    y_ttl1 = (grid_height*(map_height+lgnd_height)-sml_brd+4)*div_size
+    y_ttl1 = (grid_height*(map_height+LGND_HEIGHT)-SML_BRD+4)*div_size
     coord1, coord2 = (x_ttl1, y_ttl1), (x_ttl1+full_x_shift, y_ttl1)
-    font_titles = ImageFont.truetype('cmunrm.ttf', 16*div_size)
+    font_titles = get_font(16*div_size)
     lgnds.text(coord1, 'REÇUS', fill=0, font=font_titles)
     lgnds.text(coord2, 'PRÉDITS', fill=0, font=font_titles)
-    # sauvegarde de la carte
-    map.save(export_path + file_name + '.png')
+
+    return map
+
+
+def save_period_image(sglmts1, sglmts2, map_info, dates, period, path,
+                      max_val=None):
+    """Cree et sauvegarde l'image comparative d'une seule periode.
+        `sglmts1` & `sglmts2`: tableaux avec le nombre de signalements par
+        division sur la periode
+        `map_info`: triplet sur la construction des cartes
+        `dates`: couple `(debut, fin)` sur la periode
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `path`: chemin du fichier `.png` a creer
+        `max_val`: None (maximum de la periode) ou nombre de signalements
+        associe a la couleur la plus foncee"""
+
+    map = render_comparative([sglmts1], [sglmts2], map_info, [dates], period,
+                             max_val)
+    with stage('encodage', pixels=map.size[0]*map.size[1]):
+        map.save(path)
+
+
+def save_animation(sglmts1, sglmts2, map_info, dates, period, path,
+                   duration=500):
+    """Cree et sauvegarde une image animee (`.gif` ou `.png` anime selon
+    l'extension de `path`) avec une image comparative par periode, toutes sur
+    la meme echelle de couleurs.
+        `sglmts1` & `sglmts2`: listes des tableaux avec le nombre de
+        signalements par division pour chaque periode
+        `map_info`: triplet sur la construction des cartes
+        `dates`: liste de couples `(debut, fin)` sur chaque periode
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `path`: chemin du fichier a creer
+        `duration`: duree d'affichage de chaque image (en ms)"""
+
+    max_val = max(np.amax(sglmts1), np.amax(sglmts2), 1)
+    frames = [render_comparative([sglmts1_prd], [sglmts2_prd], map_info,
+                                 [dates_prd], period, max_val)
+              for sglmts1_prd, sglmts2_prd, dates_prd
+              in zip(sglmts1, sglmts2, dates)]
+    with stage('encodage_animation', images=len(frames)):
+        frames[0].save(path, save_all=True, append_images=frames[1:],
+                       duration=duration, loop=0)
+
+
+def comparative_pipeline(months, map_info, period, export_info, executor,
+                         period_images=False, animation=None):
+    """Comparaison de deux ensembles de cartes ou les images sont creees et
+    encodees par `executor` : une image par periode des qu'elle est complete
+    (option, pendant que les mois suivants sont produits), puis l'image de
+    toutes les periodes et une image animee (option). Ces deux dernieres
+    utilisent l'echelle de couleurs de toutes les periodes (maximum global) :
+    elles ne peuvent etre creees qu'une fois le dernier mois produit, et
+    seule leur creation simultanee est parallelisee.
+        `months`: iterable de triplets `(date, sglmts1, sglmts2)` avec pour
+        chaque mois les tableaux de signalements par division
+        `map_info`: triplet `(nb_div_long, nb_div_lat, div_size)` sur la
+        construction des cartes
+        `period`: periode de temps (nombre de mois) sur laquelle on rassemble
+        les signalements
+        `export_info`: couple `(export_path, file_name)` sur les fichiers a
+        creer
+        `executor`: `concurrent.futures.Executor` qui cree les images
+        `period_images`: bool sur la creation d'une image par periode
+        (`file_name_<numero>.png`, echelle de couleurs propre a la periode)
+        `animation`: None, `'gif'` ou `'apng'` pour une image animee
+        (`file_name.gif` ou `file_name_anim.png`)"""
+
+    export_path, file_name = export_info
+
+    sglmts1, sglmts2, dates, futures = [], [], [], []
+    months = ((date, (sglmts1, sglmts2)) for date, sglmts1, sglmts2 in months)
+    for dates_prd, (sglmts1_prd, sglmts2_prd) in iter_periods(months, period):
+        if period_images:
+            path = f'{export_path}{file_name}_{len(dates):0>3}.png'
+            futures.append(executor.submit(
+                bind(save_period_image), sglmts1_prd, sglmts2_prd, map_info,
+                dates_prd, period, path))
+        dates.append(dates_prd)
+        sglmts1.append(sglmts1_prd)
+        sglmts2.append(sglmts2_prd)
+
+    futures.append(executor.submit(bind(comparative_periods), sglmts1,
+                                   sglmts2, map_info, dates, period,
+                                   export_info))
+    if animation is not None:
+        path = export_path + file_name + ('.gif' if animation == 'gif'
+                                          else '_anim.png')
+        futures.append(executor.submit(bind(save_animation), sglmts1,
+                                       sglmts2, map_info, dates, period,
+                                       path))
+
+    for future in futures:
+        future.result()
 
 
 
@@ -0,0 +1,118 @@
+"""Types des tableaux.
+
+Ce module sert a choisir le type entier non signe le plus etroit capable de
+contenir des nombres de signalements (ou des coordonnees de la grille) a
+partir de leur maximum, et a passer a un type plus large avant tout
+depassement quand ces nombres sont sommes (periodes, blocs de divisions,
+couleurs des cartes) ou predits. Il choisit aussi le type des matrices de
+variables explicatives (`float32`, comme les arbres de `sklearn`, tant que
+les valeurs entieres y sont exactes).
+"""
+
+
+import numpy as np
+
+
+
+# types entiers non signes, du plus etroit au plus large
+UNSIGNED = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+# plus grand entier tel que tous les entiers positifs inferieurs sont exacts
+# en `float32`
+FLOAT32_EXACT = 2**24
+
+
+def count_dtype(max_value):
+    """Renvoie le type entier non signe le plus etroit contenant les valeurs
+    de `0` a `max_value`.
+        `max_value`: valeur maximale a contenir"""
+
+    for dtype in UNSIGNED:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    raise OverflowError(f'Valeur trop grande : {max_value}')
+
+
+def sum_dtype(max_value, nb_terms):
+    """Renvoie le type entier le plus etroit contenant la somme de
+    `nb_terms` valeurs entre `0` et `max_value`.
+        `max_value`: valeur maximale de chaque terme
+        `nb_terms`: nombre de termes sommes"""
+
+    return count_dtype(int(max_value)*int(nb_terms))
+
+
+def values_max(values):
+    """Renvoie le maximum (entier Python, `0` pour un tableau vide) de
+    valeurs entieres positives.
+        `values`: tableau de valeurs"""
+
+    return int(np.max(values, initial=0))
+
+
+def narrow(values):
+    """Renvoie les valeurs entieres positives `values` dans le type le plus
+    etroit adapte a leur maximum (sans copie si c'est deja le cas).
+        `values`: tableau de valeurs entieres positives"""
+
+    values = np.asarray(values)
+
+    return values.astype(count_dtype(values_max(values)), copy=False)
+
+
+def widen(values, max_value):
+    """Renvoie `values` dans un type pouvant contenir `max_value` (sans copie
+    si son type convient deja, valeurs flottantes inchangees).
+        `values`: tableau de valeurs entieres positives ou flottantes
+        `max_value`: valeur maximale que le tableau doit pouvoir contenir"""
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return values
+
+    return values.astype(np.promote_types(values.dtype,
+                                          count_dtype(max_value)),
+                         copy=False)
+
+
+def add_counts(total, values):
+    """Ajoute `values` a `total` (en place si son type suffit, sinon dans une
+    copie d'un type plus large) et renvoie le resultat.
+        `total`: tableau des sommes, modifie en place
+        `values`: tableau des valeurs a ajouter"""
+
+    total = widen(total, values_max(total) + values_max(values))
+    np.add(total, values, out=total, casting='unsafe')
+
+    return total
+
+
+def set_row(values, i, row):
+    """Ecrit `row` dans `values[i]` (en place si son type suffit, sinon dans
+    une copie d'un type plus large) et renvoie le tableau.
+        `values`: tableau, modifie en place
+        `i`: indice (ou tranche) des valeurs a ecrire
+        `row`: tableau des valeurs entieres positives a ecrire"""
+
+    values = widen(values, values_max(row))
+    values[i] = row
+
+    return values
+
+
+def round_counts(values):
+    """Renvoie des predictions arrondies en nombres de signalements positifs,
+    dans le type le plus etroit adapte a leur maximum (sans saturation).
+        `values`: tableau de predictions (flottantes ou entieres)"""
+
+    return narrow(np.maximum(np.rint(values), 0))
+
+
+def feature_dtype(max_value):
+    """Renvoie le type des matrices de variables explicatives : `float32` si
+    les valeurs entieres jusqu'a `max_value` y sont exactes, `float64`
+    sinon.
+        `max_value`: plus grande valeur entiere des variables"""
+
+    return np.dtype(np.float32 if max_value < FLOAT32_EXACT else np.float64)
@@ -0,0 +1,118 @@
+"""Methodes de prediction.
+
+Ce module sert a choisir la methode d'apprentissage utilisee pour predire le
+nombre de signalements (arbre de decision, gradient boosting avec une perte
+de Poisson, foret aleatoire) derriere les memes fonctions d'entrainement, de
+sauvegarde et de chargement. Les methodes `gradient` et `foret` utilisent
+tous les coeurs du processeur. Les arbres et les forets sont aussi
+sauvegardes au format tableau plat (voir `flat_tree`), evalue sans `sklearn`.
+"""
+
+
+import os
+import importlib
+import numpy as np
+from flat_tree import export_tree, load_tree, tree_roots, predict_tree
+
+
+
+# methodes disponibles : module, classe `sklearn` et parametres
+ENGINES = {
+    # un nombre de signalements par classe, un seul coeur
+    'arbre': ('sklearn.tree', 'DecisionTreeClassifier', {}),
+    # regression de Poisson (regularisee : les cases vides sont tres
+    # majoritaires), tous les coeurs
+    'gradient': ('sklearn.ensemble', 'HistGradientBoostingRegressor',
+                 {'loss': 'poisson', 'l2_regularization': 100.0,
+                  'min_samples_leaf': 100}),
+    # moyenne d'arbres de regression entraines en parallele
+    'foret': ('sklearn.ensemble', 'RandomForestRegressor',
+              {'n_estimators': 50, 'min_samples_leaf': 5}),
+}
+
+# parametres ajoutes quand les cases vides sont echantillonnees (lignes
+# ponderees) : un arbre complet a des feuilles pures (variables uniques par
+# ligne) ou les poids ne changent aucune prediction, des feuilles d'un poids
+# minimal leur redonnent leur effet
+SAMPLED_PARAMS = {'arbre': {'min_weight_fraction_leaf': 1e-4}}
+
+# methodes exportees au format tableau plat
+FLAT_ENGINES = ('arbre', 'foret')
+
+
+def make_estimator(engine='arbre', seed=0, nb_jobs=None, sampled=False):
+    """Cree un modele `sklearn` (non entraine) de la methode `engine`.
+        `engine`: nom de la methode (cle de `ENGINES`)
+        `seed`: graine du modele
+        `nb_jobs`: None (tous les coeurs) ou nombre de coeurs utilises par
+        la foret aleatoire
+        `sampled`: bool sur l'entrainement sur un echantillon pondere des
+        cases vides (voir `SAMPLED_PARAMS`)"""
+
+    if engine not in ENGINES:
+        raise ValueError(f'Methode inconnue : {engine} (methodes disponibles '
+                         f': {", ".join(ENGINES)})')
+    module, name, params = ENGINES[engine]
+    estimator = getattr(importlib.import_module(module), name)
+
+    params = {**params, 'random_state': seed}
+    if sampled:
+        params.update(SAMPLED_PARAMS.get(engine, {}))
+    if engine == 'foret':
+        params['n_jobs'] = -1 if nb_jobs is None else nb_jobs
+
+    return estimator(**params)
+
+
+def fit_model(X, y, weights=None, seed=0, engine='arbre', nb_jobs=None):
+    """Cree et entraine un modele.
+        `X`: variables explicatives
+        `y`: nombre de signalements
+        `weights`: None (toutes les cases) ou poids de chaque ligne (cases
+        vides echantillonnees, voir `SAMPLED_PARAMS`)
+        `seed`: graine du modele
+        `engine`: nom de la methode (cle de `ENGINES`)
+        `nb_jobs`: None ou nombre de coeurs (voir `make_estimator`)"""
+
+    model = make_estimator(engine, seed, nb_jobs, weights is not None)
+    if engine != 'arbre':
+        y = np.asarray(y, dtype=np.float64)
+    model.fit(X, y, sample_weight=weights)
+
+    return model
+
+
+def save_model(model, model_file):
+    """Sauvegarde un modele entraine au format `.joblib`, et au format tableau
+    plat (`.npy`) pour les arbres et les forets. Renvoie le chemin du fichier
+    utilise pour les predictions.
+        `model`: modele entraine
+        `model_file`: chemin des fichiers sans extension"""
+
+    import joblib
+    joblib.dump(model, model_file + '.joblib')
+
+    if hasattr(model, 'tree_') or hasattr(model, 'estimators_'):
+        export_tree(model, model_file + '.npy')
+        return model_file + '.npy'
+
+    # un ancien tableau plat du meme nom serait utilise a la place
+    if os.path.exists(model_file + '.npy'):
+        os.remove(model_file + '.npy')
+
+    return model_file + '.joblib'
+
+
+def load_model(model_file):
+    """Charge un modele et renvoie une fonction de prediction. Le format
+    tableau plat (`.npy`) est utilise s'il existe, sinon le modele `.joblib`.
+        `model_file`: chemin des fichiers sans extension"""
+
+    if os.path.exists(model_file + '.npy'):
+        nodes = load_tree(model_file + '.npy')
+        roots = tree_roots(nodes)
+        return lambda X: predict_tree(nodes, X, roots)
+
+    import joblib
+    model = joblib.load(model_file + '.joblib')
+    return model.predict
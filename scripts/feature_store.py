@@ -0,0 +1,122 @@
+"""Variables decalees et de voisinage.
+
+Ce module sert a calculer, pour chaque mois et chaque division, des variables
+explicatives supplementaires tirees des signalements passes : nombre de
+signalements le mois precedent et le meme mois de l'annee precedente, et
+moyennes de ces nombres sur les divisions voisines. Les calculs sont faits
+directement sur les tableaux denses du cube (decalages et sommes cumulees
+separables en latitude puis en longitude) et conserves dans le cache binaire
+pour chaque grille et chaque periode.
+"""
+
+
+import os
+import numpy as np
+from make_sglmt_df import sglmt_cube
+from sglmt_cache import source_dir, key_digest, temp_path
+
+
+
+# decalages (en mois) des nombres de signalements utilises
+LAGS = (1, 12)
+
+# rayon (en divisions) du voisinage des moyennes
+RADIUS = 1
+
+
+def feature_names(lags=LAGS, radius=RADIUS):
+    """Renvoie les noms des variables (colonnes ajoutees aux variables
+    explicatives).
+        `lags`: decalages en mois
+        `radius`: rayon du voisinage (0 pour ne pas calculer de moyennes)"""
+
+    names = [f'decalage{lag}' for lag in lags]
+    if radius > 0:
+        names += [f'voisins{lag}' for lag in lags]
+
+    return names
+
+
+def box_mean(dense, radius):
+    """Renvoie la moyenne de chaque division sur le carre de cote
+    `2*radius+1` centre sur elle (divisions hors de la carte comptees comme
+    vides), calculee par sommes cumulees sur chaque axe.
+        `dense`: tableau `(..., nb_div_lat, nb_div_long)`
+        `radius`: rayon du voisinage (en divisions)"""
+
+    size = 2*radius + 1
+    result = np.asarray(dense, dtype=np.float64)
+    for axis in (-2, -1):
+        padding = [(0, 0)]*result.ndim
+        padding[axis] = (radius+1, radius)
+        sums = np.cumsum(np.pad(result, padding), axis=axis)
+        length = sums.shape[axis]
+        result = (np.take(sums, np.arange(size, length), axis=axis)
+                  - np.take(sums, np.arange(0, length-size), axis=axis))
+
+    return (result / size**2).astype(np.float32)
+
+
+def compute_features(history, nb_months, lags=LAGS, radius=RADIUS):
+    """Renvoie le tableau `(nb_variables, nb_months, nb_div_lat*nb_div_long)`
+    des variables (ordre de `feature_names`) des `nb_months` derniers mois.
+        `history`: tableau dense `(nb_mois, nb_div_lat, nb_div_long)` des
+        signalements, avec `max(lags)` mois avant la periode etudiee
+        `nb_months`: nombre de mois de la periode etudiee
+        `lags`: decalages en mois
+        `radius`: rayon du voisinage"""
+
+    first = len(history) - nb_months
+    lagged = [history[first-lag:len(history)-lag] for lag in lags]
+    if radius > 0:
+        lagged += [box_mean(values, radius) for values in lagged[:len(lags)]]
+
+    features = np.empty((len(lagged), nb_months, history[0].size),
+                        dtype=np.float32)
+    for i, values in enumerate(lagged):
+        features[i] = values.reshape(nb_months, -1)
+
+    return features
+
+
+def load_features(bounds, source_file, map_info, dates_info, cache_dir=None,
+                  lags=LAGS, radius=RADIUS):
+    """Renvoie le dictionnaire `{nom: tableau (nb_mois, nb_divisions)}` des
+    variables decalees et de voisinage sur une periode, depuis le cache si
+    possible.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `dates_info`: couple sur la periode etudiee
+        `cache_dir`: None ou repertoire du cache binaire des signalements
+        `lags`: decalages en mois
+        `radius`: rayon du voisinage"""
+
+    (year_min, month_min), (year_max, month_max) = dates_info
+    rel_months = year_min*12+month_min, year_max*12+month_max
+    nb_months = rel_months[1] - rel_months[0] + 1
+    names = feature_names(lags, radius)
+
+    path = None
+    if cache_dir is not None:
+        key = key_digest(list(bounds), list(map_info), list(rel_months),
+                         list(lags), radius)
+        path = os.path.join(source_dir(source_file, cache_dir),
+                            f'variables_{key}.npy')
+
+    if path is None or not os.path.exists(path):
+        # signalements de la periode et des `max(lags)` mois precedents
+        year, month = divmod(rel_months[0] - max(lags) - 1, 12)
+        history, _ = sglmt_cube(bounds, source_file, map_info,
+                                ((year, month+1), dates_info[1]), None,
+                                cache_dir)
+        features = compute_features(history.to_dense(), nb_months, lags,
+                                    radius)
+        if path is None:
+            return dict(zip(names, features))
+        tmp_path = temp_path(path, '.tmp.npy')
+        np.save(tmp_path, features)
+        os.replace(tmp_path, path)
+
+    return dict(zip(names, np.load(path, mmap_mode='r')))
@@ -0,0 +1,132 @@
+"""Modeles au format tableau plat.
+
+Ce module sert a exporter un arbre de decision ou une foret aleatoire
+`sklearn` entraines vers un tableau `numpy` de noeuds (fichier `.npy`
+projetable en memoire), et a evaluer ce tableau sur un ensemble de donnees
+sans importer `sklearn`. Les arbres d'une foret sont mis bout a bout dans le
+meme tableau.
+"""
+
+
+import numpy as np
+
+
+
+# structure d'un noeud : enfants gauche et droit (-1 pour une feuille),
+# variable et seuil de separation, valeur predite dans la feuille
+NODE_DTYPE = np.dtype([('left', np.int32), ('right', np.int32),
+                       ('feature', np.int16), ('threshold', np.float64),
+                       ('value', np.float64)])
+
+
+def tree_to_nodes(model):
+    """Renvoie le tableau de noeuds d'un arbre `sklearn` entraine
+    (`DecisionTreeClassifier` ou `DecisionTreeRegressor`).
+        `model`: arbre de decision entraine"""
+
+    tree = model.tree_
+    nodes = np.empty(tree.node_count, dtype=NODE_DTYPE)
+    nodes['left'] = tree.children_left
+    nodes['right'] = tree.children_right
+    nodes['feature'] = np.maximum(tree.feature, -1)
+    nodes['threshold'] = tree.threshold
+
+    if hasattr(model, 'classes_'):
+        # classification : classe majoritaire de chaque noeud
+        nodes['value'] = model.classes_[np.argmax(tree.value[:, 0], axis=1)]
+    else:
+        nodes['value'] = tree.value[:, 0, 0]
+
+    return nodes
+
+
+def forest_to_nodes(model):
+    """Renvoie le tableau de noeuds d'une foret `sklearn` entrainee (arbres
+    mis bout a bout, enfants decales en consequence).
+        `model`: foret aleatoire entrainee"""
+
+    parts, offset = [], 0
+    for tree in model.estimators_:
+        nodes = tree_to_nodes(tree)
+        inner = nodes['left'] != -1
+        nodes['left'][inner] += offset
+        nodes['right'][inner] += offset
+        parts.append(nodes)
+        offset += len(nodes)
+
+    return np.concatenate(parts)
+
+
+def to_nodes(model):
+    """Renvoie le tableau de noeuds d'un arbre ou d'une foret `sklearn`
+    entraines.
+        `model`: arbre de decision ou foret aleatoire entraines"""
+
+    if hasattr(model, 'estimators_'):
+        return forest_to_nodes(model)
+
+    return tree_to_nodes(model)
+
+
+def export_tree(model, path):
+    """Sauvegarde un arbre ou une foret `sklearn` entraines au format
+    tableau plat.
+        `model`: arbre de decision ou foret aleatoire entraines
+        `path`: chemin du fichier `.npy` a creer"""
+
+    np.save(path, to_nodes(model))
+
+
+def load_tree(path):
+    """Charge (par projection en memoire) un arbre au format tableau plat.
+        `path`: chemin du fichier `.npy`"""
+
+    return np.load(path, mmap_mode='r')
+
+
+def tree_roots(nodes):
+    """Renvoie les racines des arbres d'un tableau de noeuds (les noeuds qui
+    ne sont les enfants d'aucun autre), `[0]` pour un seul arbre.
+        `nodes`: tableau de noeuds (voir `NODE_DTYPE`)"""
+
+    inner = nodes['left'] != -1
+    children = np.concatenate((nodes['left'][inner], nodes['right'][inner]))
+
+    return np.setdiff1d(np.arange(len(nodes)), children)
+
+
+def predict_tree(nodes, X, roots=(0,)):
+    """Evalue un arbre (ou la moyenne des arbres d'une foret) au format
+    tableau plat sur toutes les lignes de `X` a la fois, en descendant chaque
+    arbre niveau par niveau.
+        `nodes`: tableau de noeuds (voir `NODE_DTYPE`)
+        `X`: tableau `(nb_lignes, nb_variables)` des variables explicatives
+        `roots`: racines des arbres (voir `tree_roots`)"""
+
+    # memes comparaisons que `sklearn` (variables en float32)
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    nb_features = X.shape[1]
+    X = X.ravel()
+
+    # champs copies en tableaux contigus (acces indexes plus rapides)
+    left = np.ascontiguousarray(nodes['left'])
+    right = np.ascontiguousarray(nodes['right'])
+    feature = nodes['feature'].astype(np.intp)
+    threshold = np.ascontiguousarray(nodes['threshold'])
+
+    value = np.ascontiguousarray(nodes['value'])
+
+    result = None
+    for root in roots:
+        current = np.full(len(X)//nb_features, root, dtype=np.int32)
+        rows = np.arange(len(current))
+        while len(rows) > 0:
+            node = current[rows]
+            # les lignes arrivees dans une feuille ne bougent plus
+            inner = left[node] != -1
+            rows, node = rows[inner], node[inner]
+            go_left = X[rows*nb_features + feature[node]] <= threshold[node]
+            current[rows] = np.where(go_left, left[node], right[node])
+        result = value[current] if result is None else result + value[current]
+
+    return result if len(roots) == 1 else result / len(roots)
@@ -1,13 +1,21 @@
 """Creation de dataframes.
 
 Ce module sert a extraire les donnees de signalement puis creer des objets
-`pandas.DataFrame` contenant le nombre de signalements par mois et par
-zone geographique.
+`CountCube` ou `pandas.DataFrame` contenant le nombre de signalements par
+pas de temps (mois par defaut, semaine, jour ou nombre de jours) et par zone
+geographique.
 """
 
 
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from sglmt_cache import (read_columns, bin_columns, load_binned,
+                         read_regions, join_regions, region_raster,
+                         load_raster, ingest, step_days, first_step_day,
+                         step_count)
+from count_cube import CountCube
+from profiling import stage
 
 
 
@@ -23,7 +31,30 @@ def get_dates_array(rel_months):
     return dates
 
 
-def sglmt_data_simpli(bounds, source_file, map_info, rel_months, lyme):
+def get_steps_array(rel_months, step='mois'):
+    """Cree un tableau avec les dates de debut de chaque pas de temps entier
+    (voir `sglmt_cache.step_count`) d'une date a une autre : annees et mois
+    (voir `get_dates_array`) pour `'mois'`, annees, mois et jours sinon.
+        `rel_months`: premier et dernier mois relatif etudie
+        `step`: pas de temps (voir `sglmt_cache.step_days`)"""
+
+    length = step_days(step)
+    if length is None:
+        return get_dates_array(rel_months)
+
+    first = first_step_day(rel_months[0], step)
+    days = np.datetime64('2000-01-01', 'D') \
+        + first + np.arange(step_count(rel_months, step))*length
+
+    months = days.astype('datetime64[M]')
+    years, months_nb = divmod(months.astype(np.int64) - 360, 12)
+    day_nb = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+
+    return np.stack([years, months_nb+1, day_nb], axis=1)
+
+
+def sglmt_data_simpli(bounds, source_file, map_info, rel_months, lyme,
+                      cache_dir=None, step='mois'):
     """Importe le fichier `.csv` des signalements et renvoie une version
     discretisee en `pandas.DataFrame`.
         `bounds`: quadruplet `(long_min, long_max, lat_min, lat_max)`
@@ -32,115 +63,210 @@ def sglmt_data_simpli(bounds, source_file, map_info, rel_months, lyme):
         signalements
         `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
         des cartes
-        `map_info`: couple sur le premier et dernier mois relatif etudie
+        `rel_months`: couple sur le premier et dernier mois relatif etudie
         `lyme`: None ou couple `(regions_file, lyme_data)` sur le fichier de
-        regions et les diagnostics de maladies de Lyme"""
-
-    data_path, data_delim = source_file
-    long_min, long_max, lat_min, lat_max = bounds
-    nb_div_long, nb_div_lat = map_info
-    rel_month_min, rel_month_max = rel_months
-
-    # chargement du fichier
-    sglmt_data = pd.read_csv(data_path, delimiter=data_delim)
-    sglmt_data = sglmt_data.drop(columns=['day'])
-
-    # simplification des dates en mois relatifs
-    sglmt_data['year'] -= 2000
-    sglmt_data['rel_month'] = sglmt_data['year']*12 + sglmt_data['month']
-    sglmt_data = sglmt_data.drop(columns=['month', 'year'])
-    sglmt_data['rel_month'] = sglmt_data['rel_month'].astype(int)
-
-    # selection des donnees utiles uniquement
-    sglmt_data = sglmt_data[(sglmt_data['rel_month'] >= rel_month_min)
-                            & (sglmt_data['rel_month'] <= rel_month_max)]
-
-    # discretisation des coordonnees gps
-    lat_unit = nb_div_lat/(lat_max - lat_min)
-    sglmt_data['lat'] =  (sglmt_data['lat'] - lat_min) * lat_unit
-    sglmt_data['lat'] = sglmt_data['lat'].apply(np.floor)
-    sglmt_data['lat'] = sglmt_data['lat'].astype(int)
-
-    long_unit = nb_div_long/(long_max - long_min)
-    sglmt_data['long'] = (sglmt_data['long'] - long_min) * long_unit
-    sglmt_data['long'] = sglmt_data['long'].apply(np.floor)
-    sglmt_data['long'] = sglmt_data['long'].astype(int)
-
-    # indice des combinaisons de mois et de zone
-    sglmt_data['indices'] = ((sglmt_data['rel_month']-rel_month_min)
-                             * nb_div_lat*nb_div_long
-                             + sglmt_data['lat']*nb_div_long
-                             + sglmt_data['long'])
-
-    if lyme == None:
-        # compte des signalements par indice
-        sglmt_data = (pd.DataFrame(sglmt_data['indices'], columns=['indices'])
+        regions et les diagnostics de maladies de Lyme
+        `cache_dir`: None ou repertoire du cache binaire des signalements
+        `step`: pas de temps (voir `sglmt_cache.step_days`)"""
+
+    # chargement des signalements discretises (depuis le cache si possible)
+    with stage('discretisation') as counts:
+        if cache_dir is None:
+            columns = read_columns(source_file)
+            indices, rows = bin_columns(columns, bounds, map_info, rel_months,
+                                        step)
+        else:
+            indices, rows = load_binned(bounds, source_file, map_info,
+                                        rel_months, cache_dir, step)
+        counts['signalements'] = len(indices)
+
+    # compte des signalements par indice
+    with stage('comptage', signalements=len(indices)) as counts:
+        sglmt_data = (pd.DataFrame({'indices': indices})
             .groupby(['indices']).size()
             .reset_index(name='nb_sglmt'))
-    else:
-        # chargement du fichier de regions
-        (region_path, region_delim), lyme_data = lyme
-        regions = pd.read_csv(region_path, delimiter=region_delim)
-
-        # ajout des regions
-        regions = regions.drop(columns=['departement'])
-        sglmt_data = sglmt_data.merge(regions, on='ref')
-        sglmt_data = pd.DataFrame(sglmt_data[['indices', 'region']],
-                                  columns=['indices', 'region'])
-
-        # compte des signalements par indice
-        sglmt_data = (sglmt_data
-            .groupby(['indices', 'region']).size()
-            .reset_index(name='nb_sglmt')
-            .groupby('indices').agg({'region': 'first', 'nb_sglmt': 'sum'})
-            .reset_index())
-
-        # remplacement des regions par les diagnostics de maladies de lyme
-        sglmt_data = sglmt_data.replace({'region': lyme_data})
-        sglmt_data.columns = ['indices', 'lyme', 'nb_sglmt']
+        counts['cellules'] = len(sglmt_data)
+
+    if lyme is not None:
+        # diagnostics de maladies de lyme de la division de chaque indice
+        raster = lyme_raster(bounds, source_file, map_info, lyme, cache_dir)
+        cells = sglmt_data['indices'].to_numpy() % len(raster)
+        sglmt_data['lyme'] = raster[cells]
 
     return sglmt_data
 
 
-def sglmt_df(bounds, source_file, map_info, dates_info, lyme):
-    """Cree une `pandas.DataFrame` avec tous les signalements sur une periode
-    par mois et par division. 
+def regions_raster(bounds, source_file, map_info, regions_file,
+                   cache_dir=None):
+    """Renvoie le couple `(raster, names)` ou `raster` (taille
+    `nb_div_lat*nb_div_long`) donne le code de la region de chaque division
+    dans `names` (region majoritaire des signalements, voir
+    `sglmt_cache.region_raster`), `-1` si aucune region n'est connue.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `regions_file`: couple `(regions_path, delim)` sur le fichier de
+        regions
+        `cache_dir`: None ou repertoire du cache binaire des signalements"""
+
+    with stage('regions', divisions=map_info[0]*map_info[1]):
+        if cache_dir is None:
+            columns = read_columns(source_file)
+            codes, names = join_regions(columns['ref'],
+                                        read_regions(regions_file))
+            return region_raster(columns, codes, bounds, map_info), names
+
+        return load_raster(bounds, source_file, regions_file, map_info,
+                           cache_dir)
+
+
+def lyme_raster(bounds, source_file, map_info, lyme, cache_dir=None):
+    """Renvoie le tableau (taille `nb_div_lat*nb_div_long`) des diagnostics
+    de maladies de Lyme de la region de chaque division (voir
+    `regions_raster`), `0` si aucune region n'est connue.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `lyme`: couple `(regions_file, lyme_data)` sur le fichier de regions
+        et les diagnostics de maladies de Lyme
+        `cache_dir`: None ou repertoire du cache binaire des signalements"""
+
+    regions_file, lyme_data = lyme
+    raster, names = regions_raster(bounds, source_file, map_info,
+                                   regions_file, cache_dir)
+
+    # diagnostics de chaque region (derniere case : region inconnue)
+    rates = np.array([lyme_data.get(name, 0) for name in names] + [0],
+                     dtype=np.ushort)
+
+    return rates[raster]
+
+
+def sglmt_cube(bounds, source_file, map_info, dates_info, lyme,
+               cache_dir=None, base_map_info=None, step='mois'):
+    """Cree un `CountCube` avec tous les signalements sur une periode par pas
+    de temps et par division, et renvoie le couple `(cube, dates)`. Seules
+    les combinaisons non vides sont conservees : la memoire et le temps de
+    construction dependent du nombre de signalements, pas du nombre de pas de
+    temps.
         `bounds`: quadruplet sur les bordures des cartes
         `source_file`: couple sur le fichier de signalements
         `map_info`: couple sur la construction des cartes
         `dates_info`: couple sur la periode etudiee
         `lyme`: None ou couple `(regions_file, lyme_data)` sur le fichier de
-        regions et les diagnostics de maladies de Lyme"""
+        regions et les diagnostics de maladies de Lyme
+        `cache_dir`: None ou repertoire du cache binaire des signalements
+        `base_map_info`: None ou couple `(nb_div_long, nb_div_lat)` d'une
+        grille fine (multiple de `map_info`) discretisee une seule fois, dont
+        on deduit la grille demandee par sommes de blocs
+        `step`: pas de temps (`'mois'`, `'semaine'`, `'jour'` ou nombre de
+        jours, voir `sglmt_cache.step_days`)"""
 
-    nb_div_long, nb_div_lat = map_info
     year_min, month_min = dates_info[0]
     year_max, month_max = dates_info[1]
 
     rel_months = year_min*12+month_min, year_max*12+month_max
 
+    if base_map_info is not None and tuple(base_map_info) != tuple(map_info):
+        # Lyme calcule directement sur la grille demandee (comme sans grille
+        # fine), la grille fine n'en a pas besoin
+        base = base_cube(bounds, source_file, base_map_info, rel_months, None,
+                         cache_dir, step)
+        with stage('agregation', cellules=base.nnz):
+            cube = base.coarsen(
+                map_info,
+                None if lyme is None else lyme_raster(bounds, source_file,
+                                                      map_info, lyme,
+                                                      cache_dir))
+        return cube, base.dates
+
     # simplification des signalements
     base = sglmt_data_simpli(bounds, source_file, map_info,
-                             rel_months, lyme)
+                             rel_months, None, cache_dir, step)
 
     # tableau des dates sur la periode
-    dates = get_dates_array(rel_months)
-    nb_dates = len(dates)
-
-    # creation de la DataFrame avec chaque combinaison de date et de zone
-    map_size = nb_div_lat*nb_div_long
-    df = pd.DataFrame()
-    df[['year', 'month']] = np.repeat(dates, map_size, axis=0)
-    df['lat'] = np.tile(np.repeat(np.arange(nb_div_lat, dtype=np.ushort),
-                                  nb_div_long), nb_dates)
-    df['long'] = np.tile(np.arange(nb_div_long, dtype=np.ushort),
-                         nb_dates*nb_div_lat)
-    df['nb_sglmt'] = np.zeros(nb_dates*map_size, dtype=np.ushort)
-    df['lyme'] = np.zeros(nb_dates*map_size, dtype=np.ushort)
+    dates = get_steps_array(rel_months, step)
 
     # ajout de tous les signalements
-    for _, row in base.iterrows():
-        df.at[row['indices'], 'nb_sglmt'] = row['nb_sglmt']
-        if lyme != None:
-            df.at[row['indices'], 'lyme'] = row['lyme']
+    cube = CountCube.from_counts(
+        base['indices'].to_numpy(), base['nb_sglmt'].to_numpy(), dates,
+        map_info,
+        None if lyme is None else lyme_raster(bounds, source_file, map_info,
+                                              lyme, cache_dir))
+
+    return cube, dates
+
+
+# cubes deja discretises sur une grille fine (pyramide de resolutions)
+base_cubes = OrderedDict()
+# nombre maximal de cubes conserves en memoire
+BASE_CUBES_MAX = 4
+
+
+def base_cube(bounds, source_file, map_info, rel_months, lyme, cache_dir,
+              step='mois'):
+    """Renvoie le cube de la grille fine `map_info`, discretise une seule
+    fois puis conserve en memoire pour en deduire les grilles plus grossieres.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple `(nb_div_long, nb_div_lat)` de la grille fine
+        `rel_months`: couple sur le premier et dernier mois relatif etudie
+        `lyme`: None ou couple `(regions_file, lyme_data)`
+        `cache_dir`: None ou repertoire du cache binaire des signalements
+        `step`: pas de temps (voir `sglmt_cache.step_days`)"""
+
+    key = (tuple(bounds), tuple(source_file), tuple(map_info), rel_months,
+           None if lyme is None else tuple(lyme[0]), cache_dir, step)
+
+    if key in base_cubes:
+        base_cubes.move_to_end(key)
+    else:
+        dates_info = (divmod(rel_months[0]-1, 12), divmod(rel_months[1]-1, 12))
+        dates_info = tuple((year, month+1) for year, month in dates_info)
+        base_cubes[key], _ = sglmt_cube(bounds, source_file, map_info,
+                                        dates_info, lyme, cache_dir,
+                                        step=step)
+        if len(base_cubes) > BASE_CUBES_MAX:
+            base_cubes.popitem(last=False)
+
+    return base_cubes[key]
+
+
+def sglmt_df(bounds, source_file, map_info, dates_info, lyme, cache_dir=None,
+             base_map_info=None, step='mois'):
+    """Cree une `pandas.DataFrame` avec tous les signalements sur une periode
+    par pas de temps et par division.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple sur la construction des cartes
+        `dates_info`: couple sur la periode etudiee
+        `lyme`: None ou couple `(regions_file, lyme_data)` sur le fichier de
+        regions et les diagnostics de maladies de Lyme
+        `cache_dir`: None ou repertoire du cache binaire des signalements
+        `base_map_info`: None ou couple sur une grille fine dont on deduit la
+        grille demandee (voir `sglmt_cube`)
+        `step`: pas de temps (voir `sglmt_cache.step_days`)"""
+
+    cube, dates = sglmt_cube(bounds, source_file, map_info, dates_info, lyme,
+                             cache_dir, base_map_info, step)
+
+    return cube.to_dataframe(), dates
+
+
+def ingest_sglmt(source_file, cache_dir, regions_file=None, delta_file=None):
+    """Integre au cache binaire les nouveaux signalements (voir
+    `sglmt_cache.ingest`) et renvoie le nombre de signalements ajoutes.
+        `source_file`: couple sur le fichier de signalements
+        `cache_dir`: repertoire du cache binaire des signalements
+        `regions_file`: None ou couple sur le fichier de regions
+        `delta_file`: None ou chemin d'un fichier de nouveaux signalements"""
+
+    nb_new = ingest(source_file, cache_dir, regions_file, delta_file)
+
+    # les cubes gardes en memoire ne sont plus a jour
+    if nb_new != 0:
+        base_cubes.clear()
 
-    return df, dates
+    return nb_new
@@ -0,0 +1,227 @@
+"""Scores des predictions.
+
+Ce module sert a evaluer des predictions mois par mois (ou pas de temps par
+pas de temps) en un seul passage : coefficient R2, erreur absolue moyenne,
+deviance de Poisson et proportion des points chauds (divisions avec le plus de
+signalements) retrouves, sur la grille des predictions et sur des grilles plus
+grossieres (blocs de divisions sommes). Les scores globaux sont calcules a
+partir de sommes cumulees : aucun mois n'est garde en memoire.
+"""
+
+
+import numpy as np
+
+
+
+# facteurs d'agregation des grilles evaluees (1 : grille des predictions)
+LEVELS = (1, 4)
+
+# proportion des divisions considerees comme points chauds
+HOTSPOT_FRACTION = 0.01
+
+# prediction minimale pour la deviance de Poisson (predictions arrondies :
+# une prediction nulle donnerait une deviance infinie)
+PREDICTION_MIN = 1e-2
+
+
+def r2_score(y_true, y_pred):
+    """Renvoie le coefficient R2 (meme definition que
+    `sklearn.metrics.r2_score`, moyenne uniforme sur les colonnes pour des
+    tableaux a deux dimensions).
+        `y_true`: valeurs reelles
+        `y_pred`: valeurs predites"""
+
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    if y_true.ndim == 1:
+        y_true, y_pred = y_true[:, None], y_pred[:, None]
+
+    numerator = ((y_true - y_pred)**2).sum(axis=0)
+    denominator = ((y_true - y_true.mean(axis=0))**2).sum(axis=0)
+
+    return ratio_score(numerator, denominator)
+
+
+def ratio_score(numerator, denominator):
+    """Renvoie la moyenne des coefficients `1 - numerator/denominator` de
+    chaque colonne (colonnes constantes : 1 si predites exactement, 0
+    sinon), NaN si toutes les colonnes sont constantes (score non defini).
+        `numerator`: sommes des carres des erreurs par colonne
+        `denominator`: sommes des carres des ecarts a la moyenne par colonne"""
+
+    if not np.any(denominator != 0):
+        return float('nan')
+
+    scores = np.where(numerator == 0, 1.0, 0.0)
+    valid = denominator != 0
+    scores[valid] = 1 - numerator[valid]/denominator[valid]
+
+    return float(np.mean(scores))
+
+
+def defined(score):
+    """Renvoie le score, ou None s'il n'est pas defini (NaN), pour que les
+    dictionnaires de scores restent serialisables en `json` standard.
+        `score`: score (nombre flottant)"""
+
+    return None if np.isnan(score) else score
+
+
+def aggregate(values, map_info, factor):
+    """Renvoie les sommes des signalements par blocs de `factor*factor`
+    divisions (blocs incomplets au bord de la carte completes par des
+    zeros), a plat.
+        `values`: tableau (taille `nb_div_lat*nb_div_long`) par division
+        `map_info`: couple `(nb_div_long, nb_div_lat)` de la grille
+        `factor`: cote des blocs en divisions"""
+
+    if factor == 1:
+        return np.asarray(values, dtype=np.float64)
+
+    nb_div_long, nb_div_lat = map_info
+    grid = np.asarray(values, dtype=np.float64).reshape(nb_div_lat,
+                                                        nb_div_long)
+    height, width = -(-nb_div_lat//factor), -(-nb_div_long//factor)
+    grid = np.pad(grid, ((0, height*factor - nb_div_lat),
+                         (0, width*factor - nb_div_long)))
+
+    return grid.reshape(height, factor, width, factor).sum(axis=(1, 3)).ravel()
+
+
+def deviance(y_true, y_pred):
+    """Renvoie la somme des deviances de Poisson unitaires.
+        `y_true`: valeurs reelles
+        `y_pred`: valeurs predites (ramenees a `PREDICTION_MIN` au moins)"""
+
+    y_pred = np.maximum(y_pred, PREDICTION_MIN)
+    positive = y_true > 0
+    log_term = np.zeros(len(y_true))
+    log_term[positive] = y_true[positive]*np.log(y_true[positive]
+                                                 / y_pred[positive])
+
+    return float(2*np.sum(log_term - (y_true - y_pred)))
+
+
+def hotspot_hits(y_true, y_pred, fraction=HOTSPOT_FRACTION):
+    """Renvoie le couple `(nombre de points chauds retrouves, nombre de points
+    chauds)` : les points chauds sont les divisions non vides avec le plus de
+    signalements reels, retrouves s'ils sont aussi parmi les divisions avec
+    le plus de signalements predits.
+        `y_true`: valeurs reelles
+        `y_pred`: valeurs predites
+        `fraction`: proportion des divisions considerees comme points chauds"""
+
+    size = min(max(1, int(round(fraction*len(y_true)))),
+               int(np.count_nonzero(y_true)))
+    if size == 0:
+        return 0, 0
+
+    # classement stable : a egalite, les premieres divisions
+    hot_true = np.argsort(-y_true, kind='stable')[:size]
+    hot_pred = np.argsort(-y_pred, kind='stable')[:size]
+
+    return len(np.intersect1d(hot_true, hot_pred)), size
+
+
+class LevelSums:
+    """Sommes cumulees des scores sur une grille (voir `Metrics`).
+        `size`: nombre de divisions de la grille"""
+
+    def __init__(self, size):
+        self.count = 0
+        self.sum_true = np.zeros(size)
+        self.sum_true2 = np.zeros(size)
+        self.sum_error2 = np.zeros(size)
+        self.sum_abs = 0.0
+        self.sum_deviance = 0.0
+        self.hits = 0
+        self.hotspots = 0
+
+    def add(self, y_true, y_pred, fraction):
+        """Ajoute un mois et renvoie le dictionnaire de ses scores (memes
+        scores que `scores` sur ce seul mois, R2 sur les divisions).
+            `y_true`: signalements reels par division
+            `y_pred`: signalements predits par division
+            `fraction`: proportion des divisions considerees comme points
+            chauds"""
+
+        error = y_true - y_pred
+        self.count += 1
+        self.sum_true += y_true
+        self.sum_true2 += y_true**2
+        self.sum_error2 += error**2
+        month_abs = float(np.sum(np.abs(error)))
+        month_deviance = deviance(y_true, y_pred)
+        hits, size = hotspot_hits(y_true, y_pred, fraction)
+        self.sum_abs += month_abs
+        self.sum_deviance += month_deviance
+        self.hits += hits
+        self.hotspots += size
+
+        return {'r2': defined(r2_score(y_true, y_pred)),
+                'erreur_absolue': month_abs/len(y_true),
+                'deviance_poisson': month_deviance/len(y_true),
+                'points_chauds': hits/size if size else None}
+
+    def scores(self):
+        """Renvoie les scores globaux : R2 de chaque division sur tous les
+        mois (moyenne sur les divisions, meme valeur que `r2_score` sur le
+        tableau `(nb_mois, nb_divisions)`, None si non defini), erreur
+        absolue et deviance moyennes, proportion de tous les points chauds
+        retrouves."""
+
+        nb_values = self.count*len(self.sum_true)
+        denominator = self.sum_true2 - self.sum_true**2/max(self.count, 1)
+
+        return {'r2': defined(ratio_score(self.sum_error2, denominator)),
+                'erreur_absolue': self.sum_abs/max(nb_values, 1),
+                'deviance_poisson': self.sum_deviance/max(nb_values, 1),
+                'points_chauds': (self.hits/self.hotspots if self.hotspots
+                                  else None)}
+
+
+class Metrics:
+    """Scores de predictions ajoutees mois par mois, sur plusieurs grilles.
+        `map_info`: couple `(nb_div_long, nb_div_lat)` de la grille des
+        predictions
+        `levels`: facteurs d'agregation des grilles evaluees
+        `fraction`: proportion des divisions considerees comme points chauds"""
+
+    def __init__(self, map_info, levels=LEVELS, fraction=HOTSPOT_FRACTION):
+        self.map_info = tuple(map_info)
+        self.levels = tuple(levels)
+        self.fraction = fraction
+        nb_div_long, nb_div_lat = self.map_info
+        self.sums = [LevelSums(len(aggregate(np.zeros(nb_div_lat*nb_div_long),
+                                             self.map_info, factor)))
+                     for factor in self.levels]
+        self.periods = []
+
+    def add(self, date, y_true, y_pred):
+        """Ajoute les scores d'un mois (a appeler dans l'ordre des mois) et
+        renvoie la liste de ses scores pour chaque niveau.
+            `date`: date du mois (voir `CountCube.dates`)
+            `y_true`: signalements reels par division
+            `y_pred`: signalements predits par division"""
+
+        scores = [sums.add(aggregate(y_true, self.map_info, factor),
+                           aggregate(y_pred, self.map_info, factor),
+                           self.fraction)
+                  for factor, sums in zip(self.levels, self.sums)]
+        self.periods.append({'date': [int(v) for v in date],
+                             'scores': scores})
+
+        return scores
+
+    def result(self):
+        """Renvoie le dictionnaire (serialisable en `json`) des scores :
+        `niveaux` (facteurs d'agregation), `global` (scores globaux de chaque
+        niveau) et `periodes` (date et scores de chaque niveau pour chaque
+        mois). Leve une `ValueError` si aucun mois n'a ete ajoute."""
+
+        if not self.periods:
+            raise ValueError('Aucune periode evaluee (periode vide)')
+
+        return {'niveaux': list(self.levels),
+                'global': [sums.scores() for sums in self.sums],
+                'periodes': self.periods}
@@ -1,111 +1,595 @@
 """Predictions de signalements.
 
-Ce module sert a creer un modele `sklearn.tree.DecisionTreeClassifier`
-entraine sur une periode. Il permet aussi de creer des cartes comparant des
-predictions aux donnes reelles.
+Ce module sert a creer un modele de prediction (voir `engines`) entraine sur
+une periode. Il permet aussi de creer des cartes comparant des predictions
+aux donnes reelles (sans importer `sklearn` si le modele est disponible au
+format tableau plat). Les constantes (`constants.json`) ne sont lues qu'a la
+premiere utilisation, et les modules d'images qu'au moment des predictions.
 """
 
 
 import os
 import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sklearn.tree import DecisionTreeClassifier
-import sklearn.metrics as mt
-import joblib
-from create_maps import comparative_total
-from make_sglmt_df import sglmt_df
-
-
-
-# charge le fichier contenant les constantes utiles
-with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                       'constants.json'), 'r') as cons:
-    constants = json.load(cons)
-# bordures de la carte
-bounds = (constants["longitudeMin"], constants["longitudeMax"],
-          constants["latitudeMin"], constants["latitudeMax"])
-# donnees de signalements
-sglmt_data_file = (constants["pathDonneesSignalements"],
-                   constants["delimiteurDonneesSignalements"])
-# donnees sur les regions
-regions_file = (constants["pathDonneesRegions"],
-                   constants["delimiteurDonneesRegions"])
-# donnees sur les maladies de Lyme
-with open(constants["pathDonneesLyme"], 'r') as lyme:
-    lyme_data = (regions_file, json.load(lyme))
-# repertoire ou stocker les modeles
-model_path = constants["pathModele"]
-# repertoire ou stocker les cartes
-export_path = constants["pathCartes"]
-
-
-def make_model(map_info, dates_info, model_name, lyme):
-    """Cree un modele de prediction avec la methode `DecisionTreeClassifier`.
+from make_sglmt_df import sglmt_cube, regions_raster
+import engines
+from engines import fit_model, save_model
+from feature_store import load_features
+import result_cache
+from profiling import stage, profile, bind
+from metrics import Metrics
+from dtypes import count_dtype, values_max, set_row, round_counts
+
+
+
+# fichiers des constantes cherches dans l'ordre : a cote du module, puis a la
+# racine du depot
+CONSTANTS_FILES = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'constants.json'),
+                   os.path.join(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))), 'constants.json')]
+
+# constantes utiles, chargees a la premiere utilisation (voir
+# `load_constants`) : importer le module ne lit aucun fichier
+constants = None
+bounds = sglmt_data_file = regions_file = lyme_data = None
+model_path = export_path = cache_path = results_path = None
+results_max_size = result_cache.MAX_SIZE
+
+
+def load_constants(path=None):
+    """Charge le fichier des constantes et en deduit les variables du module
+    (bordures, fichiers de donnees, repertoires de travail).
+        `path`: None (premier fichier existant de `CONSTANTS_FILES`) ou
+        chemin du fichier `.json` des constantes"""
+
+    global constants, bounds, sglmt_data_file, regions_file, lyme_data
+    global model_path, export_path, cache_path, results_path
+    global results_max_size
+
+    if path is None:
+        path = next((file for file in CONSTANTS_FILES
+                     if os.path.exists(file)), CONSTANTS_FILES[0])
+
+    # charge le fichier contenant les constantes utiles
+    with open(path, 'r') as cons:
+        constants = json.load(cons)
+    # bordures de la carte
+    bounds = (constants["longitudeMin"], constants["longitudeMax"],
+              constants["latitudeMin"], constants["latitudeMax"])
+    # donnees de signalements
+    sglmt_data_file = (constants["pathDonneesSignalements"],
+                       constants["delimiteurDonneesSignalements"])
+    # donnees sur les regions
+    regions_file = (constants["pathDonneesRegions"],
+                    constants["delimiteurDonneesRegions"])
+    # donnees sur les maladies de Lyme
+    with open(constants["pathDonneesLyme"], 'r') as lyme:
+        lyme_data = (regions_file, json.load(lyme))
+    # repertoire ou stocker les modeles
+    model_path = constants["pathModele"]
+    # repertoire ou stocker les cartes
+    export_path = constants["pathCartes"]
+    # repertoire du cache binaire des signalements (optionnel)
+    cache_path = constants.get("pathCache")
+    # repertoire du cache des resultats (modeles, predictions, scores)
+    results_path = (None if cache_path is None
+                    else os.path.join(cache_path, 'resultats'))
+    # taille maximale du cache des resultats (en octets)
+    results_max_size = constants.get("tailleCacheResultats",
+                                     result_cache.MAX_SIZE)
+
+
+def ensure_constants():
+    """Charge les constantes (voir `load_constants`) si ce n'est pas deja
+    fait."""
+
+    if constants is None:
+        load_constants()
+
+
+def load_model(model_name):
+    """Charge un modele et renvoie une fonction de prediction (voir
+    `engines.load_model`).
+        `model_name`: nom du modele a charger"""
+
+    ensure_constants()
+
+    return engines.load_model(os.path.join(model_path, model_name))
+
+
+def inputs_key(kind, map_info, dates_info, lyme, base_map_info, **params):
+    """Renvoie l'empreinte de toutes les entrees d'un calcul : contenu des
+    fichiers de donnees, bordures, grille, periode, Lyme et parametres.
+        `kind`: type de resultat (`'modele'`, `'predictions'`)
         `map_info`: triplet sur la construction des cartes
-        `dates_info`: couple sur la periode d'entrainement 
-        `model_name`: nom du modele a sauvegarder
-        `lyme`: bool sur l'utilisation ou non des donnees de Lyme"""
+        `dates_info`: couple sur la periode
+        `lyme`: bool sur l'utilisation ou non des donnees de Lyme
+        `base_map_info`: None ou couple sur la grille fine
+        `params`: autres parametres du calcul"""
+
+    ensure_constants()
+
+    data = [result_cache.file_digest(sglmt_data_file[0]), sglmt_data_file[1]]
+    if lyme:
+        data += [result_cache.file_digest(regions_file[0]), regions_file[1],
+                 lyme_data[1]]
+
+    return result_cache.content_key(kind, data, bounds, map_info[:2],
+                                    dates_info, lyme, base_map_info, params)
+
+
+def make_cube(map_info, dates_info, lyme, base_map_info=None, lags=False,
+              step='mois'):
+    """Renvoie le couple `(cube, dates)` des signalements par pas de temps et
+    par division, avec les variables decalees et de voisinage si demandees,
+    et leve une `ValueError` si la periode ne contient aucun pas de temps.
+        `map_info`: triplet sur la construction des cartes
+        `dates_info`: couple sur la periode
+        `lyme`: bool sur l'utilisation ou non des donnees de Lyme
+        `base_map_info`: None ou couple sur une grille fine dont on deduit la
+        grille de `map_info`
+        `lags`: bool sur l'ajout des variables decalees et de voisinage (voir
+        `feature_store`, par mois uniquement)
+        `step`: pas de temps (voir `sglmt_cache.step_days`)"""
+
+    if lags and step != 'mois':
+        raise ValueError('Variables decalees disponibles uniquement avec un '
+                         'pas de temps mensuel')
+
+    ensure_constants()
 
     # utilisation de lyme
     lyme_info = lyme_data if lyme else None
 
-    # creation de la dataframe avec le nb de sglmt par date et par zone
-    df_train, _ = sglmt_df(bounds, sglmt_data_file,
-                           map_info[:-1], dates_info, lyme_info)
+    # creation du cube avec le nb de sglmts par date et par zone
+    cube, dates = sglmt_cube(bounds, sglmt_data_file, map_info[:-1],
+                             dates_info, lyme_info, cache_path, base_map_info,
+                             step)
+    if len(dates) == 0:
+        (year1, month1), (year2, month2) = dates_info
+        raise ValueError(f'Periode vide : aucun pas de temps entier de '
+                         f'{month1:0>2}/20{year1} a {month2:0>2}/20{year2}')
+
+    if lags:
+        with stage('variables_decalees', divisions=cube.map_size):
+            cube.extra = load_features(bounds, sglmt_data_file,
+                                       map_info[:-1], dates_info, cache_path)
+
+    return cube, dates
 
-    # donnees d'entrainement
-    X_train = df_train.drop(columns='nb_sglmt')
-    y_train = df_train[['nb_sglmt']].to_numpy(dtype=np.ushort).ravel()
 
-    # creation, entrainement, sauvegarde du modele de prediction
-    model = DecisionTreeClassifier()
-    model.fit(X_train, y_train)
-    joblib.dump(model, os.path.join(model_path, model_name) + '.joblib')
+def sparse_train_set(cube, zero_fraction, seed):
+    """Renvoie les donnees d'entrainement `(X, y, poids)` construites depuis
+    le cube creux : toutes les combinaisons non vides plus un echantillon
+    reproductible des combinaisons vides, ponderees par l'inverse de la
+    proportion tiree (les poids ne comptent qu'avec des feuilles d'un poids
+    minimal, voir `engines.SAMPLED_PARAMS`).
+        `cube`: `CountCube` sur la periode d'entrainement
+        `zero_fraction`: proportion des combinaisons vides conservees
+        `seed`: graine du tirage des combinaisons vides"""
+
+    nb_empty = cube.shape[0]*cube.map_size - cube.nnz
+    nb_sampled = min(nb_empty, int(round(zero_fraction*nb_empty)))
+
+    rng = np.random.default_rng(seed)
+    empty = cube.sample_empty(nb_sampled, rng)
+    indices = np.concatenate((cube.indices, empty))
+
+    X = cube.features(indices)
+    y = np.zeros(len(indices), dtype=cube.counts.dtype)
+    y[:cube.nnz] = cube.counts
+    weights = np.ones(len(indices))
+    if nb_sampled > 0:
+        weights[cube.nnz:] = nb_empty/nb_sampled
+
+    return X, y, weights
+
+
+def make_model(map_info, dates_info, model_name, lyme, base_map_info=None,
+               zero_fraction=None, seed=0, lags=False, engine='arbre',
+               nb_jobs=None, tiles=None, nb_workers=None, step='mois',
+               profiling=False):
+    """Cree un modele de prediction, le sauvegarde (voir
+    `engines.save_model`, ou `tiles.save_bundle` pour un modele par tuile)
+    et renvoie le couple `(temps d'entrainement en s,
+    taille du modele utilise pour les predictions en octets)`.
+        `map_info`: triplet sur la construction des cartes
+        `dates_info`: couple sur la periode d'entrainement
+        `model_name`: nom du modele a sauvegarder
+        `lyme`: bool sur l'utilisation ou non des donnees de Lyme
+        `base_map_info`: None ou couple `(nb_div_long, nb_div_lat)` d'une
+        grille fine dont on deduit la grille de `map_info`
+        `zero_fraction`: None (toutes les combinaisons de mois et de zone)
+        ou proportion des combinaisons sans signalement conservees pour
+        l'entrainement (voir `sparse_train_set`)
+        `seed`: graine du tirage des combinaisons sans signalement
+        `lags`: bool sur l'ajout des variables decalees et de voisinage (voir
+        `feature_store`), a garder identique pour les predictions
+        `engine`: methode de prediction (`'arbre'`, `'gradient'` ou
+        `'foret'`, voir `engines.ENGINES`)
+        `nb_jobs`: None (tous les coeurs, un seul par tuile avec `tiles`) ou
+        nombre de coeurs de la foret
+        `tiles`: None (un seul modele), couple `(nb_tuiles_long,
+        nb_tuiles_lat)` ou `'regions'` pour entrainer un modele par tuile
+        (voir `tiles`), a garder identique pour les predictions
+        `nb_workers`: None (tous les coeurs) ou nombre de processus
+        entrainant les tuiles
+        `step`: pas de temps (`'mois'`, `'semaine'`, `'jour'` ou nombre de
+        jours, voir `sglmt_cache.step_days`), a garder identique pour les
+        predictions
+        `profiling`: bool sur l'ecriture des mesures de chaque etape dans
+        `model_name_profil.jsonl` (voir `profiling.profile`)
+    Si le cache des resultats est disponible, un modele deja entraine sur les
+    memes entrees est copie depuis le cache (le temps d'entrainement renvoye
+    est alors celui de l'entrainement d'origine)."""
+
+    ensure_constants()
 
+    model_file = os.path.join(model_path, model_name)
 
-def predict(map_info, dates_train, period, image_name, model_name, regions):
+    if profiling:
+        with profile(model_file + '_profil.jsonl'):
+            return make_model(map_info, dates_info, model_name, lyme,
+                              base_map_info, zero_fraction, seed, lags,
+                              engine, nb_jobs, tiles, nb_workers, step)
+
+    # fichiers du modele (un seul fichier pour toutes les tuiles)
+    model_exts = ('.joblib', '.npy') if tiles is None else ('_tuiles.joblib',)
+
+    # modele deja entraine sur les memes entrees
+    if results_path is not None:
+        if tiles == 'regions':
+            tiles_key = [tiles, result_cache.file_digest(regions_file[0])]
+        else:
+            tiles_key = tiles
+        key = inputs_key('modele', map_info, dates_info, lyme, base_map_info,
+                         model=engines.ENGINES[engine],
+                         sampled=(None if zero_fraction is None else
+                                  engines.SAMPLED_PARAMS.get(engine)),
+                         zero_fraction=zero_fraction, seed=seed, lags=lags,
+                         tiles=tiles_key, step=step)
+        # etape mesuree meme si le modele est trouve (seule etape alors)
+        with stage('cache') as counts:
+            cached = result_cache.lookup(results_path, key)
+            counts['trouve'] = cached is not None
+            if cached is not None:
+                for ext in model_exts:
+                    if os.path.exists(os.path.join(cached, 'modele' + ext)):
+                        shutil.copyfile(os.path.join(cached, 'modele' + ext),
+                                        model_file + ext)
+                    elif os.path.exists(model_file + ext):
+                        os.remove(model_file + ext)
+                with open(os.path.join(cached, 'infos.json'), 'r') as infos:
+                    infos = json.load(infos)
+        if cached is not None:
+            return (infos['temps_entrainement'],
+                    os.path.getsize(model_file + infos['format']))
+
+    # creation du cube avec le nb de sglmt par date et par zone
+    cube_train, _ = make_cube(map_info, dates_info, lyme, base_map_info, lags,
+                              step)
+
+    if tiles is not None:
+        # un modele par tuile, entraines sur plusieurs processus
+        from tiles import grid_tiles, region_tiles, fit_tiles, save_bundle
+        if tiles == 'regions':
+            raster, _ = regions_raster(bounds, sglmt_data_file, map_info[:-1],
+                                       regions_file, cache_path)
+            tile_li = region_tiles(map_info[:-1], raster)
+        else:
+            tile_li = grid_tiles(map_info[:-1], tiles)
+
+        with stage('entrainement', tuiles=len(tile_li)):
+            start = time.perf_counter()
+            models = fit_tiles(cube_train, tile_li, zero_fraction, seed,
+                               engine, 1 if nb_jobs is None else nb_jobs,
+                               nb_workers)
+            train_time = time.perf_counter() - start
+
+        with stage('sauvegarde_modele', methode=engine):
+            predict_file = model_file + '_tuiles.joblib'
+            save_bundle(predict_file, map_info[:-1], tile_li, models)
+        model_ext = '_tuiles.joblib'
+
+    else:
+        # donnees d'entrainement
+        with stage('donnees_entrainement') as counts:
+            if zero_fraction is None:
+                X_train = cube_train.features(
+                    np.arange(cube_train.shape[0]*cube_train.map_size))
+                y_train = cube_train.to_dense().ravel()
+                weights = None
+            else:
+                X_train, y_train, weights = sparse_train_set(
+                    cube_train, zero_fraction, seed)
+            counts['lignes'] = len(y_train)
+
+        # creation, entrainement, sauvegarde du modele de prediction
+        with stage('entrainement', lignes=len(y_train)):
+            start = time.perf_counter()
+            model = fit_model(X_train, y_train, weights, seed, engine,
+                              nb_jobs)
+            train_time = time.perf_counter() - start
+
+        with stage('sauvegarde_modele', methode=engine):
+            predict_file = save_model(model, model_file)
+        model_ext = os.path.splitext(predict_file)[1]
+
+    if results_path is not None:
+        os.makedirs(results_path, exist_ok=True)
+        files = {'modele' + ext: model_file + ext
+                 for ext in model_exts
+                 if os.path.exists(model_file + ext)}
+        files['infos.json'] = {'temps_entrainement': train_time,
+                               'format': model_ext}
+        result_cache.store(results_path, key, files, results_max_size)
+
+    return train_time, os.path.getsize(predict_file)
+
+
+def predict(map_info, dates_train, period, image_name, model_name, lyme,
+            base_map_info=None, chunk_size=None, nb_threads=None,
+            period_images=False, animation=None, lags=False, tiles=None,
+            nb_workers=None, step='mois', profiling=False):
     """Predit des signalements a partir d'un modele, sauvegarde l'image de la
-    comparaison avec les donnees reelles et renvoie le coefficient R2 global
-    sur la correlation des donnees predites avec la theorie, et la liste des
-    coefficients par periode.
+    comparaison avec les donnees reelles et renvoie le dictionnaire des scores
+    (R2, erreur absolue, deviance de Poisson, points chauds retrouves) globaux
+    et de chaque mois, sur la grille et sur des grilles plus grossieres (voir
+    `metrics.Metrics.result`).
+    Les predictions sont faites mois par mois (et par paquets de
+    `chunk_size` divisions) : la memoire utilisee ne depend pas du nombre de
+    mois de test.
         `map_info`: triplet sur la construction des cartes
         `dates_train`: couple sur la periode de test
         `period`: periode de temps sur laquelle on rassemble les signalements
-        `image_name`: nom de l'image a creer 
+        `image_name`: nom de l'image a creer (None pour ne pas creer d'image)
         `model_name`: nom du modele a charger
-        `lyme`: bool sur l'utilisation ou non des donnees de Lyme"""
+        `lyme`: bool sur l'utilisation ou non des donnees de Lyme
+        `base_map_info`: None ou couple `(nb_div_long, nb_div_lat)` d'une
+        grille fine dont on deduit la grille de `map_info`
+        `chunk_size`: None (un mois a la fois) ou nombre de divisions
+        predites a la fois
+        `nb_threads`: None (tout a la suite) ou nombre de threads qui creent
+        et encodent les images (pendant les predictions uniquement pour les
+        images par periode, l'image de toutes les periodes attendant le
+        dernier mois pour son echelle de couleurs) et calculent les scores en
+        parallele
+        `period_images`: bool sur la creation d'une image par periode (avec
+        `nb_threads` uniquement)
+        `animation`: None, `'gif'` ou `'apng'` pour une image animee sur
+        toutes les periodes (avec `nb_threads` uniquement)
+        `lags`: bool sur l'ajout des variables decalees et de voisinage (comme
+        pour l'entrainement du modele)
+        `tiles`: None ou decoupage en tuiles utilise pour l'entrainement du
+        modele (voir `make_model`)
+        `nb_workers`: None (tous les coeurs) ou nombre de processus
+        predisant les tuiles
+        `step`: pas de temps (comme pour l'entrainement du modele), `period`
+        est alors un nombre de pas de temps
+        `profiling`: bool sur l'ecriture des mesures de chaque etape dans
+        `image_name_profil.jsonl` (`model_name_prediction_profil.jsonl` a
+        cote du modele sans image, voir `profiling.profile`)
+    Si le cache des resultats est disponible, les predictions et les scores
+    deja calcules avec le meme modele et les memes entrees sont relus depuis
+    le cache (seules les images sont recreees)."""
 
-    nb_div_long, nb_div_lat, _ = map_info
+    # chargement des images (PIL) uniquement pour les predictions
+    from create_maps import comparative_stream, comparative_pipeline
 
-    # utilisation de lyme
-    lyme_info = lyme_data if lyme else None
+    ensure_constants()
 
-    # creation de la DataFrame avec le nb de sglmts par date et par zone
-    df_test, dates_test = sglmt_df(bounds, sglmt_data_file,
-                                   map_info[:-1], dates_train, lyme_info)
+    if profiling:
+        path = (os.path.join(model_path, model_name + '_prediction')
+                if image_name is None else export_path + image_name)
+        with profile(path + '_profil.jsonl'):
+            return predict(map_info, dates_train, period, image_name,
+                           model_name, lyme, base_map_info, chunk_size,
+                           nb_threads, period_images, animation, lags,
+                           tiles, nb_workers, step)
 
-    # selection des donnees de test
-    X_test = df_test.drop(columns='nb_sglmt')
-    y_test = df_test[['nb_sglmt']].to_numpy(dtype=np.ushort)
+    model_file = os.path.join(model_path, model_name)
 
-    # chargement du modele et calcul des predictions
-    model = joblib.load(os.path.join(model_path, model_name) + '.joblib')
-    y_pred = model.predict(X_test)
+    # predictions et scores deja calcules avec les memes entrees
+    cached = None
+    if results_path is not None:
+        if tiles is not None:
+            model_ext = '_tuiles.joblib'
+        elif os.path.exists(model_file + '.npy'):
+            model_ext = '.npy'
+        else:
+            model_ext = '.joblib'
+        model_digest = result_cache.file_digest(model_file + model_ext)
+        key = inputs_key('predictions', map_info, dates_train, lyme,
+                         base_map_info, lags=lags, step=step,
+                         model=model_digest)
+        # etape mesuree meme si les scores sont trouves (seule etape alors)
+        with stage('cache') as counts:
+            cached = result_cache.lookup(results_path, key)
+            counts['trouve'] = cached is not None
+            if cached is not None:
+                with open(os.path.join(cached, 'scores.json'), 'r') as scores:
+                    scores = json.load(scores)
+        if cached is not None:
+            if image_name is None:
+                return scores
 
-    # formatage des donnees en sortie
-    theory = np.hstack(y_test)
-    predicted = y_pred.astype(dtype=np.ushort)
+    # creation du cube avec le nb de sglmts par date et par zone
+    cube_test, dates_test = make_cube(map_info, dates_train, lyme,
+                                      base_map_info, lags, step)
+
+    if cached is not None:
+        predicted_all = np.load(os.path.join(cached, 'predictions.npy'),
+                                mmap_mode='r')
+        months = ((date, cube_test.month_dense(i).ravel(), predicted_all[i])
+                  for i, date in enumerate(cube_test.dates))
+        if nb_threads is None:
+            comparative_stream(months, map_info, period,
+                               (export_path, image_name))
+        else:
+            with ThreadPoolExecutor(max_workers=nb_threads) as renderer:
+                comparative_pipeline(months, map_info, period,
+                                     (export_path, image_name), renderer,
+                                     period_images, animation)
+        return scores
+
+    # predictions et scores mois par mois
+    metrics = Metrics(map_info[:-1])
+    if tiles is None:
+        # chargement du modele
+        with stage('chargement_modele'):
+            model = load_model(model_name)
+        months = iter_predictions(cube_test, model, chunk_size)
+    else:
+        from tiles import iter_tile_predictions
+        months = iter_tile_predictions(cube_test,
+                                       model_file + '_tuiles.joblib',
+                                       chunk_size, nb_workers)
+
+    # predictions ecrites au fur et a mesure pour le cache des resultats
+    if results_path is not None:
+        os.makedirs(results_path, exist_ok=True)
+        predicted_file = os.path.join(
+            results_path,
+            f'predictions.{os.getpid()}.{threading.get_ident()}.npy')
+        recorded = []
+        months = record_months(months, predicted_file, cube_test, recorded)
 
     # creation des cartes en fonction du mode choisi
-    comparative_total(theory, predicted, map_info, dates_test, period,
-                      (export_path, image_name))
+    if nb_threads is None:
+        months = score_months(months, metrics)
+        if image_name is None:
+            for _ in months:
+                pass
+        else:
+            comparative_stream(months, map_info, period,
+                               (export_path, image_name))
+    else:
+        # un seul thread pour les scores (ajoutes dans l'ordre des mois)
+        with ThreadPoolExecutor(max_workers=1) as scorer, \
+                ThreadPoolExecutor(max_workers=nb_threads) as renderer:
+            months = score_months(months, metrics, scorer)
+            if image_name is None:
+                for _ in months:
+                    pass
+            else:
+                comparative_pipeline(months, map_info, period,
+                                     (export_path, image_name), renderer,
+                                     period_images, animation)
+
+    if results_path is not None:
+        recorded[0].flush()
+        del recorded[0]
+        result_cache.store(results_path, key,
+                           {'predictions.npy': predicted_file,
+                            'scores.json': metrics.result()},
+                           results_max_size)
+        os.remove(predicted_file)
+
+    return metrics.result()
+
+
+def iter_predictions(cube, model, chunk_size=None):
+    """Renvoie (generateur) pour chaque mois du cube le triplet `(date,
+    theory, predicted)` des signalements reels et predits par division.
+        `cube`: `CountCube` sur la periode de test
+        `model`: fonction de prediction (voir `load_model`)
+        `chunk_size`: None (un mois a la fois) ou nombre de divisions
+        predites a la fois"""
+
+    map_size = cube.map_size
+    chunk_size = map_size if chunk_size is None else chunk_size
+
+    for i, date in enumerate(cube.dates):
+        predicted = np.zeros(map_size, dtype=cube.counts.dtype)
+        with stage('prediction', divisions=map_size):
+            for start in range(0, map_size, chunk_size):
+                end = min(start+chunk_size, map_size)
+                X = cube.features(np.arange(i*map_size + start,
+                                            i*map_size + end))
+                # nombres de signalements (arrondis pour les regressions,
+                # type elargi si une prediction le depasse)
+                predicted = set_row(predicted, slice(start, end),
+                                    round_counts(model(X)))
+
+        yield date, cube.month_dense(i).ravel(), predicted
+
+
+def record_months(months, predicted_file, cube, recorded):
+    """Copie les predictions de chaque mois dans le fichier `.npy`
+    `predicted_file` (tableau `(nb_mois, nb_divisions)` projete en memoire,
+    du type des signalements du cube, elargi si une prediction le depasse)
+    et renvoie (generateur) les triplets `(date, theory, predicted)`
+    inchanges.
+        `months`: iterable de triplets `(date, theory, predicted)`
+        `predicted_file`: chemin du fichier a creer
+        `cube`: `CountCube` sur la periode de test
+        `recorded`: liste ou est place le tableau projete en memoire (a
+        vider une fois le fichier utilise)"""
+
+    recorded[:] = [np.lib.format.open_memmap(
+        predicted_file, mode='w+', dtype=cube.counts.dtype,
+        shape=(len(cube.dates), cube.map_size))]
+    for i, (date, theory, predicted) in enumerate(months):
+        recorded[0] = widen_file(recorded[0], predicted_file,
+                                 values_max(predicted))
+        recorded[0][i] = predicted
+        yield date, theory, predicted
+
+
+def widen_file(array, path, max_value):
+    """Renvoie le tableau `.npy` projete en memoire `array`, recopie dans un
+    type plus large (meme fichier `path`) s'il ne peut pas contenir
+    `max_value`.
+        `array`: tableau projete en memoire depuis `path`
+        `path`: chemin du fichier `.npy`
+        `max_value`: valeur maximale que le tableau doit pouvoir contenir"""
+
+    dtype = np.promote_types(array.dtype, count_dtype(max_value))
+    if dtype == array.dtype:
+        return array
+
+    wide_path = f'{path}.large.npy'
+    wide = np.lib.format.open_memmap(wide_path, mode='w+', dtype=dtype,
+                                     shape=array.shape)
+    wide[...] = array
+    wide.flush()
+    os.replace(wide_path, path)
+
+    return wide
+
+
+def score_months(months, metrics, executor=None):
+    """Ajoute au fur et a mesure les scores de chaque mois et renvoie
+    (generateur) les triplets `(date, theory, predicted)` inchanges.
+        `months`: iterable de triplets `(date, theory, predicted)`
+        `metrics`: `metrics.Metrics` ou ajouter les scores
+        `executor`: None ou `Executor` a un seul thread qui calcule les
+        scores pendant que les mois suivants sont produits"""
+
+    futures = []
+    for date, theory, predicted in months:
+        if executor is None:
+            score_month(date, theory, predicted, metrics)
+        else:
+            futures.append(executor.submit(bind(score_month), date,
+                                           theory, predicted, metrics))
+        yield date, theory, predicted
+
+    for future in futures:
+        future.result()
 
-    # coefficient de pearson pour evaluer la precision du modele
-    theory2 = theory.reshape(len(dates_test), nb_div_lat * nb_div_long)
-    predicted2 = predicted.reshape(len(dates_test), nb_div_lat * nb_div_long)
-    main_r2_score = mt.r2_score(theory2, predicted2)
-    r2_score_li = [(dates_test[i], mt.r2_score(theory2[i], predicted2[i]))
-                   for i in range(len(dates_test))]
 
-    return main_r2_score, r2_score_li
+def score_month(date, theory, predicted, metrics):
+    """Ajoute les scores d'un mois.
+        `date`: couple `(annee, mois)`
+        `theory`: signalements reels par division
+        `predicted`: signalements predits par division
+        `metrics`: `metrics.Metrics` ou ajouter les scores"""
 
+    with stage('score', divisions=len(theory)):
+        metrics.add(date, theory, predicted)
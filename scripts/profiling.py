@@ -0,0 +1,206 @@
+"""Mesures des etapes de calcul.
+
+Ce module sert a mesurer (sur demande) chaque etape des calculs : temps
+ecoule, temps processeur, pic de memoire allouee pendant l'etape (au-dessus
+de la memoire allouee a son debut, suivi par `tracemalloc`) et nombre de
+lignes ou de divisions traitees. Les mesures sont transmises aux fonctions
+enregistrees avec `add_hook` (tous les threads), ou a celles du thread qui
+les a activees avec `profile`, par exemple pour les ecrire dans un fichier
+`.jsonl` (une mesure `json` par ligne). Les taches confiees a d'autres
+threads gardent les mesures du thread appelant avec `bind`. Sans fonction
+enregistree, les etapes ne mesurent rien.
+"""
+
+
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+
+# fonctions appelees avec chaque mesure de tous les threads
+hooks = []
+
+# fonctions propres a chaque thread (voir `profile` et `bind`)
+local = threading.local()
+
+# etats `[memoire au debut, pic]` des etapes en cours (voir `memory_start`)
+open_stages = []
+
+# nombre de mesures en cours qui tracent la memoire, et trace demarree par
+# ce module
+tracing = {'users': 0, 'started': False}
+memory_lock = threading.Lock()
+
+
+def start_tracing():
+    """Demarre le suivi de la memoire par `tracemalloc` (s'il n'est pas deja
+    demarre) pour une mesure de plus."""
+
+    with memory_lock:
+        if tracing['users'] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing['started'] = True
+        tracing['users'] += 1
+
+
+def stop_tracing():
+    """Arrete le suivi de la memoire quand plus aucune mesure ne l'utilise
+    (seulement s'il a ete demarre par ce module)."""
+
+    with memory_lock:
+        tracing['users'] -= 1
+        if tracing['users'] == 0 and tracing['started']:
+            tracemalloc.stop()
+            tracing['started'] = False
+
+
+def add_hook(hook):
+    """Enregistre une fonction appelee avec le dictionnaire de chaque mesure
+    (etapes de tous les threads).
+        `hook`: fonction a un argument"""
+
+    start_tracing()
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Retire une fonction enregistree avec `add_hook`.
+        `hook`: fonction a retirer"""
+
+    hooks.remove(hook)
+    stop_tracing()
+
+
+def thread_hooks():
+    """Renvoie la liste des fonctions de mesure du thread courant."""
+
+    return getattr(local, 'hooks', [])
+
+
+def bind(function):
+    """Renvoie `function` executee avec les fonctions de mesure du thread
+    appelant, pour une tache confiee a un autre thread.
+        `function`: fonction a executer dans un autre thread"""
+
+    bound = thread_hooks()
+    if not bound:
+        return function
+
+    def run(*args, **kwargs):
+        previous = thread_hooks()
+        local.hooks = bound
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.hooks = previous
+
+    return run
+
+
+def memory_start():
+    """Commence le suivi du pic de memoire d'une etape et renvoie son etat
+    `[memoire au debut, pic]` (None si la memoire n'est pas suivie)."""
+
+    with memory_lock:
+        if not tracemalloc.is_tracing():
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        # pic commun remis a zero : reporte d'abord dans les etapes en cours
+        for state in open_stages:
+            state[1] = max(state[1], peak)
+        tracemalloc.reset_peak()
+        state = [current, current]
+        open_stages.append(state)
+
+    return state
+
+
+def memory_end(state):
+    """Termine le suivi d'une etape et renvoie le pic de memoire allouee
+    pendant l'etape au-dessus de celle allouee a son debut (en octets, None
+    si la memoire n'est pas suivie). Les allocations des autres threads
+    faites pendant l'etape y sont comptees.
+        `state`: etat renvoye par `memory_start`"""
+
+    if state is None:
+        return None
+
+    with memory_lock:
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            for other in open_stages:
+                other[1] = max(other[1], peak)
+        open_stages[:] = [other for other in open_stages
+                          if other is not state]
+
+    return state[1] - state[0]
+
+
+@contextmanager
+def stage(name, **counts):
+    """Mesure une etape de calcul (bloc `with`). Le dictionnaire renvoye
+    contient les nombres d'elements traites et peut etre complete dans le
+    bloc ; la mesure est transmise aux fonctions enregistrees a la fin du
+    bloc.
+        `name`: nom de l'etape
+        `counts`: nombres d'elements traites (lignes, divisions...)"""
+
+    stage_hooks = hooks + thread_hooks()
+    if not stage_hooks:
+        yield counts
+        return
+
+    start_time = time.time()
+    memory = memory_start()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield counts
+    finally:
+        # etape retiree des etapes en cours meme si le bloc echoue
+        memory_peak = memory_end(memory)
+    record = {'etape': name,
+              'debut': start_time,
+              'duree': time.perf_counter() - start,
+              'cpu': time.process_time() - start_cpu,
+              'memoire_pic': memory_peak,
+              'thread': threading.current_thread().name,
+              **counts}
+
+    for hook in stage_hooks:
+        hook(record)
+
+
+class JsonLinesWriter:
+    """Fonction de mesure (voir `add_hook`) qui ajoute chaque mesure a la
+    fin d'un fichier `.jsonl`.
+        `path`: chemin du fichier"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=int) + '\n'
+        with self.lock, open(self.path, 'a') as file:
+            file.write(line)
+
+
+@contextmanager
+def profile(path):
+    """Ecrit dans le fichier `path` les mesures de toutes les etapes faites
+    dans le bloc `with` par le thread courant (et par les taches qu'il confie
+    a d'autres threads avec `bind`).
+        `path`: chemin du fichier `.jsonl`"""
+
+    writer = JsonLinesWriter(path)
+    previous = thread_hooks()
+    local.hooks = previous + [writer]
+    start_tracing()
+    try:
+        yield writer
+    finally:
+        local.hooks = previous
+        stop_tracing()
@@ -0,0 +1,122 @@
+"""Cache des resultats.
+
+Ce module sert a conserver sur le disque les resultats deja calcules
+(modeles entraines, predictions, scores) dans des repertoires nommes par une
+empreinte de toutes les donnees et de tous les parametres qui les ont
+produits. Un calcul deja fait avec les memes entrees est ainsi retrouve sans
+etre refait. Les entrees les moins recemment utilisees sont supprimees quand
+le cache depasse sa taille maximale.
+"""
+
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+
+
+# version du calcul des resultats, a incrementer quand il change (les
+# resultats deja stockes ne sont alors plus utilises)
+CACHE_VERSION = 8
+
+# taille maximale par defaut du cache (en octets)
+MAX_SIZE = 1 << 30
+
+# empreintes des fichiers deja calculees (par chemin, taille et date)
+file_digests = {}
+
+
+def file_digest(path):
+    """Renvoie l'empreinte `sha1` du contenu d'un fichier (calculee une seule
+    fois tant que le fichier n'est pas modifie).
+        `path`: chemin du fichier"""
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in file_digests:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        file_digests[key] = digest.hexdigest()
+
+    return file_digests[key]
+
+
+def content_key(*values):
+    """Renvoie l'empreinte d'un ensemble d'entrees serialisables en json.
+        `values`: donnees et parametres identifiant un resultat"""
+
+    text = json.dumps((CACHE_VERSION, values), sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def lookup(cache_dir, key):
+    """Renvoie le repertoire du resultat `key` s'il est dans le cache (et le
+    marque comme utilise), None sinon.
+        `cache_dir`: repertoire du cache des resultats
+        `key`: empreinte des entrees (voir `content_key`)"""
+
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    os.utime(path)
+
+    return path
+
+
+def store(cache_dir, key, files, max_size=MAX_SIZE):
+    """Ajoute un resultat au cache et renvoie son repertoire.
+        `cache_dir`: repertoire du cache des resultats
+        `key`: empreinte des entrees (voir `content_key`)
+        `files`: dictionnaire `{nom: chemin}` des fichiers a copier dans le
+        cache, ou `{nom: objet}` pour les objets a ecrire en json (`.json`)
+        `max_size`: taille maximale du cache (en octets)"""
+
+    path = os.path.join(cache_dir, key)
+    # nom propre au processus et au thread (ecritures concurrentes)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    try:
+        for name, value in files.items():
+            if name.endswith('.json'):
+                with open(os.path.join(tmp_path, name), 'w') as file:
+                    json.dump(value, file)
+            else:
+                shutil.copyfile(value, os.path.join(tmp_path, name))
+        # ecriture atomique (un autre processus a pu stocker le meme resultat)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    evict(cache_dir, max_size)
+
+    return path
+
+
+def evict(cache_dir, max_size):
+    """Supprime les resultats les moins recemment utilises jusqu'a ce que le
+    cache ne depasse plus `max_size` octets.
+        `cache_dir`: repertoire du cache des resultats
+        `max_size`: taille maximale du cache (en octets)"""
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.tmp') or not os.path.isdir(path):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(path))
+        entries.append((os.stat(path).st_mtime, size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
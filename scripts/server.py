@@ -0,0 +1,287 @@
+"""Service de predictions.
+
+Ce module sert a lancer un serveur HTTP local qui garde en memoire les
+modeles charges, les cubes de signalements discretises, les predictions et
+les scores deja calcules (dans la limite de quelques elements de chaque
+sorte, les moins recemment utilises etant oublies). Il repond sans relancer
+Python ni rediscretiser les signalements a des requetes `json` (une requete
+ou une liste de requetes par appel `POST`) :
+- `predictions` : signalements predits par division pour un mois ;
+- `scores` : scores des predictions sur une periode (voir `metrics`) ;
+- `carte` : image comparant predictions et signalements reels sur une
+periode (PNG encode en base64).
+Les modeles par tuile (`_tuiles.joblib`, voir `tiles`) sont aussi servis.
+
+Exemple de requete :
+    {"type": "scores", "modele": "modele_01", "grille": [120, 120],
+     "debut": [20, 11], "fin": [21, 10]}
+"""
+
+
+import io
+import os
+import json
+import base64
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import predictions
+from predictions import make_cube, load_model, iter_predictions
+from tiles import iter_tile_predictions
+from metrics import Metrics
+from create_maps import iter_periods, render_comparative
+from profiling import stage
+from dtypes import set_row
+
+
+
+# nombres maximaux de modeles, de cubes, de predictions et de scores gardes
+# en memoire
+MODELS_MAX = 8
+CUBES_MAX = 8
+PREDICTIONS_MAX = 16
+SCORES_MAX = 64
+
+# fichiers d'un modele utilises pour les predictions, dans l'ordre de
+# recherche (`_tuiles.joblib` : un modele par tuile, voir `tiles.save_bundle`)
+MODEL_EXTS = ('.npy', '.joblib', '_tuiles.joblib')
+
+
+class LRUCache:
+    """Dictionnaire de taille limitee partage entre les threads du serveur :
+    l'element le moins recemment utilise est oublie en premier.
+        `max_size`: nombre maximal d'elements"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """Renvoie l'element `key`, calcule avec `load()` s'il n'est pas
+        en memoire (hors du verrou : deux threads peuvent le calculer en meme
+        temps, le dernier est garde).
+            `key`: cle de l'element
+            `load`: fonction sans argument qui calcule l'element"""
+
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+        value = load()
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self.items)
+
+
+models = LRUCache(MODELS_MAX)
+cubes = LRUCache(CUBES_MAX)
+predicted = LRUCache(PREDICTIONS_MAX)
+scored = LRUCache(SCORES_MAX)
+
+
+def model_key(model_name):
+    """Renvoie la cle d'un modele : son nom, l'extension et la date de
+    modification du fichier utilise pour les predictions (un modele
+    reentraine est recharge). Un modele par tuile n'est utilise que s'il
+    n'existe pas de modele unique du meme nom.
+        `model_name`: nom du modele"""
+
+    model_file = os.path.join(predictions.model_path, model_name)
+    for ext in MODEL_EXTS:
+        if os.path.exists(model_file + ext):
+            return model_name, ext, os.stat(model_file + ext).st_mtime_ns
+
+    raise ValueError(f'Modele introuvable : {model_name}')
+
+
+def query_window(query):
+    """Renvoie le couple `((annee, mois), (annee, mois))` de la periode d'une
+    requete (`mois` pour un seul mois, ou `debut` et `fin`).
+        `query`: dictionnaire de la requete"""
+
+    if 'mois' in query:
+        return tuple(query['mois']), tuple(query['mois'])
+
+    return tuple(query['debut']), tuple(query['fin'])
+
+
+def query_predictions(query):
+    """Renvoie le triplet `(cube, predicted, key)` du cube des signalements
+    reels de la periode d'une requete, du tableau `(nb_pas_de_temps,
+    nb_divisions)` des predictions (depuis la memoire si possible) et de la
+    cle de ces predictions.
+        `query`: dictionnaire de la requete"""
+
+    nb_div_long, nb_div_lat = query['grille']
+    map_info = (nb_div_long, nb_div_lat, query.get('pixels', 4))
+    window = query_window(query)
+    lyme = bool(query.get('lyme', False))
+    lags = bool(query.get('variables_decalees', False))
+    step = query.get('pas_de_temps', 'mois')
+
+    cube_key = (nb_div_long, nb_div_lat, window, lyme, lags, step)
+    cube = cubes.get(cube_key, lambda: make_cube(map_info, window, lyme,
+                                                 lags=lags, step=step)[0])
+
+    key = model_key(query['modele'])
+    if key[1] == '_tuiles.joblib':
+        # modeles des tuiles charges par les processus de prediction
+        bundle_file = os.path.join(predictions.model_path,
+                                   query['modele'] + key[1])
+        iter_months = lambda: iter_tile_predictions(cube, bundle_file)
+    else:
+        model = models.get(key, lambda: load_model(query['modele']))
+        iter_months = lambda: iter_predictions(cube, model)
+
+    def predict_all():
+        values = np.zeros((len(cube.dates), cube.map_size),
+                          dtype=cube.counts.dtype)
+        for i, (_, _, month) in enumerate(iter_months()):
+            values = set_row(values, i, month)
+        return values
+
+    return cube, predicted.get((key, cube_key), predict_all), (key, cube_key)
+
+
+def answer_predictions(query):
+    """Repond a une requete `predictions` : signalements predits (et reels)
+    par division pour chaque pas de temps de la periode."""
+
+    cube, values, _ = query_predictions(query)
+
+    return {'dates': cube.dates.tolist(),
+            'predictions': values.tolist(),
+            'signalements': [cube.month_dense(i).ravel().tolist()
+                             for i in range(len(cube.dates))]}
+
+
+def answer_scores(query):
+    """Repond a une requete `scores` : scores des predictions sur la periode
+    (voir `metrics.Metrics.result`)."""
+
+    cube, values, key = query_predictions(query)
+
+    def score_all():
+        metrics = Metrics((cube.nb_div_long, cube.nb_div_lat))
+        for i, date in enumerate(cube.dates):
+            metrics.add(date, cube.month_dense(i).ravel(), values[i])
+        return metrics.result()
+
+    return scored.get(key, score_all)
+
+
+def answer_map(query):
+    """Repond a une requete `carte` : image comparant les signalements reels
+    et predits, rassembles par periodes de `periode` mois (PNG en base64)."""
+
+    cube, values, _ = query_predictions(query)
+    map_info = (cube.nb_div_long, cube.nb_div_lat, query.get('pixels', 4))
+    period = query.get('periode', 1)
+
+    months = ((date, (cube.month_dense(i).ravel(), values[i]))
+              for i, date in enumerate(cube.dates))
+    sglmts1, sglmts2, dates = [], [], []
+    for dates_prd, (sglmts1_prd, sglmts2_prd) in iter_periods(months, period):
+        dates.append(dates_prd)
+        sglmts1.append(sglmts1_prd)
+        sglmts2.append(sglmts2_prd)
+
+    image = render_comparative(sglmts1, sglmts2, map_info, dates, period)
+    with stage('encodage', pixels=image.size[0]*image.size[1]):
+        buffer = io.BytesIO()
+        image.save(buffer, format='png')
+
+    return {'png': base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+
+# fonction de reponse de chaque type de requete
+ANSWERS = {'predictions': answer_predictions,
+           'scores': answer_scores,
+           'carte': answer_map}
+
+
+def answer(query):
+    """Renvoie la reponse a une requete, ou `{'erreur': message}` si elle est
+    invalide ou si son calcul echoue.
+        `query`: dictionnaire de la requete"""
+
+    try:
+        if query.get('type') not in ANSWERS:
+            raise ValueError(f'Type de requete inconnu : {query.get("type")} '
+                             f'(types disponibles : {", ".join(ANSWERS)})')
+        with stage('requete', type=query['type']):
+            return ANSWERS[query['type']](query)
+    except Exception as error:
+        # une requete en erreur n'interrompt pas les autres requetes de la
+        # liste
+        return {'erreur': f'{type(error).__name__}: {error}'}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Traitement des appels HTTP : `GET` renvoie l'etat du serveur, `POST`
+    une requete (objet `json`) ou une liste de requetes."""
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json(200, {'modeles': len(models), 'cubes': len(cubes),
+                             'predictions': len(predicted),
+                             'scores': len(scored)})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            queries = json.loads(self.rfile.read(length))
+        except ValueError as error:
+            self.send_json(400, {'erreur': f'json invalide : {error}'})
+            return
+
+        if isinstance(queries, list):
+            self.send_json(200, [answer(query) for query in queries])
+        elif isinstance(queries, dict):
+            self.send_json(200, answer(queries))
+        else:
+            self.send_json(400, {'erreur': 'objet ou liste attendu'})
+
+
+def serve(host='127.0.0.1', port=8000):
+    """Lance le serveur (jusqu'a son interruption).
+        `host`: adresse d'ecoute (locale par defaut)
+        `port`: port d'ecoute"""
+
+    predictions.ensure_constants()
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serveur de predictions sur http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hote', default='127.0.0.1',
+                        help='adresse d\'ecoute')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port d\'ecoute')
+    args = parser.parse_args()
+
+    serve(args.hote, args.port)
@@ -0,0 +1,726 @@
+"""Cache binaire des signalements.
+
+Ce module sert a stocker les colonnes du fichier `.csv` des signalements dans
+un format binaire en colonnes (un fichier brut par colonne, lisible avec
+`numpy.memmap`) ainsi que les indices discretises pour chaque grille et
+chaque pas de temps (mois, semaine, jour...) et la region de chaque division
+pour chaque grille, afin de ne plus relire ni rediscretiser le
+fichier `.csv` a chaque execution.
+
+Le cache est invalide si le fichier source change (date de modification puis
+empreinte du contenu) ou si les valeurs de `constants.json` utilisees (chemin,
+delimiteur, bordures) changent. Les nouveaux signalements ajoutes a la fin du
+fichier peuvent etre integres sans tout recalculer (voir `ingest`).
+"""
+
+
+import io
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+
+
+# version du format, a incrementer si la structure du cache ou la
+# discretisation change
+CACHE_VERSION = 4
+
+# colonnes conservees et leur type binaire
+COLUMNS = {'ref': np.int64, 'day': np.uint8, 'rel_month': np.int32,
+           'lat': np.float64, 'long': np.float64}
+
+# colonnes attendues dans le fichier `.csv` des signalements
+CSV_COLUMNS = ['ref', 'day', 'month', 'year', 'lat', 'long']
+
+# pas de temps nommes et leur duree en jours (`'mois'` : duree variable)
+STEPS = {'mois': None, 'semaine': 7, 'jour': 1}
+
+# taille de la fin de fichier dont on garde l'empreinte pour verifier qu'un
+# fichier n'a ete modifie que par ajout de lignes
+TAIL_SIZE = 1 << 16
+
+
+def file_digest(path, start=0, end=None):
+    """Renvoie l'empreinte `sha1` du contenu (ou d'une partie) d'un fichier.
+        `path`: chemin du fichier
+        `start` & `end`: None ou bornes (en octets) de la partie a lire"""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = -1 if end is None else end - start
+        while remaining != 0:
+            block = file.read(1 << 20 if remaining < 0
+                              else min(1 << 20, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining = remaining - len(block) if remaining > 0 else remaining
+
+    return digest.hexdigest()
+
+
+def key_digest(*values):
+    """Renvoie une cle courte a partir de valeurs serialisables en json.
+        `values`: valeurs identifiant une entree du cache"""
+
+    text = json.dumps([CACHE_VERSION, *values], sort_keys=True)
+
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def validate_rows(sglmt_data):
+    """Verifie les lignes lues dans un fichier de signalements et leve une
+    `ValueError` si elles sont invalides.
+        `sglmt_data`: `pandas.DataFrame` des signalements"""
+
+    missing = set(CSV_COLUMNS) - set(sglmt_data.columns)
+    if missing:
+        raise ValueError(f'Colonnes manquantes : {sorted(missing)}')
+    if sglmt_data[CSV_COLUMNS].isna().any().any():
+        raise ValueError('Valeurs manquantes dans les signalements')
+
+    checks = {'day': (1, 31), 'month': (1, 12), 'year': (2000, 2099),
+              'lat': (-90, 90), 'long': (-180, 180)}
+    for column, (low, high) in checks.items():
+        values = sglmt_data[column]
+        if ((values < low) | (values > high)).any():
+            raise ValueError(f'Valeurs de `{column}` hors de [{low}, {high}]')
+
+
+def to_columns(sglmt_data):
+    """Renvoie le dictionnaire de tableaux `numpy` (une entree par colonne de
+    `COLUMNS`) d'une `pandas.DataFrame` de signalements, avec les dates
+    simplifiees en mois relatifs (numero du mois depuis janvier 2000).
+        `sglmt_data`: `pandas.DataFrame` des signalements"""
+
+    rel_month = (sglmt_data['year'].to_numpy() - 2000)*12 \
+        + sglmt_data['month'].to_numpy()
+
+    return {'ref': sglmt_data['ref'].to_numpy(dtype=COLUMNS['ref']),
+            'day': sglmt_data['day'].to_numpy(dtype=COLUMNS['day']),
+            'rel_month': rel_month.astype(COLUMNS['rel_month']),
+            'lat': sglmt_data['lat'].to_numpy(dtype=COLUMNS['lat']),
+            'long': sglmt_data['long'].to_numpy(dtype=COLUMNS['long'])}
+
+
+def read_columns(source_file):
+    """Lit le fichier `.csv` des signalements et renvoie ses colonnes (voir
+    `to_columns`).
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements"""
+
+    data_path, data_delim = source_file
+
+    return to_columns(pd.read_csv(data_path, delimiter=data_delim))
+
+
+def step_days(step):
+    """Renvoie la duree en jours d'un pas de temps (None pour `'mois'`) et
+    leve une `ValueError` s'il est invalide.
+        `step`: `'mois'`, `'semaine'` (semaines ISO, du lundi au dimanche),
+        `'jour'` ou nombre de jours"""
+
+    if isinstance(step, str):
+        if step not in STEPS:
+            raise ValueError(f'Pas de temps inconnu : {step} (pas '
+                             f'disponibles : {", ".join(STEPS)} ou un nombre '
+                             f'de jours)')
+        return STEPS[step]
+    if int(step) != step or step < 1:
+        raise ValueError(f'Nombre de jours invalide : {step}')
+
+    return int(step)
+
+
+def month_first_day(rel_month):
+    """Renvoie le numero (jour depuis le 1er janvier 2000) du premier jour
+    de chaque mois relatif.
+        `rel_month`: tableau de mois relatifs"""
+
+    months = np.datetime64('2000-01', 'M') + np.asarray(rel_month) - 1
+
+    return (months.astype('datetime64[D]')
+            - np.datetime64('2000-01-01', 'D')).astype(np.int64)
+
+
+def first_step_day(rel_month_min, step):
+    """Renvoie le numero du premier jour du premier pas de temps d'une
+    periode (le premier lundi de la periode pour les semaines, pour ne
+    garder que des semaines entieres).
+        `rel_month_min`: premier mois relatif de la periode
+        `step`: pas de temps (voir `step_days`)"""
+
+    day = int(month_first_day(rel_month_min))
+    if step == 'semaine':
+        # le 1er janvier 2000 etait un samedi
+        day += -(day + 5) % 7
+
+    return day
+
+
+def step_count(rel_months, step):
+    """Renvoie le nombre de pas de temps entiers d'une periode : les jours du
+    debut (avant le premier lundi) et de la fin de la periode qui ne forment
+    pas un pas de temps entier sont ignores.
+        `rel_months`: couple sur le premier et dernier mois relatif etudie
+        `step`: pas de temps (voir `step_days`)"""
+
+    length = step_days(step)
+    if length is None:
+        return rel_months[1] - rel_months[0] + 1
+
+    end = int(month_first_day(rel_months[1] + 1))
+
+    return max(0, (end - first_step_day(rel_months[0], step)) // length)
+
+
+def time_bins(rel_month, day, rel_month_min, step='mois'):
+    """Renvoie le numero du pas de temps de chaque signalement depuis le
+    debut de la periode.
+        `rel_month`: tableau des mois relatifs des signalements
+        `day`: tableau des jours du mois des signalements
+        `rel_month_min`: premier mois relatif de la periode
+        `step`: pas de temps (voir `step_days`)"""
+
+    length = step_days(step)
+    rel_month = np.asarray(rel_month).astype(np.int64)
+    if length is None:
+        return rel_month - rel_month_min
+
+    # jours hors du mois (31 avril...) ramenes au dernier jour du mois
+    first = month_first_day(rel_month)
+    days = np.minimum(first + np.asarray(day, dtype=np.int64) - 1,
+                      month_first_day(rel_month + 1) - 1)
+
+    return (days - first_step_day(rel_month_min, step)) // length
+
+
+def bin_columns(columns, bounds, map_info, rel_months, step='mois'):
+    """Discretise les signalements et renvoie le couple `(indices, rows)` des
+    signalements de la periode situes dans les bordures et dans un pas de
+    temps entier (voir `step_count`), ou `indices` donne la combinaison de
+    pas de temps et de zone de chaque signalement et `rows` sa ligne dans
+    les colonnes.
+        `columns`: dictionnaire des colonnes (voir `read_columns`)
+        `bounds`: quadruplet `(long_min, long_max, lat_min, lat_max)` sur
+        les bordures des cartes
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `rel_months`: couple sur le premier et dernier mois relatif etudie
+        `step`: pas de temps (voir `step_days`)"""
+
+    long_min, long_max, lat_min, lat_max = bounds
+    nb_div_long, nb_div_lat = map_info
+    rel_month_min, rel_month_max = rel_months
+
+    # selection des donnees utiles uniquement
+    rel_month = np.asarray(columns['rel_month'])
+    rows = np.flatnonzero((rel_month >= rel_month_min)
+                          & (rel_month <= rel_month_max))
+
+    # discretisation des coordonnees gps
+    lat_unit = nb_div_lat/(lat_max - lat_min)
+    lat = np.floor((columns['lat'][rows] - lat_min) * lat_unit)
+    long_unit = nb_div_long/(long_max - long_min)
+    long = np.floor((columns['long'][rows] - long_min) * long_unit)
+
+    # signalements hors des bordures ignores (ils tomberaient sinon dans une
+    # autre ligne ou un autre pas de temps)
+    keep = (lat >= 0) & (lat < nb_div_lat) & (long >= 0) & (long < nb_div_long)
+    rows, lat, long = rows[keep], lat[keep], long[keep]
+
+    # signalements des pas de temps incomplets (debut et fin de periode)
+    # ignores
+    steps = time_bins(rel_month[rows], np.asarray(columns['day'])[rows],
+                      rel_month_min, step)
+    keep = (steps >= 0) & (steps < step_count(rel_months, step))
+    rows, lat, long, steps = rows[keep], lat[keep], long[keep], steps[keep]
+
+    # indice des combinaisons de pas de temps et de zone
+    indices = (steps*nb_div_lat*nb_div_long
+               + lat.astype(np.int64)*nb_div_long
+               + long.astype(np.int64))
+
+    return indices, rows.astype(np.int64)
+
+
+def read_regions(regions_file):
+    """Lit le fichier `.csv` des regions et renvoie le couple `(ref,
+    region)` de tableaux `numpy`.
+        `regions_file`: couple `(regions_path, delim)` sur le fichier de
+        regions"""
+
+    region_path, region_delim = regions_file
+    regions = pd.read_csv(region_path, delimiter=region_delim)
+    regions = regions.dropna(subset=['region'])
+
+    return (regions['ref'].to_numpy(dtype=np.int64),
+            regions['region'].to_numpy(dtype=str))
+
+
+def join_regions(ref, regions, names=None):
+    """Renvoie le couple `(codes, names)` ou `codes` donne pour chaque
+    signalement l'indice de sa region dans `names` (la premiere trouvee dans
+    le fichier de regions), `-1` si sa region est inconnue.
+        `ref`: tableau des references des signalements
+        `regions`: couple `(ref, region)` (voir `read_regions`)
+        `names`: None ou liste des noms de regions deja codes (completee
+        par les nouvelles regions)"""
+
+    regions_ref, regions_name = regions
+    names = [] if names is None else list(names)
+    names += sorted(set(regions_name) - set(names))
+    name_codes = {name: code for code, name in enumerate(names)}
+
+    # premiere region de chaque reference
+    uniques, first = np.unique(regions_ref, return_index=True)
+    first_codes = np.array([name_codes[name] for name in regions_name[first]],
+                           dtype=np.int8)
+
+    ref = np.asarray(ref)
+    codes = np.full(len(ref), -1, dtype=np.int8)
+    if len(uniques) > 0:
+        pos = np.minimum(np.searchsorted(uniques, ref), len(uniques)-1)
+        found = uniques[pos] == ref
+        codes[found] = first_codes[pos[found]]
+
+    return codes, names
+
+
+def region_raster(columns, codes, bounds, map_info):
+    """Renvoie le tableau (taille `nb_div_lat*nb_div_long`) du code de region
+    de chaque division : la region la plus frequente parmi les signalements
+    de la division (tous mois confondus), ou celle de la division non vide la
+    plus proche pour les divisions sans signalement (`-1` si aucune region
+    n'est connue).
+        `columns`: dictionnaire des colonnes (voir `read_columns`)
+        `codes`: code de region de chaque signalement (voir `join_regions`)
+        `bounds`: quadruplet sur les bordures des cartes
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes"""
+
+    long_min, long_max, lat_min, lat_max = bounds
+    nb_div_long, nb_div_lat = map_info
+    map_size = nb_div_lat*nb_div_long
+
+    # division de chaque signalement de region connue dans la carte
+    codes = np.asarray(codes)
+    lat = np.floor((columns['lat'] - lat_min) * nb_div_lat/(lat_max - lat_min))
+    long = np.floor((columns['long'] - long_min)
+                    * nb_div_long/(long_max - long_min))
+    keep = ((codes >= 0) & (lat >= 0) & (lat < nb_div_lat)
+            & (long >= 0) & (long < nb_div_long))
+    cells = (lat[keep].astype(np.int64)*nb_div_long
+             + long[keep].astype(np.int64))
+
+    # region majoritaire de chaque division (la premiere en cas d'egalite)
+    nb_codes = int(codes.max()) + 1 if len(codes) else 0
+    counts = np.bincount(cells*nb_codes + codes[keep],
+                         minlength=map_size*nb_codes)
+    counts = counts.reshape(map_size, nb_codes)
+    raster = np.full(map_size, -1, dtype=np.int8)
+    filled = counts.sum(axis=1) > 0
+    raster[filled] = counts[filled].argmax(axis=1)
+
+    return fill_nearest(raster.reshape(nb_div_lat, nb_div_long)).ravel()
+
+
+def fill_nearest(raster):
+    """Complete les divisions sans region (`-1`) avec la region d'une division
+    voisine, de proche en proche (distance en nombre de divisions, voisins
+    parcourus dans un ordre fixe).
+        `raster`: tableau `(nb_div_lat, nb_div_long)` des codes de region"""
+
+    raster = raster.copy()
+    if not (raster >= 0).any():
+        return raster
+
+    neighbours = [(-1, 0), (1, 0), (0, -1), (0, 1),
+                  (-1, -1), (-1, 1), (1, -1), (1, 1)]
+    while (raster < 0).any():
+        padded = np.pad(raster, 1, constant_values=-1)
+        grown = raster.copy()
+        for d_lat, d_long in neighbours:
+            shifted = padded[1+d_lat:padded.shape[0]-1+d_lat,
+                             1+d_long:padded.shape[1]-1+d_long]
+            empty = (grown < 0) & (shifted >= 0)
+            grown[empty] = shifted[empty]
+        raster = grown
+
+    return raster
+
+
+def temp_path(path, suffix='.tmp'):
+    """Renvoie le nom du fichier temporaire ecrit avant de remplacer `path`,
+    propre au processus et au thread (les threads du serveur peuvent ecrire
+    le meme fichier en meme temps).
+        `path`: chemin du fichier a creer
+        `suffix`: extension du fichier temporaire"""
+
+    return f'{path}.{os.getpid()}.{threading.get_ident()}{suffix}'
+
+
+def write_array(path, array):
+    """Ecrit un tableau en binaire brut de maniere atomique.
+        `path`: chemin du fichier a creer
+        `array`: tableau `numpy` a ecrire"""
+
+    tmp_path = temp_path(path)
+    np.ascontiguousarray(array).tofile(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def append_array(path, array):
+    """Ajoute un tableau a la fin d'un fichier binaire brut.
+        `path`: chemin du fichier
+        `array`: tableau `numpy` a ajouter"""
+
+    with open(path, 'ab') as file:
+        np.ascontiguousarray(array).tofile(file)
+
+
+def read_array(path, dtype):
+    """Projette en memoire (lecture seule) un tableau binaire brut.
+        `path`: chemin du fichier
+        `dtype`: type des elements"""
+
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def source_dir(source_file, cache_dir):
+    """Renvoie le repertoire du cache associe a un fichier de signalements.
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements
+        `cache_dir`: repertoire racine du cache"""
+
+    data_path, data_delim = source_file
+    key = key_digest(os.path.abspath(data_path), data_delim)
+
+    return os.path.join(cache_dir, f'sglmt_{key}')
+
+
+def source_meta(path):
+    """Renvoie les metadonnees (taille, date, empreintes) d'un fichier.
+        `path`: chemin du fichier"""
+
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': file_digest(path),
+            'tail_sha1': file_digest(path, max(0, stat.st_size-TAIL_SIZE),
+                                     stat.st_size)}
+
+
+def check_source(source_file, meta):
+    """Verifie que les metadonnees du cache correspondent toujours au fichier
+    source, et les met a jour si seule la date de modification a change.
+    Renvoie `True` si le cache est valide.
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements
+        `meta`: dictionnaire des metadonnees du cache"""
+
+    stat = os.stat(source_file[0])
+    if meta.get('version') != CACHE_VERSION or meta['size'] != stat.st_size:
+        return False
+    if meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+
+    # date modifiee : on compare le contenu (inconnu apres un ajout)
+    if meta['sha1'] is None or meta['sha1'] != file_digest(source_file[0]):
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+
+    return True
+
+
+def read_meta(directory):
+    """Renvoie les metadonnees d'un repertoire du cache (None s'il n'y en a
+    pas).
+        `directory`: repertoire du cache d'un fichier de signalements"""
+
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as file:
+        return json.load(file)
+
+
+def write_meta(directory, meta):
+    """Ecrit les metadonnees d'un repertoire du cache de maniere atomique.
+        `directory`: repertoire du cache d'un fichier de signalements
+        `meta`: dictionnaire des metadonnees"""
+
+    meta_path = os.path.join(directory, 'meta.json')
+    tmp_path = temp_path(meta_path)
+    with open(tmp_path, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, meta_path)
+
+
+def load_columns(source_file, cache_dir):
+    """Renvoie les colonnes des signalements projetees en memoire depuis le
+    cache, en (re)construisant le cache si necessaire.
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements
+        `cache_dir`: repertoire racine du cache"""
+
+    directory = source_dir(source_file, cache_dir)
+
+    meta = read_meta(directory)
+    if meta is not None:
+        mtime_ns = meta.get('mtime_ns')
+        if not check_source(source_file, meta):
+            meta = None
+        elif meta['mtime_ns'] != mtime_ns:
+            write_meta(directory, meta)
+
+    if meta is None:
+        # (re)construction du cache
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        columns = read_columns(source_file)
+        for name, column in columns.items():
+            write_array(os.path.join(directory, name + '.bin'), column)
+        meta = {'version': CACHE_VERSION, **source_meta(source_file[0]),
+                'nb_rows': len(columns['ref'])}
+        write_meta(directory, meta)
+
+    return {name: read_array(os.path.join(directory, name + '.bin'), dtype)
+            for name, dtype in COLUMNS.items()}
+
+
+def load_binned(bounds, source_file, map_info, rel_months, cache_dir,
+                step='mois'):
+    """Renvoie le couple `(indices, rows)` des signalements discretises (voir
+    `bin_columns`) depuis le cache, en le construisant si necessaire.
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `rel_months`: couple sur le premier et dernier mois relatif etudie
+        `cache_dir`: repertoire racine du cache
+        `step`: pas de temps (voir `step_days`)"""
+
+    columns = load_columns(source_file, cache_dir)
+
+    directory = source_dir(source_file, cache_dir)
+    params = {'bounds': list(bounds), 'map_info': list(map_info),
+              'rel_months': list(rel_months)}
+    if step != 'mois':
+        # cle inchangee pour les grilles mensuelles deja en cache
+        params['step'] = step
+    path = os.path.join(directory, f'grille_{key_digest(params)}')
+
+    if not os.path.exists(path + '.json'):
+        indices, rows = bin_columns(columns, bounds, map_info, rel_months,
+                                    step)
+        write_array(path + '_rows.bin', rows)
+        write_array(path + '_indices.bin', indices)
+        # parametres gardes pour mettre a jour la grille (voir `ingest`)
+        with open(path + '.json', 'w') as file:
+            json.dump(params, file)
+
+    return (read_array(path + '_indices.bin', np.int64),
+            read_array(path + '_rows.bin', np.int64))
+
+
+def load_regions(source_file, regions_file, cache_dir):
+    """Renvoie le couple `(codes, names)` des regions de chaque signalement
+    (voir `join_regions`) depuis le cache, en le construisant si necessaire.
+        `source_file`: couple sur le fichier de signalements
+        `regions_file`: couple `(regions_path, delim)` sur le fichier de
+        regions
+        `cache_dir`: repertoire racine du cache"""
+
+    columns = load_columns(source_file, cache_dir)
+
+    directory = source_dir(source_file, cache_dir)
+    meta = read_meta(directory)
+    stat = os.stat(regions_file[0])
+    regions_meta = {'path': os.path.abspath(regions_file[0]),
+                    'delim': regions_file[1], 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns}
+    path = os.path.join(directory, 'region.bin')
+
+    cached = meta.get('regions')
+    if cached is None or cached['file'] != regions_meta \
+            or not os.path.exists(path):
+        codes, names = join_regions(columns['ref'],
+                                    read_regions(regions_file))
+        write_array(path, codes)
+        if cached is not None:
+            # regions modifiees (sans regions en cache, aucune carte deduite
+            # n'existe encore : rien a supprimer sous les autres threads)
+            remove_derived(directory)
+        meta['regions'] = {'file': regions_meta, 'names': names}
+        write_meta(directory, meta)
+        cached = meta['regions']
+
+    return read_array(path, np.int8), cached['names']
+
+
+def load_raster(bounds, source_file, regions_file, map_info, cache_dir):
+    """Renvoie le couple `(raster, names)` des codes de region de chaque
+    division (voir `region_raster`) depuis le cache, en le construisant si
+    necessaire (une seule fois par grille).
+        `bounds`: quadruplet sur les bordures des cartes
+        `source_file`: couple sur le fichier de signalements
+        `regions_file`: couple `(regions_path, delim)` sur le fichier de
+        regions
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `cache_dir`: repertoire racine du cache"""
+
+    codes, names = load_regions(source_file, regions_file, cache_dir)
+
+    directory = source_dir(source_file, cache_dir)
+    key = key_digest(list(bounds), list(map_info))
+    path = os.path.join(directory, f'raster_{key}.bin')
+
+    if not os.path.exists(path):
+        columns = load_columns(source_file, cache_dir)
+        write_array(path, region_raster(columns, codes, bounds, map_info))
+
+    return read_array(path, np.int8), names
+
+
+def remove_derived(directory):
+    """Supprime du cache les donnees deduites des signalements (cartes de
+    regions, variables decalees) a reconstruire apres une modification des
+    signalements ou des regions (les fichiers temporaires en cours
+    d'ecriture par d'autres threads sont laisses a leur auteur).
+        `directory`: repertoire du cache d'un fichier de signalements"""
+
+    for name in os.listdir(directory):
+        if name.startswith(('raster_', 'variables_')) and '.tmp' not in name:
+            os.remove(os.path.join(directory, name))
+
+
+def append_delta(source_file, delta_file):
+    """Ajoute les lignes d'un fichier de nouveaux signalements (meme format,
+    avec en-tete) a la fin du fichier de signalements.
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements
+        `delta_file`: chemin du fichier des nouveaux signalements"""
+
+    data_path, data_delim = source_file
+    with open(delta_file, 'r') as delta:
+        header = delta.readline()
+        lines = delta.read()
+    with open(data_path, 'r') as data:
+        if header.strip() != data.readline().strip():
+            raise ValueError(f'En-tete de {delta_file} different de celui '
+                             f'de {data_path}')
+
+    # verification avant toute modification du fichier de signalements
+    validate_rows(pd.read_csv(io.StringIO(header + lines),
+                              delimiter=data_delim))
+
+    with open(data_path, 'rb+') as data:
+        data.seek(0, os.SEEK_END)
+        if data.tell() > 0:
+            data.seek(-1, os.SEEK_END)
+            if data.read(1) != b'\n':
+                data.write(b'\n')
+        data.write(lines.encode())
+
+
+def ingest(source_file, cache_dir, regions_file=None, delta_file=None):
+    """Integre au cache les signalements ajoutes a la fin du fichier de
+    signalements (ou ceux d'un fichier `delta_file`, d'abord ajoutes au
+    fichier de signalements) sans relire ni rediscretiser l'historique, et
+    renvoie le nombre de signalements ajoutes. Les colonnes, les grilles deja
+    discretisees et les regions sont completees sur place. Si le debut du
+    fichier a change, le cache est entierement reconstruit.
+        `source_file`: couple `(data_path, delim)` sur le fichier de
+        signalements
+        `cache_dir`: repertoire racine du cache
+        `regions_file`: None ou couple `(regions_path, delim)` sur le fichier
+        de regions (pour les regions des nouveaux signalements)
+        `delta_file`: None ou chemin d'un fichier de nouveaux signalements"""
+
+    data_path, data_delim = source_file
+    if delta_file is not None:
+        append_delta(source_file, delta_file)
+
+    directory = source_dir(source_file, cache_dir)
+    meta = read_meta(directory)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return len(load_columns(source_file, cache_dir)['ref'])
+
+    size, nb_rows = meta['size'], meta['nb_rows']
+    stat = os.stat(data_path)
+    if stat.st_size == size and check_source(source_file, meta):
+        return 0
+
+    # le fichier doit avoir seulement grandi (fin d'origine inchangee)
+    if stat.st_size <= size or meta['tail_sha1'] != file_digest(
+            data_path, max(0, size-TAIL_SIZE), size):
+        meta['version'] = None
+        write_meta(directory, meta)
+        columns = load_columns(source_file, cache_dir)
+        return len(columns['ref']) - nb_rows
+
+    # lecture et verification des nouvelles lignes uniquement
+    with open(data_path, 'rb') as data:
+        header = data.readline()
+        data.seek(size)
+        tail = data.read(stat.st_size - size)
+    sglmt_data = pd.read_csv(io.BytesIO(header + tail), delimiter=data_delim)
+    validate_rows(sglmt_data)
+    new_columns = to_columns(sglmt_data)
+    nb_new = len(new_columns['ref'])
+
+    # ajout aux colonnes
+    for name, column in new_columns.items():
+        append_array(os.path.join(directory, name + '.bin'), column)
+
+    # ajout aux grilles deja discretisees
+    for name in os.listdir(directory):
+        if name.startswith('grille_') and name.endswith('.json'):
+            with open(os.path.join(directory, name), 'r') as file:
+                params = json.load(file)
+            indices, rows = bin_columns(new_columns, params['bounds'],
+                                        params['map_info'],
+                                        params['rel_months'],
+                                        params.get('step', 'mois'))
+            path = os.path.join(directory, name[:-len('.json')])
+            append_array(path + '_indices.bin', indices)
+            append_array(path + '_rows.bin', rows + nb_rows)
+
+    # regions des nouveaux signalements uniquement
+    regions_path = os.path.join(directory, 'region.bin')
+    if 'regions' in meta and os.path.exists(regions_path):
+        if regions_file is None:
+            os.remove(regions_path)
+            del meta['regions']
+        else:
+            codes, names = join_regions(new_columns['ref'],
+                                        read_regions(regions_file),
+                                        meta['regions']['names'])
+            append_array(regions_path, codes)
+            stat_regions = os.stat(regions_file[0])
+            meta['regions']['names'] = names
+            meta['regions']['file'].update(size=stat_regions.st_size,
+                                           mtime_ns=stat_regions.st_mtime_ns)
+
+    # regions majoritaires et variables decalees a recalculer
+    remove_derived(directory)
+
+    # l'empreinte complete n'est plus connue (voir `check_source`)
+    meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha1=None,
+                tail_sha1=file_digest(data_path,
+                                      max(0, stat.st_size-TAIL_SIZE),
+                                      stat.st_size),
+                nb_rows=nb_rows + nb_new)
+    write_meta(directory, meta)
+
+    return nb_new
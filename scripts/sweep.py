@@ -0,0 +1,169 @@
+"""Balayage de parametres.
+
+Ce module sert a entrainer et evaluer des modeles pour toutes les
+combinaisons d'une grille de parametres (periodes d'entrainement et de test,
+taille de grille, utilisation de Lyme) en parallele sur plusieurs processus,
+et a rassembler les resultats dans une seule table `.csv`.
+
+Les processus partagent les signalements discretises par le cache binaire
+(`sglmt_cache`) : les fichiers sont projetes en memoire et donc partages par
+le systeme au lieu d'etre relus par chaque processus. Un balayage interrompu
+peut etre relance : les combinaisons deja presentes dans la table sont
+ignorees. Une combinaison en erreur est signalee sans interrompre les autres
+et n'est pas ajoutee a la table (elle est donc reessayee a la relance).
+"""
+
+
+import os
+import sys
+import json
+import time
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import predictions
+from sglmt_cache import load_columns
+
+
+
+def param_grid(dates_train_li, dates_test_li, map_info_li, lyme_li):
+    """Renvoie la liste des combinaisons de parametres (dictionnaires).
+        `dates_train_li`: liste de couples sur les periodes d'entrainement
+        `dates_test_li`: liste de couples sur les periodes de test
+        `map_info_li`: liste de triplets sur la construction des cartes
+        `lyme_li`: liste de bool sur l'utilisation des donnees de Lyme"""
+
+    return [{'dates_train': dates_train, 'dates_test': dates_test,
+             'map_info': map_info, 'lyme': lyme}
+            for dates_train, dates_test, map_info, lyme in itertools.product(
+                dates_train_li, dates_test_li, map_info_li, lyme_li)]
+
+
+def combination_name(params, period=1, zero_fraction=None):
+    """Renvoie le nom (unique) d'une combinaison, utilise comme nom de modele.
+    Tous les reglages qui changent les resultats y figurent.
+        `params`: dictionnaire des parametres
+        `period`: periode de temps sur laquelle on rassemble les signalements
+        `zero_fraction`: None ou proportion des cases vides gardees pour
+        l'entrainement"""
+
+    (y1, m1), (y2, m2) = params['dates_train']
+    (y3, m3), (y4, m4) = params['dates_test']
+    nb_div_long, nb_div_lat = params['map_info'][:2]
+
+    return (f'model({m1:0>2}-{y1}->{m2:0>2}-{y2})'
+            f'_test({m3:0>2}-{y3}->{m4:0>2}-{y4})'
+            f'_{nb_div_long}x{nb_div_lat}'
+            + ('_lyme' if params['lyme'] else '') + f'_periode{period}'
+            + ('' if zero_fraction is None else f'_zeros{zero_fraction}'))
+
+
+def set_cache(cache_dir):
+    """Initialisation des processus : utilise le cache binaire partage.
+        `cache_dir`: repertoire du cache binaire des signalements"""
+
+    predictions.ensure_constants()
+    predictions.cache_path = cache_dir
+
+
+def run_combination(params, period, render, zero_fraction):
+    """Entraine et evalue le modele d'une combinaison et renvoie la ligne de
+    resultats correspondante.
+        `params`: dictionnaire des parametres
+        `period`: periode de temps sur laquelle on rassemble les signalements
+        `render`: bool sur la creation des cartes
+        `zero_fraction`: None ou proportion des cases vides gardees pour
+        l'entrainement"""
+
+    name = combination_name(params, period, zero_fraction)
+    map_info = tuple(params['map_info'])
+
+    train_time, model_size = predictions.make_model(
+        map_info, params['dates_train'], name, params['lyme'],
+        zero_fraction=zero_fraction)
+
+    start = time.perf_counter()
+    scores = predictions.predict(
+        map_info, params['dates_test'], period, name if render else None,
+        name, params['lyme'])
+    predict_time = time.perf_counter() - start
+
+    return {'nom': name,
+            'dates_train': json.dumps(params['dates_train']),
+            'dates_test': json.dumps(params['dates_test']),
+            'nb_div_long': map_info[0], 'nb_div_lat': map_info[1],
+            'lyme': params['lyme'],
+            'periode': period,
+            'zero_fraction': zero_fraction,
+            **scores['global'][0],
+            'r2_mois': json.dumps([(f'{period["date"][1]:0>2}'
+                                    f'/20{period["date"][0]}',
+                                    period['scores'][0]['r2'])
+                                   for period in scores['periodes']]),
+            'temps_entrainement': train_time,
+            'temps_prediction': predict_time,
+            'taille_modele': model_size,
+            'modele': os.path.join(predictions.model_path, name)}
+
+
+def sweep(grid, results_file, period=1, render=False, zero_fraction=None,
+          nb_workers=None):
+    """Evalue toutes les combinaisons d'une grille en parallele et ajoute les
+    resultats a la table `results_file` au fur et a mesure. Renvoie la table
+    complete.
+        `grid`: liste de combinaisons (voir `param_grid`)
+        `results_file`: chemin de la table `.csv` des resultats
+        `period`: periode de temps sur laquelle on rassemble les signalements
+        `render`: bool sur la creation des cartes
+        `zero_fraction`: None ou proportion des cases vides gardees pour
+        l'entrainement
+        `nb_workers`: nombre de processus (None pour tous les coeurs)"""
+
+    # combinaisons deja evaluees
+    done = set()
+    if os.path.exists(results_file):
+        done = set(pd.read_csv(results_file)['nom'])
+    todo = [params for params in grid
+            if combination_name(params, period, zero_fraction) not in done]
+
+    # cache partage entre les processus (construit une seule fois ici)
+    predictions.ensure_constants()
+    cache_dir = predictions.cache_path
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'tipe_cache')
+    load_columns(predictions.sglmt_data_file, cache_dir)
+
+    with ProcessPoolExecutor(max_workers=nb_workers or os.cpu_count(),
+                             initializer=set_cache,
+                             initargs=(cache_dir,)) as executor:
+        futures = {executor.submit(run_combination, params, period, render,
+                                   zero_fraction): params
+                   for params in todo}
+        for future in as_completed(futures):
+            try:
+                row = pd.DataFrame([future.result()])
+            except Exception as error:
+                # une combinaison en erreur n'interrompt pas le balayage
+                name = combination_name(futures[future], period,
+                                        zero_fraction)
+                print(f'Erreur ({name}) : {type(error).__name__}: {error}',
+                      file=sys.stderr)
+                continue
+            row.to_csv(results_file, mode='a', index=False,
+                       header=not os.path.exists(results_file))
+
+    return pd.read_csv(results_file)
+
+
+if __name__ == '__main__':
+    predictions.ensure_constants()
+    grid = param_grid(
+        dates_train_li=[((17, 4), (19, 10)), ((17, 4), (20, 10))],
+        dates_test_li=[((20, 11), (21, 10))],
+        map_info_li=[(60, 60, 4), (120, 120, 4)],
+        lyme_li=[False, True])
+
+    results = sweep(grid, os.path.join(predictions.model_path,
+                                       'balayage.csv'))
+    print(results[['nom', 'r2', 'temps_entrainement', 'temps_prediction']])
@@ -0,0 +1,275 @@
+"""Modeles par tuiles.
+
+Ce module sert a decouper la carte en tuiles (rectangles de divisions de
+meme taille, ou rectangles englobant chaque region) et a entrainer un modele
+par tuile sur plusieurs processus. Chaque processus ne recoit que les
+signalements de sa tuile. Les modeles sont sauvegardes dans un seul fichier
+(`.joblib`, tableaux plats projetes en memoire a la lecture), et les
+predictions des tuiles, faites elles aussi en parallele par blocs de mois,
+sont rassemblees sur la carte entiere.
+"""
+
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from predictions import sparse_train_set
+from engines import fit_model, FLAT_ENGINES
+from flat_tree import to_nodes, tree_roots, predict_tree
+from profiling import stage
+from dtypes import values_max, widen, set_row, round_counts
+
+
+
+# nombre de mois predits a la fois par les tuiles (memoire proportionnelle a
+# ce nombre et non a la periode de test)
+BLOCK_MONTHS = 4
+
+
+def grid_tiles(map_info, tiles):
+    """Renvoie la liste des tuiles `(lat_range, long_range, mask)` d'un
+    decoupage regulier de la carte (`mask` vaut None : toutes les divisions
+    du rectangle).
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `tiles`: couple `(nb_tuiles_long, nb_tuiles_lat)`"""
+
+    nb_div_long, nb_div_lat = map_info
+    nb_tiles_long, nb_tiles_lat = tiles
+    lat_limits = np.linspace(0, nb_div_lat, nb_tiles_lat+1).astype(int)
+    long_limits = np.linspace(0, nb_div_long, nb_tiles_long+1).astype(int)
+
+    return [((int(lat_min), int(lat_max)), (int(long_min), int(long_max)),
+             None)
+            for lat_min, lat_max in zip(lat_limits, lat_limits[1:])
+            for long_min, long_max in zip(long_limits, long_limits[1:])
+            if lat_max > lat_min and long_max > long_min]
+
+
+def region_tiles(map_info, raster):
+    """Renvoie la liste des tuiles `(lat_range, long_range, mask)` des
+    regions : rectangle englobant les divisions de chaque region, et masque
+    (a plat) des divisions du rectangle qui appartiennent a la region.
+        `map_info`: couple `(nb_div_long, nb_div_lat)` sur la construction
+        des cartes
+        `raster`: code de region de chaque division (voir
+        `make_sglmt_df.regions_raster`)"""
+
+    nb_div_long, nb_div_lat = map_info
+    raster = np.asarray(raster).reshape(nb_div_lat, nb_div_long)
+
+    tiles = []
+    for code in np.unique(raster[raster >= 0]):
+        lat, long = np.nonzero(raster == code)
+        lat_range = (int(lat.min()), int(lat.max()) + 1)
+        long_range = (int(long.min()), int(long.max()) + 1)
+        mask = raster[lat_range[0]:lat_range[1],
+                      long_range[0]:long_range[1]] == code
+        tiles.append((lat_range, long_range, mask.ravel()))
+
+    return tiles
+
+
+def tile_train_set(cube, mask, zero_fraction, seed):
+    """Renvoie les donnees d'entrainement `(X, y, poids)` d'une tuile.
+        `cube`: `CountCube` de la tuile (voir `CountCube.crop`)
+        `mask`: None ou masque des divisions de la tuile a utiliser
+        `zero_fraction`: None (toutes les divisions) ou proportion des
+        divisions sans signalement conservees
+        `seed`: graine du tirage des divisions sans signalement"""
+
+    if zero_fraction is None:
+        indices = np.arange(cube.shape[0]*cube.map_size)
+        X, y, weights = cube.features(indices), cube.values_at(indices), None
+    else:
+        X, y, weights = sparse_train_set(cube, zero_fraction, seed)
+
+    if mask is not None:
+        # divisions de la region uniquement (indices locaux a la tuile)
+        lat = X[:, cube.feature_names.index('lat')].astype(np.int64)
+        long = X[:, cube.feature_names.index('long')].astype(np.int64)
+        cells = ((lat - cube.origin[0])*cube.nb_div_long
+                 + long - cube.origin[1])
+        keep = np.asarray(mask)[cells]
+        X, y = X[keep], y[keep]
+        weights = None if weights is None else weights[keep]
+
+    return X, y, weights
+
+
+def fit_tile(cube, mask, zero_fraction, seed, engine, nb_jobs):
+    """Entraine le modele d'une tuile et le renvoie (tableau de noeuds pour
+    les arbres et les forets, None si la tuile n'a aucun signalement).
+        `cube`: `CountCube` de la tuile
+        `mask`: None ou masque des divisions de la tuile a utiliser
+        `zero_fraction`: None ou proportion des divisions vides conservees
+        `seed`: graine des tirages et du modele
+        `engine`: methode de prediction (voir `engines.ENGINES`)
+        `nb_jobs`: nombre de coeurs de la foret"""
+
+    X, y, weights = tile_train_set(cube, mask, zero_fraction, seed)
+    if len(y) == 0 or not np.any(y):
+        return None
+
+    model = fit_model(X, y, weights, seed, engine, nb_jobs)
+
+    return to_nodes(model) if engine in FLAT_ENGINES else model
+
+
+def fit_tiles(cube, tiles, zero_fraction=None, seed=0, engine='arbre',
+              nb_jobs=1, nb_workers=None):
+    """Entraine un modele par tuile sur plusieurs processus et renvoie la
+    liste des modeles (voir `fit_tile`).
+        `cube`: `CountCube` de toute la carte
+        `tiles`: liste des tuiles (voir `grid_tiles` et `region_tiles`)
+        `zero_fraction`: None ou proportion des divisions vides conservees
+        `seed`: graine des tirages et des modeles
+        `engine`: methode de prediction
+        `nb_jobs`: nombre de coeurs de chaque foret
+        `nb_workers`: None (tous les coeurs) ou nombre de processus"""
+
+    with ProcessPoolExecutor(max_workers=nb_workers or os.cpu_count()) \
+            as executor:
+        futures = [executor.submit(fit_tile, cube.crop(lat_range, long_range),
+                                   mask, zero_fraction, seed, engine, nb_jobs)
+                   for lat_range, long_range, mask in tiles]
+        return [future.result() for future in futures]
+
+
+def save_bundle(path, map_info, tiles, models):
+    """Sauvegarde les modeles de toutes les tuiles dans un seul fichier.
+        `path`: chemin du fichier `.joblib`
+        `map_info`: couple `(nb_div_long, nb_div_lat)` de la carte
+        `tiles`: liste des tuiles
+        `models`: liste des modeles de chaque tuile (voir `fit_tile`)"""
+
+    import joblib
+    joblib.dump({'grille': tuple(map_info), 'tuiles': tiles,
+                 'modeles': models}, path)
+
+
+def load_bundle(path):
+    """Charge les modeles de toutes les tuiles (tableaux plats projetes en
+    memoire).
+        `path`: chemin du fichier `.joblib`"""
+
+    import joblib
+    return joblib.load(path, mmap_mode='r')
+
+
+def predict_tile(bundle_file, i, cube, chunk_size=None):
+    """Renvoie le tableau `(nb_mois, nb_divisions de la tuile)` des
+    predictions de la tuile `i`.
+        `bundle_file`: chemin du fichier des modeles (voir `save_bundle`)
+        `i`: indice de la tuile
+        `cube`: `CountCube` de la tuile
+        `chunk_size`: None (un mois a la fois) ou nombre de divisions
+        predites a la fois"""
+
+    model = load_bundle(bundle_file)['modeles'][i]
+    predicted = np.zeros((len(cube.dates), cube.map_size),
+                         dtype=cube.counts.dtype)
+    if model is None:
+        return predicted
+
+    if isinstance(model, np.ndarray):
+        roots = tree_roots(model)
+        predict = lambda X: predict_tree(model, X, roots)
+    else:
+        predict = model.predict
+
+    map_size = cube.map_size
+    chunk_size = map_size if chunk_size is None else chunk_size
+    for month in range(len(cube.dates)):
+        for start in range(0, map_size, chunk_size):
+            end = min(start+chunk_size, map_size)
+            X = cube.features(np.arange(month*map_size + start,
+                                        month*map_size + end))
+            predicted = set_row(predicted, (month, slice(start, end)),
+                                round_counts(predict(X)))
+
+    return predicted
+
+
+def submit_tiles(executor, bundle, bundle_file, cube, chunk_size):
+    """Lance la prediction de chaque tuile d'un cube et renvoie la liste des
+    `Future` correspondants (voir `predict_tile`).
+        `executor`: `ProcessPoolExecutor` des predictions
+        `bundle`: modeles charges (voir `load_bundle`)
+        `bundle_file`: chemin du fichier des modeles
+        `cube`: `CountCube` de toute la carte sur un bloc de mois
+        `chunk_size`: None ou nombre de divisions predites a la fois"""
+
+    return [executor.submit(predict_tile, bundle_file, i,
+                            cube.crop(lat_range, long_range), chunk_size)
+            for i, (lat_range, long_range, _)
+            in enumerate(bundle['tuiles'])]
+
+
+def assemble_tiles(bundle, futures, cube):
+    """Renvoie le tableau `(nb_mois, nb_div_lat, nb_div_long)` des
+    predictions d'un cube assemblees depuis celles des tuiles (divisions de
+    la region uniquement, divisions hors des tuiles predites a 0).
+        `bundle`: modeles charges (voir `load_bundle`)
+        `futures`: predictions des tuiles (voir `submit_tiles`)
+        `cube`: `CountCube` de toute la carte sur un bloc de mois"""
+
+    predicted = np.zeros(cube.shape, dtype=cube.counts.dtype)
+    for (lat_range, long_range, mask), future in zip(bundle['tuiles'],
+                                                      futures):
+        values = future.result()
+        predicted = widen(predicted, values_max(values))
+        tile = predicted[:, lat_range[0]:lat_range[1],
+                         long_range[0]:long_range[1]]
+        values = values.reshape((len(cube.dates),) + tile.shape[1:])
+        if mask is None:
+            tile[...] = values
+        else:
+            mask = np.asarray(mask).reshape(tile.shape[1:])
+            tile[:, mask] = values[:, mask]
+
+    return predicted
+
+
+def iter_tile_predictions(cube, bundle_file, chunk_size=None,
+                          nb_workers=None, block_size=BLOCK_MONTHS):
+    """Predit les tuiles sur plusieurs processus par blocs de `block_size`
+    mois et renvoie (generateur) pour chaque mois le triplet `(date, theory,
+    predicted)` sur la carte entiere (divisions hors des tuiles predites a
+    0). Seuls deux blocs sont en memoire : le bloc suivant est predit
+    pendant que les mois du bloc courant sont renvoyes.
+        `cube`: `CountCube` de toute la carte sur la periode de test
+        `bundle_file`: chemin du fichier des modeles (voir `save_bundle`)
+        `chunk_size`: None ou nombre de divisions predites a la fois
+        `nb_workers`: None (tous les coeurs) ou nombre de processus
+        `block_size`: nombre de mois predits a la fois"""
+
+    bundle = load_bundle(bundle_file)
+    if tuple(bundle['grille']) != (cube.nb_div_long, cube.nb_div_lat):
+        raise ValueError(f'Modeles entraines sur une grille '
+                         f'{bundle["grille"][0]}x{bundle["grille"][1]}')
+
+    nb_months = len(cube.dates)
+    blocks = [cube.slice_months(start, min(start+block_size, nb_months))
+              for start in range(0, nb_months, block_size)]
+
+    with ProcessPoolExecutor(max_workers=nb_workers or os.cpu_count()) \
+            as executor:
+        pending = (submit_tiles(executor, bundle, bundle_file, blocks[0],
+                                chunk_size) if blocks else None)
+        start = 0
+        for b, block in enumerate(blocks):
+            futures = pending
+            if b + 1 < len(blocks):
+                pending = submit_tiles(executor, bundle, bundle_file,
+                                       blocks[b+1], chunk_size)
+
+            with stage('prediction', tuiles=len(bundle['tuiles']),
+                       divisions=block.shape[0]*block.map_size):
+                predicted = assemble_tiles(bundle, futures, block)
+
+            for i in range(len(block.dates)):
+                yield (cube.dates[start+i],
+                       cube.month_dense(start+i).ravel(),
+                       predicted[i].ravel())
+            start += len(block.dates)